@@ -22,20 +22,20 @@
 # SOFTWARE.
 
 import asyncio
+import bisect
 import threading
 import itertools
 from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List, Mapping, Union
+from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List, Mapping, Union, Iterable
 
-from .crypto import sha256
 from . import bitcoin, util
 from .bitcoin import COINBASE_MATURITY
 from .util import profiler, bfh, TxMinedInfo, UnrelatedTransactionException, with_lock, OldTaskGroup
 from .transaction import Transaction, TxOutput, TxInput, PartialTxInput, TxOutpoint
 from .synchronizer import Synchronizer
 from .verifier import SPV
-from .asset import get_asset_info_from_script, AssetMetadata, get_error_for_asset_typed, AssetType
-from .blockchain import hash_header, Blockchain
+from .asset import get_asset_info_from_outputs, AssetMetadata, get_error_for_asset_typed, AssetType
+from .blockchain import Blockchain, MissingHeader
 from .i18n import _
 from .logging import Logger
 from .util import EventListener, event_listener
@@ -70,6 +70,42 @@ class HistoryItem(NamedTuple):
     balance: int
 
 
+class AdbChanges:
+    """What changed in an AddressSynchronizer since the last take():
+    the txids whose history row changed, the addresses whose balance or history
+    changed, and the assets touched. everything is set when the whole wallet
+    history was reloaded. See AddressSynchronizer.add_change_tracker.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.txids = set()  # type: Set[str]
+        self.addresses = set()  # type: Set[str]
+        self.assets = set()  # type: Set[Optional[str]]
+        self.everything = False
+
+    def add(self, *, txids: Iterable[str] = (), addresses: Iterable[str] = (),
+            assets: Iterable[Optional[str]] = (), everything: bool = False) -> None:
+        with self.lock:
+            self.txids.update(txids)
+            self.addresses.update(addresses)
+            self.assets.update(assets)
+            self.everything |= everything
+
+    def take(self) -> 'AdbChanges':
+        """Returns the changes accumulated so far, and starts over."""
+        changes = AdbChanges()
+        with self.lock:
+            changes.txids, self.txids = self.txids, set()
+            changes.addresses, self.addresses = self.addresses, set()
+            changes.assets, self.assets = self.assets, set()
+            changes.everything, self.everything = self.everything, False
+        return changes
+
+    def is_empty(self) -> bool:
+        return not (self.txids or self.addresses or self.assets or self.everything)
+
+
 class AddressSynchronizer(Logger, EventListener):
     """ address database """
 
@@ -97,6 +133,7 @@ class AddressSynchronizer(Logger, EventListener):
         self.unconfirmed_tx = defaultdict(int)  # type: Dict[str, int]  # txid -> height. Access with self.lock.
         # thread local storage for caching stuff
         self.threadlocal_cache = threading.local()
+        self._change_trackers = []  # type: List[AdbChanges]
 
         self.unverified_asset_metadata = {}  # type: Dict[str, Tuple[AssetMetadata, Tuple[TxOutpoint, int], Optional[Tuple[TxOutpoint, int]], Optional[Tuple[TxOutpoint, int]]]]
         self.unconfirmed_asset_metadata = {}  # type: Dict[str, Tuple[AssetMetadata, Tuple[TxOutpoint, int], Optional[Tuple[TxOutpoint, int]], Optional[Tuple[TxOutpoint, int]]]]
@@ -116,10 +153,6 @@ class AddressSynchronizer(Logger, EventListener):
         self.unverified_broadcast = defaultdict(dict)
         self.unconfirmed_broadcast = defaultdict(dict)
 
-        self._get_balance_cache = {}
-        self._get_asset_balance_cache = {}
-        self._get_assets_in_mempool_cache = {}
-
         self.load_and_cleanup()
 
     def diagnostic_name(self):
@@ -133,6 +166,7 @@ class AddressSynchronizer(Logger, EventListener):
 
     def load_and_cleanup(self):
         self.load_local_history()
+        self.load_utxo_index()
         self.check_history()
         self.load_unverified_transactions()
         self.remove_local_transactions_we_dont_have()
@@ -258,9 +292,6 @@ class AddressSynchronizer(Logger, EventListener):
 
     @event_listener
     def on_event_blockchain_updated(self, *args):
-        self._get_balance_cache = {}  # invalidate cache
-        self._get_asset_balance_cache = {}
-        self._get_assets_in_mempool_cache = {}
         self.db.put('stored_height', self.get_local_height())
 
     async def stop(self):
@@ -276,9 +307,32 @@ class AddressSynchronizer(Logger, EventListener):
                 self.verifier = None
                 self.unregister_callbacks()
 
+    def add_change_tracker(self) -> AdbChanges:
+        """Returns an AdbChanges that accumulates what changes from now on,
+        so that e.g. a GUI can update only the affected rows.
+        """
+        tracker = AdbChanges()
+        with self.lock:
+            self._change_trackers.append(tracker)
+        return tracker
+
+    def remove_change_tracker(self, tracker: AdbChanges) -> None:
+        with self.lock:
+            if tracker in self._change_trackers:
+                self._change_trackers.remove(tracker)
+
+    def _note_changes(self, **kwargs) -> None:
+        for tracker in self._change_trackers:
+            tracker.add(**kwargs)
+
+    def _mark_tx_dirty(self, txid: str) -> None:
+        self._history_dirty.add(txid)
+        self._note_changes(txids=(txid,))
+
     def add_address(self, address):
         if address not in self.db.history:
             self.db.history[address] = []
+        self._note_changes(addresses=(address,))
         if self.synchronizer:
             self.synchronizer.add(address)
         self.up_to_date_changed()
@@ -389,9 +443,7 @@ class AddressSynchronizer(Logger, EventListener):
                         pass
                     else:
                         self.db.add_txi_addr(tx_hash, addr, ser, v, asset)
-                        self._get_balance_cache.clear()  # invalidate cache
-                        self._get_asset_balance_cache.clear()
-                        self._get_assets_in_mempool_cache.clear()
+                        self._remove_from_utxo_index(txi.prevout)
             for txi in tx.inputs():
                 if txi.is_coinbase_input():
                     continue
@@ -409,24 +461,24 @@ class AddressSynchronizer(Logger, EventListener):
                     util.trigger_callback('adb_swap_redeemed', self, swap_id)
 
             # add outputs
-            for n, txo in enumerate(tx.outputs()):
+            outputs = tx.outputs()
+            for n, (txo, asset_data) in enumerate(zip(outputs, get_asset_info_from_outputs(outputs))):
                 v = txo.value
                 ser = tx_hash + ':%d'%n
-                asset_data = get_asset_info_from_script(txo.scriptpubkey)
                 scripthash = bitcoin.script_to_scripthash(txo.scriptpubkey.hex())
                 self.db.add_prevout_by_scripthash(scripthash, prevout=TxOutpoint.from_str(ser), value=asset_data.amount or v, asset=asset_data.asset)
                 addr = txo.address
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, asset_data.amount or v, asset_data.asset, is_coinbase)
-                    self._get_balance_cache.clear()  # invalidate cache
-                    self._get_asset_balance_cache.clear()
-                    self._get_assets_in_mempool_cache.clear()
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
                         self.db.add_txi_addr(next_tx, addr, ser, asset_data.amount or v, asset_data.asset)
                         self._add_tx_to_local_history(next_tx)
+                        self._update_balances_of_tx(next_tx)
                     else:
+                        self._add_to_utxo_index(TxOutpoint(txid=bfh(tx_hash), out_idx=n),
+                                                addr, asset_data.asset, asset_data.amount or v, is_coinbase)
                         if asset_data.asset:
                             self.watch_asset(asset_data.asset)
                         if not asset_data.is_deterministic():
@@ -439,6 +491,7 @@ class AddressSynchronizer(Logger, EventListener):
 
             # add to local history
             self._add_tx_to_local_history(tx_hash)
+            self._update_balances_of_tx(tx_hash)
             # save
             self.db.add_transaction(tx_hash, tx)
             self.db.add_num_inputs_to_tx(tx_hash, len(tx.inputs()))
@@ -512,10 +565,16 @@ class AddressSynchronizer(Logger, EventListener):
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
-            for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
-                self._get_balance_cache.clear()  # invalidate cache
-                self._get_asset_balance_cache.clear()
-                self._get_assets_in_mempool_cache.clear()
+            # our coins created by this tx are gone, the ones it spent are unspent again
+            for addr in self.db.get_txo_addresses(tx_hash):
+                for n in self.db.get_txo_addr(tx_hash, addr):
+                    self._remove_from_utxo_index(TxOutpoint(txid=bfh(tx_hash), out_idx=n))
+            for addr in self.db.get_txi_addresses(tx_hash):
+                for prevout_str, v, asset in self.db.get_txi_addr(tx_hash, addr):
+                    prevout = TxOutpoint.from_str(prevout_str)
+                    txo = self.db.get_txo_addr(prevout.txid.hex(), addr).get(prevout.out_idx)
+                    if txo is not None:
+                        self._add_to_utxo_index(prevout, addr, asset, v, txo[2])
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
             self.db.remove_tx_fee(tx_hash)
@@ -554,6 +613,7 @@ class AddressSynchronizer(Logger, EventListener):
                     self.db.remove_verified_tx(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
+                    self._update_balances_of_tx(tx_hash)
             self.db.set_addr_history(addr, hist)
 
         for tx_hash, tx_height in hist:
@@ -572,14 +632,192 @@ class AddressSynchronizer(Logger, EventListener):
         # Store fees
         for tx_hash, fee_sat in tx_fees.items():
             self.db.add_tx_fee_from_server(tx_hash, fee_sat)
+            self._mark_tx_dirty(tx_hash)
 
     @profiler
     def load_local_history(self):
         self._history_local = {}  # type: Dict[str, Set[str]]  # address -> set(txid)
         self._address_history_changed_events = defaultdict(asyncio.Event)  # address -> Event
+        self._reset_history_index()
         for txid in itertools.chain(self.db.list_txi(), self.db.list_txo()):
             self._add_tx_to_local_history(txid)
 
+    def _reset_history_index(self):
+        """The history index is the wallet history (all addresses), ordered by
+        _get_tx_sort_key, with running balances. It is updated lazily by
+        get_history: txs in _history_dirty are spliced out and back in,
+        and balances are only recomputed from the first changed position.
+        """
+        self._history_order = []  # type: List[Tuple[Tuple[int, int], str]]  # sorted (sort_key, txid)
+        self._history_rows = []  # type: List[Sequence[Tuple[Optional[str], int, int]]]  # (asset, delta, balance), parallel to _history_order
+        self._history_txs = {}  # type: Dict[str, Tuple[Tuple[int, int], Dict[Optional[str], int], Optional[int]]]  # txid -> (sort_key, deltas, fee)
+        self._history_totals = defaultdict(int)  # type: Dict[Optional[str], int]
+        self._history_dirty = set()  # type: Set[str]
+        self._history_local_height = None  # type: Optional[int]
+
+    def load_utxo_index(self):
+        """Builds the index of our unspent outputs from the txo/txi tables of the db.
+        From then on, it is updated as transactions are added and removed.
+        """
+        with self.transaction_lock:
+            self._utxos = {}  # type: Dict[TxOutpoint, Tuple[str, Optional[str], int, bool]]  # -> (address, asset, value, is_coinbase)
+            self._utxos_by_address = defaultdict(set)  # type: Dict[str, Set[TxOutpoint]]
+            self._utxos_by_asset = defaultdict(set)  # type: Dict[Optional[str], Set[TxOutpoint]]
+            # balance counters, see _apply_utxo_balance
+            self._utxo_balances = {}  # type: Dict[TxOutpoint, Tuple[int, int, int, bool]]  # -> (c, u, x, in_mempool)
+            self._addr_balances = defaultdict(dict)  # type: Dict[str, Dict[Optional[str], List[int]]]  # addr -> asset -> [c, u, x, n_mempool, n_utxos]
+            self._balance_totals = {}  # type: Dict[Optional[str], List[int]]  # asset -> [c, u, x, n_mempool, n_utxos]
+            self._coinbase_utxos = set()  # type: Set[TxOutpoint]
+            self._mempool_utxos = set()  # type: Set[TxOutpoint]
+            self._balances_local_height = self.get_local_height()
+            for tx_hash in self.db.list_txo():
+                for addr in self.db.get_txo_addresses(tx_hash):
+                    for n, (v, asset, is_cb) in self.db.get_txo_addr(tx_hash, addr).items():
+                        self._add_to_utxo_index(TxOutpoint(txid=bfh(tx_hash), out_idx=n), addr, asset, v, is_cb)
+            for tx_hash in self.db.list_txi():
+                for addr in self.db.get_txi_addresses(tx_hash):
+                    for prevout_str, v, asset in self.db.get_txi_addr(tx_hash, addr):
+                        self._remove_from_utxo_index(TxOutpoint.from_str(prevout_str))
+
+    def _add_to_utxo_index(self, prevout: TxOutpoint, address: str, asset: Optional[str],
+                           value: int, is_coinbase: bool) -> None:
+        self._remove_from_utxo_index(prevout)
+        self._utxos[prevout] = (address, asset, value, is_coinbase)
+        self._utxos_by_address[address].add(prevout)
+        self._utxos_by_asset[asset].add(prevout)
+        if is_coinbase:
+            self._coinbase_utxos.add(prevout)
+        self._apply_utxo_balance(prevout)
+
+    def _remove_from_utxo_index(self, prevout: TxOutpoint) -> None:
+        if prevout not in self._utxos:
+            return
+        self._unapply_utxo_balance(prevout)
+        address, asset, value, is_coinbase = self._utxos.pop(prevout)
+        self._coinbase_utxos.discard(prevout)
+        for index, key in ((self._utxos_by_address, address), (self._utxos_by_asset, asset)):
+            index[key].discard(prevout)
+            if not index[key]:
+                del index[key]
+
+    def _get_utxo_from_index(self, prevout: TxOutpoint) -> PartialTxInput:
+        address, asset, value, is_coinbase = self._utxos[prevout]
+        tx_mined_info = self.get_tx_height(prevout.txid.hex())
+        utxo = PartialTxInput(prevout=prevout, is_coinbase_output=is_coinbase)
+        utxo._trusted_address = address
+        utxo._trusted_value_sats = value
+        utxo._trusted_asset = asset
+        utxo.block_height = tx_mined_info.height
+        utxo.block_txpos = tx_mined_info.txpos if tx_mined_info.txpos is not None else -1
+        utxo.spent_txid = None
+        utxo.spent_height = None
+        return utxo
+
+    def _get_unspent_outpoints(self, domain: Set[str], *,
+                               assets: Set[Optional[str]] = None) -> Sequence[TxOutpoint]:
+        """Returns our unspent outpoints in domain (and of given assets), from the index.
+        Iterates over whichever is smaller: the addresses, or the matching unspent set.
+        """
+        if assets is not None:
+            candidates = itertools.chain.from_iterable(self._utxos_by_asset.get(asset, ()) for asset in assets)
+            return [prevout for prevout in candidates if self._utxos[prevout][0] in domain]
+        if len(domain) > len(self._utxos):
+            return [prevout for prevout, utxo in self._utxos.items() if utxo[0] in domain]
+        return [prevout for addr in domain for prevout in self._utxos_by_address.get(addr, ())]
+
+    def _compute_utxo_balance(self, prevout: TxOutpoint) -> Tuple[int, int, int, bool]:
+        """Returns how an unspent output contributes to the balance:
+        (confirmed, unconfirmed, unmatured, in_mempool)
+        """
+        address, asset, value, is_cb = self._utxos[prevout]
+        txid = prevout.txid.hex()
+        tx_height = self.get_tx_height(txid).height
+        if is_cb and tx_height + COINBASE_MATURITY > self._balances_local_height + 1:
+            return 0, 0, value, False
+        if tx_height > 0:
+            return value, 0, 0, False
+        # we look at the outputs that are spent by this transaction
+        # if those outputs are ours and confirmed, we count this coin as confirmed
+        # Compare amount, in case tx has confirmed and unconfirmed inputs, or is a coinjoin.
+        # (fixme: tx may have multiple change outputs)
+        spent_amount = self._get_confirmed_spent_amounts(txid).get(asset, 0)
+        c = min(value, spent_amount)
+        return c, value - c, 0, True
+
+    def _add_balance_delta(self, address: str, asset: Optional[str],
+                           delta: Tuple[int, int, int, bool], sign: int) -> None:
+        c, u, x, in_mempool = delta
+        self._note_changes(addresses=(address,), assets=(asset,))
+        d = (sign * c, sign * u, sign * x, sign * int(in_mempool), sign)
+        addr_balances = self._addr_balances[address]
+        for counters, key in ((addr_balances, asset), (self._balance_totals, asset)):
+            row = counters.setdefault(key, [0, 0, 0, 0, 0])
+            for i in range(5):
+                row[i] += d[i]
+            if not row[4]:
+                del counters[key]
+        if not addr_balances:
+            del self._addr_balances[address]
+
+    def _apply_utxo_balance(self, prevout: TxOutpoint) -> None:
+        address, asset, value, is_cb = self._utxos[prevout]
+        balance = self._compute_utxo_balance(prevout)
+        self._utxo_balances[prevout] = balance
+        if balance[3]:
+            self._mempool_utxos.add(prevout)
+        self._add_balance_delta(address, asset, balance, +1)
+
+    def _unapply_utxo_balance(self, prevout: TxOutpoint) -> None:
+        balance = self._utxo_balances.pop(prevout, None)
+        if balance is None:
+            return
+        self._mempool_utxos.discard(prevout)
+        address, asset, value, is_cb = self._utxos[prevout]
+        self._add_balance_delta(address, asset, balance, -1)
+
+    def _refresh_utxo_balance(self, prevout: TxOutpoint) -> None:
+        if prevout not in self._utxos:
+            return
+        balance = self._compute_utxo_balance(prevout)
+        if balance == self._utxo_balances.get(prevout):
+            return
+        self._unapply_utxo_balance(prevout)
+        address, asset, value, is_cb = self._utxos[prevout]
+        self._utxo_balances[prevout] = balance
+        if balance[3]:
+            self._mempool_utxos.add(prevout)
+        self._add_balance_delta(address, asset, balance, +1)
+
+    def _update_balances_of_tx(self, txid: str) -> None:
+        """Called when txid was added or its height changed.
+        Recomputes the balance contribution of its unspent outputs,
+        and of those of the transactions spending them (see _compute_utxo_balance).
+        The tx is also repositioned in the history index on the next get_history.
+        """
+        with self.lock, self.transaction_lock:
+            self._mark_tx_dirty(txid)
+            txids = {txid}
+            for addr in self.db.get_txo_addresses(txid):
+                for n in self.db.get_txo_addr(txid, addr):
+                    spender = self.db.get_spent_outpoint(txid, n)
+                    if spender is not None:
+                        txids.add(spender)
+            for tx_hash in txids:
+                for addr in self.db.get_txo_addresses(tx_hash):
+                    for n in self.db.get_txo_addr(tx_hash, addr):
+                        self._refresh_utxo_balance(TxOutpoint(txid=bfh(tx_hash), out_idx=n))
+
+    def _update_coinbase_maturity(self) -> None:
+        """Coinbase outputs mature as the chain grows; their contribution
+        is recomputed lazily, when the local height has changed.
+        """
+        local_height = self.get_local_height()
+        if local_height == self._balances_local_height:
+            return
+        self._balances_local_height = local_height
+        for prevout in list(self._coinbase_utxos):
+            self._refresh_utxo_balance(prevout)
+
     @profiler
     def check_history(self):
         hist_addrs_mine = list(filter(lambda k: self.is_mine(k), self.db.get_history()))
@@ -606,9 +844,9 @@ class AddressSynchronizer(Logger, EventListener):
             with self.transaction_lock:
                 self.db.clear_history()
                 self._history_local.clear()
-                self._get_balance_cache.clear()  # invalidate cache
-                self._get_asset_balance_cache.clear()
-                self._get_assets_in_mempool_cache.clear()
+                self._reset_history_index()
+                self.load_utxo_index()
+                self._note_changes(everything=True)
 
     def _get_tx_sort_key(self, tx_hash: str) -> Tuple[int, int]:
         """Returns a key to be used for sorting txs."""
@@ -649,8 +887,36 @@ class AddressSynchronizer(Logger, EventListener):
     @with_lock
     @with_transaction_lock
     @with_local_height_cached
-    def get_history(self, domain) -> Sequence[HistoryItem]:
+    def get_history(self, domain, *, sanity_check: bool = False) -> Sequence[HistoryItem]:
         domain = set(domain)
+        if domain.issuperset(self._history_local):
+            self._update_history_index()
+            history = []
+            for (sort_key, tx_hash), rows in zip(self._history_order, self._history_rows):
+                tx_mined_status = self.get_tx_height(tx_hash)
+                fee = self._history_txs[tx_hash][2]
+                for asset, delta, balance in rows:
+                    history.append(HistoryItem(
+                        txid=tx_hash,
+                        tx_mined_status=tx_mined_status,
+                        asset=asset,
+                        delta=delta,
+                        fee=fee,
+                        balance=balance))
+            balance = self._history_totals
+        else:
+            history, balance = self._compute_history(domain)
+        if sanity_check:
+            asset_balances = self.get_balance(domain, asset_aware=True)
+            for key, _balance in balance.items():
+                c, u, x = asset_balances[key]
+                if _balance != c + u + x:
+                    self.logger.error(f'sanity check failed! key={key}; c={c},u={u},x={x} while history balance={_balance}')
+                    raise Exception("wallet.get_history() failed balance sanity-check")
+        return history
+
+    def _compute_history(self, domain: Set[str]) -> Tuple[Sequence[HistoryItem], Mapping[Optional[str], int]]:
+        """Computes the history of a subset of our addresses from scratch."""
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(lambda: defaultdict(int))  # type: Dict[str, Dict[Optional[str], int]]
@@ -666,7 +932,7 @@ class AddressSynchronizer(Logger, EventListener):
             fee = self.get_tx_fee(tx_hash)
             for _asset, delta in tx_deltas[tx_hash].items():
                 history.append((tx_hash, tx_mined_status, _asset, delta, fee))
-        history.sort(key = lambda x: self._get_tx_sort_key(x[0]))
+        history.sort(key = lambda x: (self._get_tx_sort_key(x[0]), x[0]))  # same order as the index
         # 3. add balance
         h2 = []
         balance = defaultdict(int)
@@ -679,25 +945,85 @@ class AddressSynchronizer(Logger, EventListener):
                 delta=delta,
                 fee=fee,
                 balance=balance[asset]))
-        # sanity check
-        asset_balances = self.get_balance(domain, asset_aware=True)
-        for key, _balance in balance.items():
-            c, u, x = asset_balances[key]
-            if _balance != c + u + x:
-                self.logger.error(f'sanity check failed! key={key}; c={c},u={u},x={x} while history balance={_balance}')
-                raise Exception("wallet.get_history() failed balance sanity-check")
-        return h2
+        return h2, balance
+
+    def _get_history_entry(self, tx_hash: str) -> Optional[Tuple[Tuple[int, int], Dict[Optional[str], int], Optional[int]]]:
+        addresses = set(itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)))
+        if not addresses:
+            return None
+        deltas = defaultdict(int)
+        for addr in addresses:
+            for asset, value in self.get_tx_delta(tx_hash, addr).items():
+                deltas[asset] += value
+        return self._get_tx_sort_key(tx_hash), dict(deltas), self.get_tx_fee(tx_hash)
+
+    def _update_history_index(self) -> None:
+        # future txs become local when the chain reaches their wanted height
+        local_height = self.get_local_height()
+        if local_height != self._history_local_height:
+            self._history_local_height = local_height
+            self._history_dirty.update(self.future_tx)
+        if not self._history_dirty:
+            return
+        dirty, self._history_dirty = self._history_dirty, set()
+        order = self._history_order
+        if len(dirty) > len(order) // 4:
+            # many changes (e.g. initial load): a full sort is cheaper than splicing
+            for tx_hash in dirty:
+                if (entry := self._get_history_entry(tx_hash)) is not None:
+                    self._history_txs[tx_hash] = entry
+                else:
+                    self._history_txs.pop(tx_hash, None)
+            order[:] = sorted((entry[0], tx_hash) for tx_hash, entry in self._history_txs.items())
+            self._history_rows = [()] * len(order)
+            self._history_totals = defaultdict(int)
+            for entry in self._history_txs.values():
+                for asset, delta in entry[1].items():
+                    self._history_totals[asset] += delta
+            first_changed = 0
+        else:
+            first_changed = len(order)
+            for tx_hash in dirty:
+                old_entry = self._history_txs.pop(tx_hash, None)
+                if old_entry is not None:
+                    pos = bisect.bisect_left(order, (old_entry[0], tx_hash))
+                    del order[pos]
+                    del self._history_rows[pos]
+                    first_changed = min(first_changed, pos)
+                    for asset, delta in old_entry[1].items():
+                        self._history_totals[asset] -= delta
+                new_entry = self._get_history_entry(tx_hash)
+                if new_entry is not None:
+                    self._history_txs[tx_hash] = new_entry
+                    pos = bisect.bisect_left(order, (new_entry[0], tx_hash))
+                    order.insert(pos, (new_entry[0], tx_hash))
+                    self._history_rows.insert(pos, ())
+                    first_changed = min(first_changed, pos)
+                    for asset, delta in new_entry[1].items():
+                        self._history_totals[asset] += delta
+        # recompute running balances, walking back from the totals
+        balance = dict(self._history_totals)
+        for pos in range(len(order) - 1, first_changed - 1, -1):
+            deltas = self._history_txs[order[pos][1]][1]
+            rows = []
+            for asset, delta in deltas.items():
+                rows.append((asset, delta, balance[asset]))
+                balance[asset] -= delta
+            self._history_rows[pos] = rows
 
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
+            self._mark_tx_dirty(txid)
             for addr in itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid)):
                 cur_hist = self._history_local.get(addr, set())
                 cur_hist.add(txid)
                 self._history_local[addr] = cur_hist
                 self._mark_address_history_changed(addr)
+                self._note_changes(addresses=(addr,))
 
     def _remove_tx_from_local_history(self, txid):
         with self.transaction_lock:
+            self._mark_tx_dirty(txid)
             for addr in itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid)):
                 cur_hist = self._history_local.get(addr, set())
                 try:
@@ -707,6 +1033,7 @@ class AddressSynchronizer(Logger, EventListener):
                 else:
                     self._history_local[addr] = cur_hist
                     self._mark_address_history_changed(addr)
+                    self._note_changes(addresses=(addr,))
 
     def _mark_address_history_changed(self, addr: str) -> None:
         def set_and_clear():
@@ -742,6 +1069,7 @@ class AddressSynchronizer(Logger, EventListener):
                     self.unverified_tx[tx_hash] = tx_height
                 else:
                     self.unconfirmed_tx[tx_hash] = tx_height
+        self._update_balances_of_tx(tx_hash)
 
     def add_unverified_or_unconfirmed_asset_metadata(self, asset, d):
         metadata = AssetMetadata(
@@ -777,6 +1105,7 @@ class AddressSynchronizer(Logger, EventListener):
                 self.unverified_asset_metadata[asset] = metadata, source, source_divisions, source_ipfs
             else:
                 self.unconfirmed_asset_metadata[asset] = metadata, source, source_divisions, source_ipfs
+                self._note_changes(assets=(asset,))
                 util.trigger_callback('adb_added_unconfirmed_asset_metadata', self, asset)
 
     def get_unverified_asset_metadatas(self):
@@ -802,6 +1131,7 @@ class AddressSynchronizer(Logger, EventListener):
                     old_ipfs_str = old_metadata.associated_data_as_ipfs()
                     util.trigger_callback('ipfs_hash_dissociate_asset', old_ipfs_str, asset)
             self.db.add_verified_asset_metadata(asset, metadata, source_tup, source_divisions_tup, source_associated_data_tup)
+        self._note_changes(assets=(asset,))
         util.trigger_callback('adb_added_verified_asset_metadata', self, asset)
 
     def get_metadata_for_synchronizer(self, asset: str) -> Optional[AssetMetadata]:
@@ -912,6 +1242,7 @@ class AddressSynchronizer(Logger, EventListener):
         with self.lock:
             self.unverified_verifier_for_restricted.pop(asset, None)
             self.db.add_verified_restricted_verifier(asset, d)
+        self._note_changes(assets=(asset,))
         util.trigger_callback('adb_added_verified_restricted_verifier', self, asset, d['string'])
 
     def add_unverified_or_unconfirmed_associations(self, asset: str, data: Dict):
@@ -934,6 +1265,7 @@ class AddressSynchronizer(Logger, EventListener):
                     self.unverified_broadcast[asset][tx_hash] = d
                 else:
                     self.unconfirmed_broadcast[asset][tx_hash] = d
+                    self._note_changes(assets=(asset,))
                     util.trigger_callback('adb_added_unconfirmed_broadcast', self, asset, tx_hash)
 
     def get_broadcasts_for_synchronizer(self, asset: str) -> Dict[str, Dict[str, object]]:
@@ -981,6 +1313,7 @@ class AddressSynchronizer(Logger, EventListener):
             if not self.unverified_broadcast.get(asset, None):
                 self.unverified_broadcast.pop(asset, None)
             self.db.add_verified_broadcast(asset, tx_hash, data)
+        self._note_changes(assets=(asset,))
         util.trigger_callback('adb_added_verified_broadcast', self, asset, tx_hash)
 
     def add_unverified_or_unconfirmed_freeze_for_restricted(self, asset: str, data):
@@ -1030,6 +1363,7 @@ class AddressSynchronizer(Logger, EventListener):
         with self.lock:
             self.unverified_freeze_for_restricted.pop(asset, None)
             self.db.add_verified_restricted_freeze(asset, d)
+        self._note_changes(assets=(asset,))
         util.trigger_callback('adb_added_verified_restricted_freeze', self, asset, d['frozen'])
 
     def add_unverified_or_unconfirmed_tags_for_h160(self, h160, asset_tags):
@@ -1117,6 +1451,7 @@ class AddressSynchronizer(Logger, EventListener):
             if not self.unverified_tags_for_h160.get(h160):
                 self.unverified_tags_for_h160.pop(h160, None)
             self.db.add_verified_h160_tag(h160, asset, d)
+        self._note_changes(addresses=(bitcoin.hash160_to_p2pkh(bfh(h160)),), assets=(asset,))
         util.trigger_callback('adb_added_verified_tag_for_h160', self, h160, asset)
 
     def add_unverified_or_unconfirmed_tags_for_qualifier(self, asset, h160_tags):
@@ -1178,6 +1513,7 @@ class AddressSynchronizer(Logger, EventListener):
             if not self.unverified_tags_for_qualifier.get(asset):
                 self.unverified_tags_for_qualifier.pop(asset, None)
             self.db.add_verified_qualifier_tag(asset, h160, d)
+        self._note_changes(assets=(asset,))
         util.trigger_callback('adb_added_verified_tag_for_qualifier', self, asset, h160)
 
     def get_tags_for_qualifier(self, asset: str, *, include_mempool=True):
@@ -1215,12 +1551,14 @@ class AddressSynchronizer(Logger, EventListener):
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+        self._update_balances_of_tx(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+        self._update_balances_of_tx(tx_hash)
         util.trigger_callback('adb_added_verified_tx', self, tx_hash)
 
     def get_unverified_txs(self) -> Dict[str, int]:
@@ -1232,12 +1570,21 @@ class AddressSynchronizer(Logger, EventListener):
         '''Used by the verifier when a reorg has happened'''
         txs = set()
         assets = set()
+        header_hashes = {}  # height -> hash of our header at that height
+        def is_still_verified(height: int, txid: str) -> bool:
+            verified_info = self.db.get_verified_tx(txid)
+            if not verified_info:
+                return False
+            if height not in header_hashes:
+                try:
+                    header_hashes[height] = blockchain.get_hash(height)
+                except MissingHeader:
+                    header_hashes[height] = None
+            return header_hashes[height] == verified_info.header_hash
         with self.lock:
             for asset in self.db.get_assets_verified_after_height(above_height):
                 base_outpoint, base_height = self.db.get_verified_asset_metadata_base_source(asset)
-                verified_info = self.db.get_verified_tx(base_outpoint.txid.hex())
-                header = blockchain.read_header(base_height)
-                if header and verified_info and hash_header(header) == verified_info.header_hash: continue
+                if is_still_verified(base_height, base_outpoint.txid.hex()): continue
                 assets.add(asset)
                 tup = self.db.remove_verified_asset_metadata(asset)
                 self.unverified_asset_metadata[asset] = tup
@@ -1249,69 +1596,58 @@ class AddressSynchronizer(Logger, EventListener):
                     txs.add(associated_data_tup[0].txid.hex())
             for asset in self.db.get_verified_restricted_verifier_after_height(above_height):
                 data = self.db.get_verified_restricted_verifier(asset)
-                verified_info = self.db.get_verified_tx(data['tx_hash'])
-                header = blockchain.read_header(data['height'])
-                if header and verified_info and hash_header(header) == verified_info.header_hash: continue
+                if is_still_verified(data['height'], data['tx_hash']): continue
                 
                 self.db.remove_verified_restricted_verifier(asset)
                 txs.add(data['tx_hash'])
             for asset in self.db.get_verified_restricted_freezes_after_height(above_height):
                 data = self.db.get_verified_restricted_freeze(asset)
-                verified_info = self.db.get_verified_tx(data['tx_hash'])
-                header = blockchain.read_header(data['height'])
-                if header and verified_info and hash_header(header) == verified_info.header_hash: continue
+                if is_still_verified(data['height'], data['tx_hash']): continue
                 
                 self.db.remove_verified_restricted_freeze(asset)
                 txs.add(data['tx_hash'])
             for asset, h160s in self.db.get_verified_qualifier_tags_after_height(above_height).items():
                 for h160 in h160s:
                     tag_data = self.db.get_verified_qualifier_tag(asset, h160)
-                    verified_info = self.db.get_verified_tx(tag_data['tx_hash'])
-                    header = blockchain.read_header(tag_data['height'])
-                    if header and verified_info and hash_header(header) == verified_info.header_hash: continue
+                    if is_still_verified(tag_data['height'], tag_data['tx_hash']): continue
                     
                     self.db.remove_verified_qualifier_tag(asset, h160)
                     txs.add(tag_data['tx_hash'])
-            for h160, assets in self.db.get_verified_h160_tags_after_height(above_height).items():
-                for asset in assets:
+            for h160, h160_assets in self.db.get_verified_h160_tags_after_height(above_height).items():
+                for asset in h160_assets:
                     tag_data = self.db.get_verified_h160_tag(h160, asset)
-                    verified_info = self.db.get_verified_tx(tag_data['tx_hash'])
-                    header = blockchain.read_header(tag_data['height'])
-                    if header and verified_info and hash_header(header) == verified_info.header_hash: continue
+                    if is_still_verified(tag_data['height'], tag_data['tx_hash']): continue
                     
                     self.db.remove_verified_h160_tag(h160, asset)
                     txs.add(tag_data['tx_hash'])
             for asset, tx_hashes in self.db.get_verified_broadcasts_after_height(above_height).items():
                 for tx_hash in tx_hashes:
                     broadcast = self.db.get_verified_broadcast(asset, tx_hash)
-                    verified_info = self.db.get_verified_tx(tx_hash)
-                    header = blockchain.read_header(broadcast['height'])
-                    if header and verified_info and hash_header(header) == verified_info.header_hash: continue
+                    if is_still_verified(broadcast['height'], tx_hash): continue
 
                     self.db.remove_verified_broadcast(asset, tx_hash)
                     txs.add(tx_hash)
-            for tx_hash in self.db.list_verified_tx():
-                info = self.db.get_verified_tx(tx_hash)
-                tx_height = info.height
-                if tx_height > above_height:
-                    header = blockchain.read_header(tx_height)
-                    if not header or hash_header(header) != info.header_hash:
-                        self.db.remove_verified_tx(tx_hash)
-                        # NOTE: we should add these txns to self.unverified_tx,
-                        # but with what height?
-                        # If on the new fork after the reorg, the txn is at the
-                        # same height, we will not get a status update for the
-                        # address. If the txn is not mined or at a diff height,
-                        # we should get a status update. Unless we put tx into
-                        # unverified_tx, it will turn into local. So we put it
-                        # into unverified_tx with the old height, and if we get
-                        # a status update, that will overwrite it.
-                        self.unverified_tx[tx_hash] = tx_height
-                        txs.add(tx_hash)
+            for tx_hash in self.db.get_verified_tx_after_height(above_height):
+                tx_height = self.db.get_verified_tx(tx_hash).height
+                if not is_still_verified(tx_height, tx_hash):
+                    self.db.remove_verified_tx(tx_hash)
+                    # NOTE: we should add these txns to self.unverified_tx,
+                    # but with what height?
+                    # If on the new fork after the reorg, the txn is at the
+                    # same height, we will not get a status update for the
+                    # address. If the txn is not mined or at a diff height,
+                    # we should get a status update. Unless we put tx into
+                    # unverified_tx, it will turn into local. So we put it
+                    # into unverified_tx with the old height, and if we get
+                    # a status update, that will overwrite it.
+                    self.unverified_tx[tx_hash] = tx_height
+                    txs.add(tx_hash)
 
         for tx_hash in txs:
+            self._update_balances_of_tx(tx_hash)
             util.trigger_callback('adb_removed_verified_tx', self, tx_hash)
         for asset in assets:
+            self._note_changes(assets=(asset,))
             util.trigger_callback('adb_removed_verified_asset', self, asset)
         return txs
 
@@ -1331,6 +1667,7 @@ class AddressSynchronizer(Logger, EventListener):
         with self.lock:
             old_height = self.future_tx.get(txid) or None
             self.future_tx[txid] = wanted_height
+            self._mark_tx_dirty(txid)
         if old_height != wanted_height:
             util.trigger_callback('adb_set_future_tx', self, txid)
 
@@ -1492,22 +1829,21 @@ class AddressSynchronizer(Logger, EventListener):
         return out
 
     def get_addr_utxo(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        out = self.get_addr_outputs(address)
-        for k, v in list(out.items()):
-            if v.spent_height is not None:
-                out.pop(k)
-        return out
+        with self.lock, self.transaction_lock:
+            return {prevout: self._get_utxo_from_index(prevout)
+                    for prevout in self._utxos_by_address.get(address, ())}
 
     @with_lock
     @with_transaction_lock
     @with_local_height_cached
     def get_assets_in_mempool(self, domain) -> Set[str]:
-        cache_key = sha256(','.join(sorted(domain)) + ';')
-        cached_value = self._get_assets_in_mempool_cache.get(cache_key)
-        if cached_value:
-            return cached_value
-        self.get_balance(domain, asset_aware=True)
-        return set(self._get_assets_in_mempool_cache.get(cache_key) or [])
+        self._update_coinbase_maturity()
+        domain = set(domain)
+        if domain.issuperset(self._addr_balances):
+            return {asset for asset, row in self._balance_totals.items() if row[3]}
+        return {asset
+                for addr in domain
+                for asset, row in self._addr_balances.get(addr, {}).items() if row[3]}
 
     @with_lock
     @with_transaction_lock
@@ -1516,6 +1852,13 @@ class AddressSynchronizer(Logger, EventListener):
                     excluded_coins: Set[str] = None, asset_aware=False) -> Union[Tuple[int, int, int], Mapping[Optional[str], Tuple[int, int, int]]]:
         """Return the balance of a set of addresses:
         confirmed and matured, unconfirmed, unmatured
+
+        Reads the per-address counters, which are updated as transactions
+        are added/removed or change height, so the cost does not depend on
+        the number of coins. The counters count an unconfirmed coin as
+        confirmed up to the confirmed coins of the wallet its tx spends;
+        for a smaller domain, only spent coins in the domain count, so those
+        coins are recomputed.
         """
         if excluded_addresses is None:
             excluded_addresses = set()
@@ -1525,99 +1868,60 @@ class AddressSynchronizer(Logger, EventListener):
             excluded_coins = set()
         assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
 
-        cache_key = sha256(','.join(sorted(domain)) + ';'
-                           + ','.join(sorted(excluded_coins)))
-        
-        if asset_aware:
-            cached_value = self._get_asset_balance_cache.get(cache_key)
+        self._update_coinbase_maturity()
+        totals = defaultdict(lambda: [0, 0, 0, 0])  # asset -> [c, u, x, n_utxos]
+        if domain.issuperset(self._addr_balances):
+            rows = [self._balance_totals]
         else:
-            cached_value = self._get_balance_cache.get(cache_key)
-        
-        if cached_value:
-            return cached_value
-
-        coins = {}  # type: Dict[TxOutpoint, PartialTxInput]
-        for address in domain:
-            coins.update(self.get_addr_outputs(address))
-
-        if asset_aware:
-            c = defaultdict(int)
-            u = defaultdict(int)
-            x = defaultdict(int)
-            assets_in_mempool = set()
-        else:
-            c = u = x = 0
-        
-        mempool_height = self.get_local_height() + 1  # height of next block
-        for utxo in coins.values():
-            if utxo.spent_height is not None:
-                continue
-            if utxo.prevout.to_str() in excluded_coins:
+            rows = [self._addr_balances[addr] for addr in domain if addr in self._addr_balances]
+        for balances in rows:
+            for asset, row in balances.items():
+                total = totals[asset]
+                for i in range(3):
+                    total[i] += row[i]
+                total[3] += row[4]
+        balance_in_domain = {}  # type: Dict[TxOutpoint, Tuple[int, int, int, bool]]
+        if not domain.issuperset(self._history_local):
+            for prevout in self._mempool_utxos:
+                address, asset, value, is_cb = self._utxos[prevout]
+                if address not in domain:
+                    continue
+                spent_amount = self._get_confirmed_spent_amounts(prevout.txid.hex(), domain=domain).get(asset, 0)
+                c = min(value, spent_amount)
+                balance = balance_in_domain[prevout] = (c, value - c, 0, True)
+                total = totals[asset]
+                for i in range(3):
+                    total[i] += balance[i] - self._utxo_balances[prevout][i]
+        for coin in excluded_coins:
+            prevout = TxOutpoint.from_str(coin)
+            utxo = self._utxos.get(prevout)
+            if utxo is None or utxo[0] not in domain:
                 continue
-
-            v = utxo.value_sats(asset_aware=asset_aware)
-            tx_height = utxo.block_height
-            is_cb = utxo.is_coinbase_output()
-            if is_cb and tx_height + COINBASE_MATURITY > mempool_height:
-                if asset_aware:
-                    x[utxo.asset] += v
-                else:
-                    x += v
-            elif tx_height > 0:
-                if asset_aware:
-                    c[utxo.asset] += v
-                else:
-                    c += v
-            else:
-                txid = utxo.prevout.txid.hex()
-                tx = self.db.get_transaction(txid)
-                assert tx is not None # txid comes from get_addr_io
-                # we look at the outputs that are spent by this transaction
-                # if those outputs are ours and confirmed, we count this coin as confirmed
-
-                if asset_aware:
-                    confirmed_spent_amount = defaultdict(int)
-                else:
-                    confirmed_spent_amount = 0
-                
-                for txin in tx.inputs():
-                    if txin.prevout in coins:
-                        coin = coins[txin.prevout]
-                        if coin.block_height > 0:
-                            if asset_aware:
-                                confirmed_spent_amount[coin.asset] += coin.value_sats(asset_aware=asset_aware)
-                            else:
-                                confirmed_spent_amount += coin.value_sats(asset_aware=asset_aware)
-                # Compare amount, in case tx has confirmed and unconfirmed inputs, or is a coinjoin.
-                # (fixme: tx may have multiple change outputs)
-
-                if asset_aware:
-                    assets_in_mempool.add(utxo.asset)
-                    if confirmed_spent_amount[utxo.asset] >= v:
-                        c[utxo.asset] += v
-                    else:
-                        c[utxo.asset] += confirmed_spent_amount[utxo.asset]
-                        u[utxo.asset] += v - confirmed_spent_amount[utxo.asset]
-                else:
-                    if confirmed_spent_amount >= v:
-                        c += v
-                    else:
-                        c += confirmed_spent_amount
-                        u += v - confirmed_spent_amount
+            total = totals[utxo[1]]
+            balance = balance_in_domain.get(prevout) or self._utxo_balances[prevout]
+            for i in range(3):
+                total[i] -= balance[i]
+            total[3] -= 1
 
         if asset_aware:
             result = defaultdict(lambda: (0, 0, 0))
-            for asset in set(c.keys()).union(u.keys()).union(x.keys()):
-                result[asset] = c[asset], u[asset], x[asset]
-            self._get_asset_balance_cache[cache_key] = result
-            self._get_assets_in_mempool_cache[cache_key] = assets_in_mempool
-        else:
-            result = c, u, x
-            # cache result.
-            # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...)
-            self._get_balance_cache[cache_key] = result
-        return result
+            for asset, total in totals.items():
+                if total[3]:
+                    result[asset] = tuple(total[:3])
+            return result
+        return tuple(totals[None][:3]) if None in totals else (0, 0, 0)
+
+    def _get_confirmed_spent_amounts(self, txid: str, *, domain: Set[str] = None) -> Mapping[Optional[str], int]:
+        """Returns the value of the confirmed coins of ours (in domain, if given)
+        spent by txid, per asset."""
+        amounts = defaultdict(int)
+        for addr in self.db.get_txi_addresses(txid):
+            if domain is not None and addr not in domain:
+                continue
+            for prevout_str, v, asset in self.db.get_txi_addr(txid, addr):
+                if self.get_tx_height(prevout_str.split(':')[0]).height > 0:
+                    amounts[asset] += v
+        return amounts
 
     @with_local_height_cached
     def get_utxos(
@@ -1630,6 +1934,7 @@ class AddressSynchronizer(Logger, EventListener):
             confirmed_spending_only: bool = False,
             nonlocal_only: bool = False,
             block_height: int = None,
+            assets: Iterable[Optional[str]] = None,
     ) -> Sequence[PartialTxInput]:
         if block_height is not None:
             # caller wants the UTXOs we had at a given height; check other parameters
@@ -1642,25 +1947,33 @@ class AddressSynchronizer(Logger, EventListener):
         domain = set(domain)
         if excluded_addresses:
             domain = set(domain) - set(excluded_addresses)
+        if assets is not None:
+            assets = set(assets)
         mempool_height = block_height + 1  # height of next block
-        for addr in domain:
-            txos = self.get_addr_outputs(addr)
-            for txo in txos.values():
-                if txo.value_sats(asset_aware=True) == 0: continue
-                if txo.spent_height is not None:
-                    if not confirmed_spending_only:
-                        continue
-                    if confirmed_spending_only and 0 < txo.spent_height <= block_height:
-                        continue
-                if confirmed_funding_only and not (0 < txo.block_height <= block_height):
-                    continue
-                if nonlocal_only and txo.block_height in (TX_HEIGHT_LOCAL, TX_HEIGHT_FUTURE):
+        with self.lock, self.transaction_lock:
+            if confirmed_spending_only:
+                # coins spent by unconfirmed txs count as unspent;
+                # the index does not have those, so look at the full history
+                txos = [txo for addr in domain for txo in self.get_addr_outputs(addr).values()
+                        if assets is None or txo.asset in assets]
+            else:
+                txos = [self._get_utxo_from_index(prevout)
+                        for prevout in self._get_unspent_outpoints(domain, assets=assets)]
+        for txo in txos:
+            if txo.value_sats(asset_aware=True) == 0: continue
+            if txo.spent_height is not None:
+                if not confirmed_spending_only:
                     continue
-                if (mature_only and txo.is_coinbase_output()
-                        and txo.block_height + COINBASE_MATURITY > mempool_height):
+                if confirmed_spending_only and 0 < txo.spent_height <= block_height:
                     continue
-                coins.append(txo)
+            if confirmed_funding_only and not (0 < txo.block_height <= block_height):
+                continue
+            if nonlocal_only and txo.block_height in (TX_HEIGHT_LOCAL, TX_HEIGHT_FUTURE):
+                continue
+            if (mature_only and txo.is_coinbase_output()
+                    and txo.block_height + COINBASE_MATURITY > mempool_height):
                 continue
+            coins.append(txo)
         return coins
 
     def is_used(self, address: str) -> bool:
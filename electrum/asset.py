@@ -1,17 +1,18 @@
 import attr
+import functools
 import itertools
 import re
 import hashlib
 
 from enum import Enum, auto
-from typing import Optional, Sequence, Mapping, Union, TYPE_CHECKING
+from typing import Optional, Sequence, Mapping, Union, List, TYPE_CHECKING
 
 from . import constants
 from .bitcoin import address_to_script, construct_script, int_to_hex, opcodes, COIN, base_decode, base_encode, _op_push, TOTAL_COIN_SUPPLY_LIMIT_IN_BTC
 from .boolean_ast_tree import parse_boolean_equation, AbstractBooleanASTNode
 from .i18n import _
 
-from .transaction import PartialTxOutput, MalformedBitcoinScript, script_GetOp
+from .transaction import TxOutput, PartialTxOutput, MalformedBitcoinScript, script_GetOp
 from .json_db import StoredObject, stored_as
 
 from .util import ByteReader
@@ -28,6 +29,9 @@ DEFAULT_ASSET_AMOUNT_MAX = TOTAL_COIN_SUPPLY_LIMIT_IN_BTC
 UNIQUE_ASSET_AMOUNT_MAX = 1
 QUALIFIER_ASSET_AMOUNT_MAX = 10
 
+# number of scripts whose asset vout information is memoized, see get_asset_info_from_script
+ASSET_INFO_CACHE_SIZE = 10_000
+
 RVN_ASSET_TYPE_CREATE = b'q'
 RVN_ASSET_TYPE_CREATE_INT = RVN_ASSET_TYPE_CREATE[0]
 RVN_ASSET_TYPE_OWNER = b'o'
@@ -362,12 +366,17 @@ class AssetVoutType(Enum):
     FREEZE = 8
 
 class BaseAssetVoutInformation():
-    asset = None
-    amount: Optional[int] = None
+    # instances are memoized by get_asset_info_from_script and shared: they must not be modified
+    __slots__ = ('_type', 'well_formed_script', 'asset', 'amount')
+
+    asset: Optional[str]
+    amount: Optional[int]
 
     def __init__(self, type_: AssetVoutType, well_formed):
         self._type = type_
         self.well_formed_script = well_formed
+        self.asset = None
+        self.amount = None
 
     def get_type(self):
         return self._type
@@ -382,10 +391,14 @@ class BaseAssetVoutInformation():
         return False
 
 class NoAssetVoutInformation(BaseAssetVoutInformation):
+    __slots__ = ()
+
     def __init__(self):
         BaseAssetVoutInformation.__init__(self, AssetVoutType.NONE, True)
 
 class MetadataAssetVoutInformation(BaseAssetVoutInformation):
+    __slots__ = ('divisions', 'reissuable', 'associated_data')
+
     def __init__(self, type_: AssetVoutType, well_formed, asset: str, amount: int, divisions: int, reissuable: bool, associated_data: Optional[bytes]):
         BaseAssetVoutInformation.__init__(self, type_, well_formed)
         self.asset = asset
@@ -395,12 +408,16 @@ class MetadataAssetVoutInformation(BaseAssetVoutInformation):
         self.associated_data = associated_data
 
 class OwnerAssetVoutInformation(BaseAssetVoutInformation):
+    __slots__ = ()
+
     def __init__(self, well_formed, asset: str):
         BaseAssetVoutInformation.__init__(self, AssetVoutType.OWNER, well_formed)
         self.asset = asset
         self.amount = COIN
 
 class TransferAssetVoutInformation(BaseAssetVoutInformation):
+    __slots__ = ('asset_memo', 'asset_memo_timestamp')
+
     def __init__(self, well_formed, asset: str, amount: int, asset_memo: Optional[bytes], asset_memo_timestamp: Optional[int]):
         BaseAssetVoutInformation.__init__(self, AssetVoutType.TRANSFER, well_formed)
         self.asset = asset
@@ -412,6 +429,8 @@ class TransferAssetVoutInformation(BaseAssetVoutInformation):
         return self.asset_memo is None and self.asset_memo_timestamp is None and super().is_deterministic()
 
 class TagAssetVoutInformation(BaseAssetVoutInformation):
+    __slots__ = ()
+
     def is_deterministic(self):
         return True
     
@@ -419,6 +438,8 @@ class TagAssetVoutInformation(BaseAssetVoutInformation):
         return True
     
 class NullTagAssetVoutInformation(TagAssetVoutInformation):
+    __slots__ = ('h160', 'flag')
+
     def __init__(self, asset: str, h160: str, flag: bool):
         BaseAssetVoutInformation.__init__(self, AssetVoutType.NULL, True)
         self.asset = asset
@@ -426,17 +447,126 @@ class NullTagAssetVoutInformation(TagAssetVoutInformation):
         self.flag = flag
 
 class VerifierTagAssetVoutInformation(TagAssetVoutInformation):
+    __slots__ = ('verifier_string',)
+
     def __init__(self, verifier_string: str):
         BaseAssetVoutInformation.__init__(self, AssetVoutType.VERIFIER, True)
         self.verifier_string = verifier_string
 
 class FreezeTagAssetVoutInformation(TagAssetVoutInformation):
+    __slots__ = ('flag',)
+
     def __init__(self, asset: str, flag: bool):
         BaseAssetVoutInformation.__init__(self, AssetVoutType.FREEZE, True)
         self.asset = asset
         self.flag = flag
 
-def get_asset_info_from_script(script: bytes) -> BaseAssetVoutInformation:
+def get_asset_info_from_script(script: bytes) -> Optional[BaseAssetVoutInformation]:
+    """Returns the asset vout information of an output script, or None if it is malformed.
+    Results are memoized by script, and shared between callers: do not modify them.
+    """
+    if not isinstance(script, bytes):
+        script = bytes(script)
+    return _get_asset_info_from_script(script)
+
+def get_asset_info_from_outputs(outputs: Sequence[TxOutput]) -> List[Optional[BaseAssetVoutInformation]]:
+    """Returns the asset vout information of each output, e.g. of all outputs of a transaction."""
+    get_info = _get_asset_info_from_script
+    return [get_info(o.scriptpubkey if isinstance(o.scriptpubkey, bytes) else bytes(o.scriptpubkey))
+            for o in outputs]
+
+@functools.lru_cache(maxsize=ASSET_INFO_CACHE_SIZE)
+def _get_asset_info_from_script(script: bytes) -> Optional[BaseAssetVoutInformation]:
+    asset_info = _classify_standard_script(script)
+    if asset_info is not None:
+        return asset_info
+    return _decode_asset_info_from_script(script)
+
+def _classify_standard_script(script: bytes) -> Optional[BaseAssetVoutInformation]:
+    """Fast path for P2PKH and P2SH scripts, optionally followed by a well formed
+    asset portion (OP_ASSET <push> OP_DROP), recognized at fixed offsets.
+    Returns None for any other script, which then has to be fully decoded.
+    """
+    size = len(script)
+    if (size >= 25 and script[0] == opcodes.OP_DUP and script[1] == opcodes.OP_HASH160 and script[2] == 20
+            and script[23] == opcodes.OP_EQUALVERIFY and script[24] == opcodes.OP_CHECKSIG):
+        base_size = 25
+    elif size >= 23 and script[0] == opcodes.OP_HASH160 and script[1] == 20 and script[22] == opcodes.OP_EQUAL:
+        base_size = 23
+    else:
+        return None
+    if size == base_size:
+        return NoAssetVoutInformation()
+    if size < base_size + 3 or script[base_size] != opcodes.OP_ASSET:
+        return None
+    push_opcode = script[base_size + 1]
+    if 0 < push_opcode < opcodes.OP_PUSHDATA1:
+        data_start, data_size = base_size + 2, push_opcode
+    elif push_opcode == opcodes.OP_PUSHDATA1 and script[base_size + 2] >= opcodes.OP_PUSHDATA1:
+        data_start, data_size = base_size + 3, script[base_size + 2]
+    else:
+        # not a minimal push, as constructed by _op_push
+        return None
+    if size != data_start + data_size + 1 or script[-1] != opcodes.OP_DROP:
+        return None
+    try:
+        return _parse_asset_portion(script[base_size + 1:], True)
+    except IndexError:
+        return NoAssetVoutInformation()
+
+def _parse_asset_portion(asset_portion: bytes, well_formed: bool) -> BaseAssetVoutInformation:
+    """Parses what follows OP_ASSET in an output script that is not a tag."""
+    asset_prefix_position = asset_portion.find(constants.net.ASSET_PREFIX)
+    if asset_prefix_position < 0: return NoAssetVoutInformation()
+    if len(asset_portion) < len(constants.net.ASSET_PREFIX) + 3: return NoAssetVoutInformation()
+    reader = ByteReader(asset_portion[asset_prefix_position + len(constants.net.ASSET_PREFIX):])
+    vout_type = reader.read_bytes(1)
+    if vout_type == RVN_ASSET_TYPE_CREATE:
+        asset_vout_type = AssetVoutType.CREATE
+    elif vout_type == RVN_ASSET_TYPE_OWNER:
+        asset_vout_type = AssetVoutType.OWNER
+    elif vout_type == RVN_ASSET_TYPE_TRANSFER:
+        asset_vout_type = AssetVoutType.TRANSFER
+    elif vout_type == RVN_ASSET_TYPE_REISSUE:
+        asset_vout_type = AssetVoutType.REISSUE
+    else: return NoAssetVoutInformation()
+
+    asset_length = reader.read_byte_as_int()
+    asset = reader.read_bytes(asset_length).decode()
+    if asset_vout_type == AssetVoutType.OWNER:
+        return OwnerAssetVoutInformation(well_formed, asset)
+
+    asset_amount_bytes = reader.read_bytes(8)
+    asset_amount = int.from_bytes(asset_amount_bytes, 'little')
+
+    if asset_vout_type == AssetVoutType.TRANSFER:
+        memo = None
+        timestamp = None
+        if reader.can_read_amount(34):
+            memo = reader.read_bytes(34)
+            if reader.can_read_amount(8):
+                timestamp_bytes = reader.read_bytes(8)
+                timestamp = int.from_bytes(timestamp_bytes, 'little')
+        return TransferAssetVoutInformation(well_formed, asset, asset_amount, memo, timestamp)
+    
+    divisions = reader.read_byte_as_int()
+    reissuable = reader.read_byte_as_int() == 1
+
+    if asset_vout_type == AssetVoutType.CREATE:
+        has_associated_data = reader.read_byte_as_int() == 1
+        if has_associated_data:
+            associated_data = reader.read_bytes(34)
+            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, associated_data)
+        else:
+            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, None)
+    else:
+        if reader.can_read_amount(34):
+            associated_data = reader.read_bytes(34)
+            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, associated_data)
+        else:
+            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, None)
+
+def _decode_asset_info_from_script(script: bytes) -> Optional[BaseAssetVoutInformation]:
     try:
         decoded = [x for x in script_GetOp(script)]
     except MalformedBitcoinScript:
@@ -480,56 +610,7 @@ def get_asset_info_from_script(script: bytes) -> BaseAssetVoutInformation:
                             remaining_matches = (op_push_prefix + decoded[i+1][1] + b'\x75') == asset_portion
                     well_formed = decoded_has_good_length and next_op_is_a_push and remaining_matches
                     
-                    asset_prefix_position = asset_portion.find(constants.net.ASSET_PREFIX)
-                    if asset_prefix_position < 0: break
-                    if len(asset_portion) < len(constants.net.ASSET_PREFIX) + 3: break
-                    reader = ByteReader(asset_portion[asset_prefix_position + len(constants.net.ASSET_PREFIX):])
-                    vout_type = reader.read_bytes(1)
-                    if vout_type == RVN_ASSET_TYPE_CREATE:
-                        asset_vout_type = AssetVoutType.CREATE
-                    elif vout_type == RVN_ASSET_TYPE_OWNER:
-                        asset_vout_type = AssetVoutType.OWNER
-                    elif vout_type == RVN_ASSET_TYPE_TRANSFER:
-                        asset_vout_type = AssetVoutType.TRANSFER
-                    elif vout_type == RVN_ASSET_TYPE_REISSUE:
-                        asset_vout_type = AssetVoutType.REISSUE
-                    else: break
-
-                    asset_length = reader.read_byte_as_int()
-                    asset = reader.read_bytes(asset_length).decode()
-                    if asset_vout_type == AssetVoutType.OWNER:
-                        return OwnerAssetVoutInformation(well_formed, asset)
-
-                    asset_amount_bytes = reader.read_bytes(8)
-                    asset_amount = int.from_bytes(asset_amount_bytes, 'little')
-
-                    if asset_vout_type == AssetVoutType.TRANSFER:
-                        memo = None
-                        timestamp = None
-                        if reader.can_read_amount(34):
-                            memo = reader.read_bytes(34)
-                            if reader.can_read_amount(8):
-                                timestamp_bytes = reader.read_bytes(8)
-                                timestamp = int.from_bytes(timestamp_bytes, 'little')
-                        return TransferAssetVoutInformation(well_formed, asset, asset_amount, memo, timestamp)
-                    
-                    divisions = reader.read_byte_as_int()
-                    reissuable = reader.read_byte_as_int() == 1
-
-                    if asset_vout_type == AssetVoutType.CREATE:
-                        has_associated_data = reader.read_byte_as_int() == 1
-                        if has_associated_data:
-                            associated_data = reader.read_bytes(34)
-                            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, associated_data)
-                        else:
-                            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, None)
-                    elif asset_vout_type == AssetVoutType.REISSUE:
-                        if reader.can_read_amount(34):
-                            associated_data = reader.read_bytes(34)
-                            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, associated_data)
-                        else:
-                            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, None)
-                    break
+                    return _parse_asset_portion(asset_portion, well_formed)
     except IndexError:
         pass
     return NoAssetVoutInformation()
@@ -21,10 +21,18 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import asyncio
+import hashlib
+import mmap
 import threading
 import time
 import struct
-from typing import Optional, Dict, Mapping, Sequence, TYPE_CHECKING
+import zlib
+import concurrent.futures
+import itertools
+import multiprocessing
+from collections import deque
+from typing import Optional, Dict, Mapping, Sequence, List, Tuple, TYPE_CHECKING
 
 from . import util
 from .bitcoin import hash_encode, int_to_hex, rev_hex
@@ -50,6 +58,11 @@ LEGACY_HEADER_SIZE = 80
 
 DGW_PASTBLOCKS = 180
 
+# header writes that are not yet fsynced are kept within this many bytes (64 chunks),
+# so that only this much has to be checked when recovering from a crash
+MAX_UNSYNCED_BYTES = 64 * 2016 * HEADER_SIZE
+CHAINWORK_RECORD_SIZE = 36  # cumulative work (32) | crc32 of header (4)
+
 class MissingHeader(Exception):
     pass
 
@@ -151,6 +164,436 @@ def hash_raw_header_kawpow(header: str) -> str:
     return final_hash
 
 
+def split_chunk_into_raw_headers(start_height: int, data: bytes) -> List[bytes]:
+    """Splits a chunk as served by 'blockchain.block.headers' into raw headers.
+    Headers before kawpow activation are served without the kawpow fields.
+    """
+    raw_headers = []
+    p = 0
+    s = start_height
+    while p < len(data):
+        if s < constants.net.KawpowActivationHeight:
+            raw = data[p:p + LEGACY_HEADER_SIZE]
+            p += LEGACY_HEADER_SIZE
+        else:
+            raw = data[p:p + HEADER_SIZE]
+            p += HEADER_SIZE
+        if len(raw) not in (LEGACY_HEADER_SIZE, HEADER_SIZE):
+            raise Exception('Invalid header length: {}'.format(len(raw)))
+        raw_headers.append(raw)
+        s += 1
+    return raw_headers
+
+
+def _hash_raw_headers(raw_headers: Sequence[bytes], x16rv2_activation_ts: int,
+                      kawpow_activation_ts: int) -> List[str]:
+    """Same as hash_header, for a batch of raw headers.
+    This runs in the worker processes of the PoW pool, so the activation
+    timestamps are passed in instead of being read from constants.net.
+    """
+    hashes = []
+    for raw in raw_headers:
+        timestamp = int.from_bytes(raw[68:72], byteorder='little')
+        if timestamp >= kawpow_activation_ts:
+            raw_hash = kawpow_hash(raw)
+        elif timestamp >= x16rv2_activation_ts:
+            raw_hash = x16rv2_hash.getPoWHash(raw[:LEGACY_HEADER_SIZE])
+        else:
+            raw_hash = x16r_hash.getPoWHash(raw[:LEGACY_HEADER_SIZE])
+        hashes.append(hash_encode(raw_hash))
+    return hashes
+
+
+def hash_raw_headers(raw_headers: Sequence[bytes]) -> List[str]:
+    return _hash_raw_headers(raw_headers,
+                             constants.net.X16Rv2ActivationTS,
+                             constants.net.KawpowActivationTS)
+
+
+# Pool of worker processes used to compute the PoW hashes of header chunks.
+# Below this many headers, hashing inline is cheaper than the IPC overhead.
+POW_POOL_MIN_HEADERS = 64
+_pow_executor = None  # type: Optional[concurrent.futures.ProcessPoolExecutor]
+_pow_executor_lock = threading.Lock()
+
+
+def _get_pow_executor(num_workers: int) -> Optional[concurrent.futures.ProcessPoolExecutor]:
+    global _pow_executor
+    with _pow_executor_lock:
+        if _pow_executor is None:
+            try:
+                # note: 'spawn', as forking a process that runs the asyncio loop and other threads is unsafe
+                _pow_executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=num_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            except Exception as e:
+                # e.g. no working sem_open on this platform
+                _logger.warning(f'cannot create process pool for header verification: {repr(e)}')
+                return None
+        return _pow_executor
+
+
+def shutdown_pow_executor() -> None:
+    global _pow_executor
+    with _pow_executor_lock:
+        if _pow_executor is not None:
+            _pow_executor.shutdown(wait=False)
+            _pow_executor = None
+
+
+def _split_for_pow_pool(raw_headers: Sequence[bytes], *, config: 'SimpleConfig' = None
+                        ) -> Tuple[Optional[concurrent.futures.ProcessPoolExecutor], List[Sequence[bytes]]]:
+    """Returns the pool to hash raw_headers with (None if they should be hashed inline),
+    and the batches to hand to its workers.
+    """
+    num_workers = config.NETWORK_HEADER_VERIFY_WORKERS if config else None
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    executor = None
+    if num_workers > 1 and len(raw_headers) >= POW_POOL_MIN_HEADERS:
+        executor = _get_pow_executor(num_workers)
+    if executor is None:
+        return None, [raw_headers]
+    batch_size = -(-len(raw_headers) // num_workers)
+    return executor, [raw_headers[i:i + batch_size] for i in range(0, len(raw_headers), batch_size)]
+
+
+async def hash_raw_headers_in_pool(raw_headers: Sequence[bytes], *,
+                                   config: 'SimpleConfig' = None) -> List[str]:
+    """Returns hash_raw_headers(raw_headers), with the work spread over
+    one worker process per CPU core (or config.NETWORK_HEADER_VERIFY_WORKERS).
+    Falls back to hashing in the calling thread if no pool is available.
+    """
+    executor, batches = _split_for_pow_pool(raw_headers, config=config)
+    if executor is None:
+        return hash_raw_headers(raw_headers)
+    loop = asyncio.get_running_loop()
+    try:
+        results = await asyncio.gather(*[
+            loop.run_in_executor(executor, _hash_raw_headers, batch,
+                                 constants.net.X16Rv2ActivationTS,
+                                 constants.net.KawpowActivationTS)
+            for batch in batches])
+    except concurrent.futures.process.BrokenProcessPool as e:
+        _logger.warning(f'process pool for header verification broke: {repr(e)}. hashing inline.')
+        shutdown_pow_executor()
+        return hash_raw_headers(raw_headers)
+    return [h for batch_hashes in results for h in batch_hashes]
+
+
+def hash_raw_headers_blocking(raw_headers: Sequence[bytes], *,
+                              config: 'SimpleConfig' = None) -> List[str]:
+    """Same as hash_raw_headers_in_pool, for callers outside the event loop."""
+    executor, batches = _split_for_pow_pool(raw_headers, config=config)
+    if executor is None:
+        return hash_raw_headers(raw_headers)
+    try:
+        results = list(executor.map(_hash_raw_headers, batches,
+                                    itertools.repeat(constants.net.X16Rv2ActivationTS),
+                                    itertools.repeat(constants.net.KawpowActivationTS)))
+    except concurrent.futures.process.BrokenProcessPool as e:
+        _logger.warning(f'process pool for header verification broke: {repr(e)}. hashing inline.')
+        shutdown_pow_executor()
+        return hash_raw_headers(raw_headers)
+    return [h for batch_hashes in results for h in batch_hashes]
+
+
+class HeaderStore:
+    """Memory-mapped view of a headers file, plus an index file next to it
+    (path + '.idx') with the hash and bits of every header, so that stored
+    headers never have to be re-hashed.
+
+    Index records are (hash, bits, crc32 of raw header + hash + bits). A record
+    is only used if its crc matches the raw header it describes and the record
+    itself; otherwise (e.g. the headers file was written to, the record was
+    damaged, or after a crash) it is recomputed and stored again.
+    Hence the index needs no fsync and cannot get out of sync with the headers.
+    """
+
+    INDEX_RECORD_SIZE = 40
+
+    def __init__(self, path: str, num_headers: int):
+        self.path = path
+        self.num_headers = num_headers
+        self._headers_mmap = None  # type: Optional[mmap.mmap]
+        self._index_mmap = None  # type: Optional[mmap.mmap]
+        if num_headers == 0:
+            return
+        with open(path, 'rb') as f:
+            self._headers_mmap = mmap.mmap(f.fileno(), length=num_headers * HEADER_SIZE, access=mmap.ACCESS_READ)
+        try:
+            self._index_mmap = self._open_index()
+        except OSError as e:
+            # the index is only a cache, we can work without it
+            _logger.info(f'cannot open header index for {path}: {repr(e)}')
+
+    @classmethod
+    def index_path(cls, path: str) -> str:
+        return path + '.idx'
+
+    def _open_index(self) -> mmap.mmap:
+        index_path = self.index_path(self.path)
+        length = self.num_headers * self.INDEX_RECORD_SIZE
+        is_new = not os.path.exists(index_path)
+        with open(index_path, 'w+b' if is_new else 'r+b') as f:
+            if is_new or os.fstat(f.fileno()).st_size != length:
+                f.truncate(length)  # new records are zeros, i.e. invalid
+            if is_new:
+                util.ensure_sparse_file(index_path)
+            return mmap.mmap(f.fileno(), length=length, access=mmap.ACCESS_WRITE)
+
+    def close(self) -> None:
+        if self._headers_mmap is not None:
+            self._headers_mmap.close()
+            self._headers_mmap = None
+        if self._index_mmap is not None:
+            self._index_mmap.close()
+            self._index_mmap = None
+
+    def read_raw_header(self, delta: int) -> bytes:
+        assert 0 <= delta < self.num_headers, (delta, self.num_headers)
+        return self._headers_mmap[delta * HEADER_SIZE:(delta + 1) * HEADER_SIZE]
+
+    def get_hash_and_bits(self, delta: int) -> Optional[Tuple[str, int]]:
+        """Returns (hash, bits) of the header at position delta,
+        or None if there is no header there (zeroes in a sparse file).
+        """
+        raw = self.read_raw_header(delta)
+        offset = delta * self.INDEX_RECORD_SIZE
+        if self._index_mmap is not None:
+            record = self._index_mmap[offset:offset + self.INDEX_RECORD_SIZE]
+            header_hash, bits = record[:32], record[32:36]
+            if record == self._make_index_record(raw, header_hash) and any(header_hash):
+                return header_hash.hex(), int.from_bytes(bits, 'little')
+        if raw == bytes(HEADER_SIZE):
+            return None
+        header_hash = hash_raw_headers([raw])[0]
+        bits = int.from_bytes(raw[72:76], byteorder='little')
+        if self._index_mmap is not None:
+            self._index_mmap[offset:offset + self.INDEX_RECORD_SIZE] = self._make_index_record(raw, bytes.fromhex(header_hash))
+        return header_hash, bits
+
+    @classmethod
+    def _make_index_record(cls, raw: bytes, header_hash: bytes) -> bytes:
+        bits = raw[72:76]
+        return header_hash + bits + zlib.crc32(raw + header_hash + bits).to_bytes(4, 'little')
+
+    def put_hashes(self, start_delta: int, header_hashes: Sequence[bytes]) -> None:
+        """Fills in the index records of stored headers whose hashes are already known."""
+        if self._index_mmap is None:
+            return
+        for i, header_hash in enumerate(header_hashes):
+            delta = start_delta + i
+            raw = self.read_raw_header(delta)
+            offset = delta * self.INDEX_RECORD_SIZE
+            self._index_mmap[offset:offset + self.INDEX_RECORD_SIZE] = self._make_index_record(raw, header_hash)
+
+
+# Header snapshots hold a contiguous range of best chain headers, together with
+# their hashes and cumulative chainwork, so that a new node can start from them
+# without downloading every header from the network. The file consists of:
+#   preamble: magic | genesis hash (32) | start height (u32) | number of headers (u32)
+#   records:  raw header (HEADER_SIZE) | hash (32) | work since start height, inclusive (32, big endian)
+#   trailer:  sha256d of everything before it
+# Hashes are in display byte order, as in the header index.
+HEADER_SNAPSHOT_MAGIC = b'HDRSNAP\x01'
+HEADER_SNAPSHOT_PREAMBLE = struct.Struct('<8s32sII')
+HEADER_SNAPSHOT_RECORD_SIZE = HEADER_SIZE + 32 + 32
+HEADER_SNAPSHOT_BATCH_SIZE = 2016  # records
+
+
+class InvalidHeaderSnapshot(Exception):
+    pass
+
+
+def work_from_bits(bits: int) -> int:
+    target = Blockchain.bits_to_target(bits)
+    return ((2 ** 256 - target - 1) // (target + 1)) + 1
+
+
+def export_header_snapshot(blockchain: 'Blockchain', path: str) -> dict:
+    """Writes the longest range of stored headers that ends at the tip of blockchain,
+    and starts right after a checkpoint, into a snapshot file at path.
+    """
+    assert blockchain.parent is None, 'only the best chain can be exported'
+    with blockchain.lock:
+        tip = blockchain.height()
+        store = blockchain._get_header_store()
+        first_stored = tip + 1
+        while first_stored > 0 and store.read_raw_header(first_stored - 1) != bytes(HEADER_SIZE):
+            first_stored -= 1
+        spacing = constants.net.DGW_CHECKPOINTS_SPACING
+        start_height = -(-first_stored // spacing) * spacing
+        if start_height > tip or blockchain.get_checkpointed_hash(start_height - 1) is None:
+            raise Exception(f'not enough headers stored to export a snapshot (have {first_stored}..{tip})')
+        count = tip - start_height + 1
+        digest = hashlib.sha256()
+        chainwork = 0
+        with open(path, 'wb') as f:
+            preamble = HEADER_SNAPSHOT_PREAMBLE.pack(
+                HEADER_SNAPSHOT_MAGIC, bytes.fromhex(constants.net.GENESIS), start_height, count)
+            f.write(preamble)
+            digest.update(preamble)
+            for batch_start in range(start_height, tip + 1, HEADER_SNAPSHOT_BATCH_SIZE):
+                records = []
+                for height in range(batch_start, min(tip + 1, batch_start + HEADER_SNAPSHOT_BATCH_SIZE)):
+                    header_hash, bits = store.get_hash_and_bits(height)
+                    chainwork += work_from_bits(bits)
+                    records.append(store.read_raw_header(height))
+                    records.append(bytes.fromhex(header_hash))
+                    records.append(chainwork.to_bytes(32, byteorder='big'))
+                data = b''.join(records)
+                f.write(data)
+                digest.update(data)
+            checksum = hashlib.sha256(digest.digest()).digest()
+            f.write(checksum)
+    return {
+        'path': path,
+        'start_height': start_height,
+        'height': tip,
+        'sha256d': checksum.hex(),
+    }
+
+
+def _read_header_snapshot_preamble(f) -> Tuple[bytes, int, int]:
+    preamble = f.read(HEADER_SNAPSHOT_PREAMBLE.size)
+    if len(preamble) != HEADER_SNAPSHOT_PREAMBLE.size:
+        raise InvalidHeaderSnapshot('file too short')
+    magic, genesis, start_height, count = HEADER_SNAPSHOT_PREAMBLE.unpack(preamble)
+    if magic != HEADER_SNAPSHOT_MAGIC:
+        raise InvalidHeaderSnapshot('not a header snapshot')
+    if genesis.hex() != constants.net.GENESIS:
+        raise InvalidHeaderSnapshot('header snapshot is for another network')
+    expected_size = len(preamble) + count * HEADER_SNAPSHOT_RECORD_SIZE + 32
+    if os.fstat(f.fileno()).st_size != expected_size:
+        raise InvalidHeaderSnapshot('unexpected file size')
+    return preamble, start_height, count
+
+
+def verify_header_snapshot(blockchain: 'Blockchain', path: str, *,
+                           expected_checksum: str = None) -> Tuple[int, int]:
+    """Checks that the snapshot at path is intact and consistent with our checkpoints.
+    Returns (start_height, number of headers).
+
+    The headers have to link up with each other, starting right after a checkpoint,
+    and match every checkpoint they cover. The hash of the headers after the last
+    checkpoint is recomputed, and has to match the one in the snapshot; they also
+    have to have the right target, and enough proof of work for it.
+    Up to the last checkpoint, the hashes of the snapshot are used as they are,
+    which is what makes importing it fast: only expected_checksum (if given)
+    vouches for them, and the checksum guards against corruption.
+    """
+    start_height, count, __ = _verify_header_snapshot(blockchain, path, expected_checksum=expected_checksum)
+    return start_height, count
+
+
+def _verify_header_snapshot(blockchain: 'Blockchain', path: str, *,
+                            expected_checksum: Optional[str]) -> Tuple[int, int, Sequence[bytes]]:
+    """Same as verify_header_snapshot, but also returns the sha256 of each batch of records,
+    so that they can be imported without trusting the file to stay the same.
+    """
+    max_checkpoint = constants.net.max_checkpoint()
+    with open(path, 'rb') as f:
+        preamble, start_height, count = _read_header_snapshot_preamble(f)
+        prev_hash = blockchain.get_checkpointed_hash(start_height - 1)
+        if prev_hash is None:
+            raise InvalidHeaderSnapshot(f'header snapshot does not start after a checkpoint: {start_height}')
+        digest = hashlib.sha256(preamble)
+        batch_digests = []
+        chainwork = 0
+        dgw_state = DGWState()
+        recent_headers = {}  # type: Dict[int, dict]  # to load dgw_state from
+        for batch_start in range(0, count, HEADER_SNAPSHOT_BATCH_SIZE):
+            num_records = min(HEADER_SNAPSHOT_BATCH_SIZE, count - batch_start)
+            data = f.read(num_records * HEADER_SNAPSHOT_RECORD_SIZE)
+            digest.update(data)
+            batch_digests.append(hashlib.sha256(data).digest())
+            raw_headers = [data[i:i + HEADER_SIZE] for i in range(0, len(data), HEADER_SNAPSHOT_RECORD_SIZE)]
+            # the proof of work is only recomputed after the last checkpoint
+            num_checkpointed = min(len(raw_headers), max(0, max_checkpoint + 1 - (start_height + batch_start)))
+            computed_hashes = [None] * num_checkpointed  # type: List[Optional[str]]
+            if num_checkpointed < len(raw_headers):
+                computed_hashes += hash_raw_headers_blocking(raw_headers[num_checkpointed:], config=blockchain.config)
+            for i, (raw, computed_hash) in enumerate(zip(raw_headers, computed_hashes)):
+                height = start_height + batch_start + i
+                offset = i * HEADER_SNAPSHOT_RECORD_SIZE
+                header_hash = data[offset + HEADER_SIZE:offset + HEADER_SIZE + 32].hex()
+                if computed_hash is not None and header_hash != computed_hash:
+                    raise InvalidHeaderSnapshot(f'wrong hash at height {height}')
+                if raw[4:36][::-1].hex() != prev_hash:
+                    raise InvalidHeaderSnapshot(f'headers do not link up at height {height}')
+                cp_hash = blockchain.get_checkpointed_hash(height)
+                if cp_hash is not None and cp_hash != header_hash:
+                    raise InvalidHeaderSnapshot(f'hash does not match checkpoint at height {height}')
+                if height >= constants.net.KawpowActivationHeight \
+                        and int.from_bytes(raw[76:80], byteorder='little') != height:
+                    raise InvalidHeaderSnapshot(f'wrong nheight at height {height}')
+                bits = int.from_bytes(raw[72:76], byteorder='little')
+                timestamp = int.from_bytes(raw[68:72], byteorder='little')
+                if height > max_checkpoint and not constants.net.TESTNET:
+                    try:
+                        if not dgw_state.can_compute(height):
+                            dgw_state.load(blockchain, height - 1, recent_headers)
+                        target = dgw_state.get_target(height)
+                        Blockchain.verify_header(deserialize_header(raw, height), prev_hash, target,
+                                                 header_hash=computed_hash)
+                    except (InvalidHeader, NotEnoughHeaders) as e:
+                        raise InvalidHeaderSnapshot(f'invalid header at height {height}: {repr(e)}') from e
+                dgw_state.push(height, bits, timestamp)
+                recent_headers[height] = {'bits': bits, 'timestamp': timestamp}
+                recent_headers.pop(height - DGW_PASTBLOCKS - 1, None)
+                chainwork += work_from_bits(bits)
+                if int.from_bytes(data[offset + HEADER_SIZE + 32:offset + HEADER_SNAPSHOT_RECORD_SIZE],
+                                  byteorder='big') != chainwork:
+                    raise InvalidHeaderSnapshot(f'wrong chainwork at height {height}')
+                prev_hash = header_hash
+        checksum = f.read(32)
+    if hashlib.sha256(digest.digest()).digest() != checksum:
+        raise InvalidHeaderSnapshot('checksum mismatch')
+    if expected_checksum is not None and checksum.hex() != expected_checksum.lower():
+        raise InvalidHeaderSnapshot('header snapshot is not the expected one')
+    return start_height, count, batch_digests
+
+
+def import_header_snapshot(blockchain: 'Blockchain', path: str, *,
+                           expected_checksum: Optional[str]) -> bool:
+    """Replaces the headers of blockchain (the best chain) with those in the snapshot
+    at path, from its start height on, if that makes the chain longer.
+    Returns whether anything was imported.
+
+    The snapshot has to be the one with expected_checksum, and is fully verified
+    before any of our headers are touched.
+    """
+    assert blockchain.parent is None, 'snapshots can only be imported into the best chain'
+    if not expected_checksum:
+        raise InvalidHeaderSnapshot('refusing to import a header snapshot whose checksum is not pinned')
+    with open(path, 'rb') as f:
+        __, start_height, count = _read_header_snapshot_preamble(f)
+    if start_height + count - 1 <= blockchain.height():
+        return False
+    __, __, batch_digests = _verify_header_snapshot(blockchain, path, expected_checksum=expected_checksum)
+    with blockchain.lock, open(path, 'rb') as f:
+        headers_path = blockchain.path()
+        if not os.path.exists(headers_path):
+            open(headers_path, 'wb').close()
+        f.seek(HEADER_SNAPSHOT_PREAMBLE.size)
+        for batch_start, batch_digest in zip(range(0, count, HEADER_SNAPSHOT_BATCH_SIZE), batch_digests):
+            num_records = min(HEADER_SNAPSHOT_BATCH_SIZE, count - batch_start)
+            data = f.read(num_records * HEADER_SNAPSHOT_RECORD_SIZE)
+            if hashlib.sha256(data).digest() != batch_digest:
+                # what we imported so far was verified, and stays
+                raise InvalidHeaderSnapshot('header snapshot changed while importing it')
+            records = [data[i:i + HEADER_SNAPSHOT_RECORD_SIZE]
+                       for i in range(0, len(data), HEADER_SNAPSHOT_RECORD_SIZE)]
+            height = start_height + batch_start
+            blockchain.write(b''.join(r[:HEADER_SIZE] for r in records), height * HEADER_SIZE,
+                             truncate=batch_start == 0)
+            blockchain._get_header_store().put_hashes(height, [r[HEADER_SIZE:HEADER_SIZE + 32] for r in records])
+        blockchain.sync_to_disk()
+    _logger.info(f"imported header snapshot {path}: heights {start_height}..{start_height + count - 1}")
+    return True
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
@@ -164,13 +607,24 @@ def read_blockchains(config: 'SimpleConfig'):
                             forkpoint_hash=constants.net.GENESIS,
                             prev_hash=None)
     blockchains[constants.net.GENESIS] = best_chain
+    best_chain.recover_unsynced_writes()
+    best_chain.verify_chainwork_index()
+    snapshot_path = config.HEADERS_SNAPSHOT_PATH
+    if snapshot_path and not config.HEADERS_SNAPSHOT_CHECKSUM:
+        _logger.warning(f"[blockchain] not importing header snapshot {snapshot_path}: "
+                        f"its checksum has to be set as well (headers_snapshot_sha256d)")
+    elif snapshot_path:
+        try:
+            import_header_snapshot(best_chain, snapshot_path,
+                                   expected_checksum=config.HEADERS_SNAPSHOT_CHECKSUM)
+        except (OSError, InvalidHeaderSnapshot) as e:
+            _logger.warning(f"[blockchain] cannot import header snapshot {snapshot_path}: {repr(e)}")
     # consistency checks
     if best_chain.height() > constants.net.max_checkpoint():
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
-            os.unlink(best_chain.path())
-            best_chain.update_size()
+            best_chain.delete_headers_file()
     # forks
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     util.make_dir(fdir)
@@ -180,7 +634,11 @@ def read_blockchains(config: 'SimpleConfig'):
 
     def delete_chain(filename, reason):
         _logger.info(f"[blockchain] deleting chain {filename}: {reason}")
-        os.unlink(os.path.join(fdir, filename))
+        path = os.path.join(fdir, filename)
+        os.unlink(path)
+        for sidecar_path in (HeaderStore.index_path(path), path + '.unsynced', path + '.unsynced.tmp', path + '.work'):
+            if os.path.exists(sidecar_path):
+                os.unlink(sidecar_path)
 
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
@@ -203,6 +661,8 @@ def read_blockchains(config: 'SimpleConfig'):
                        parent=parent,
                        forkpoint_hash=first_hash,
                        prev_hash=prev_hash)
+        b.recover_unsynced_writes()
+        b.verify_chainwork_index()
         # consistency checks
         h = b.read_header(b.forkpoint)
         if first_hash != hash_header(h):
@@ -222,13 +682,11 @@ def read_blockchains(config: 'SimpleConfig'):
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
-# block hash -> chain work; up to and including that block
-_CHAINWORK_CACHE = {
-    "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
-}  # type: Dict[str, int]
 
-if len(constants.net.DGW_CHECKPOINTS) > 0:
-    _CHAINWORK_CACHE[constants.net.DGW_CHECKPOINTS[-1][1][0]] = 0  # set start of cache to 0 work
+def sync_headers_to_disk(*, only_if_due: bool = False) -> None:
+    with blockchains_lock: chains = list(blockchains.values())
+    for b in chains:
+        b.sync_to_disk(only_if_due=only_if_due)
 
 
 def init_headers_file_for_best_chain():
@@ -236,6 +694,7 @@ def init_headers_file_for_best_chain():
     filename = b.path()
     length = HEADER_SIZE * (constants.net.max_checkpoint() + 1)
     if not os.path.exists(filename) or os.path.getsize(filename) < length:
+        b._close_header_store()
         with open(filename, 'wb') as f:
             if length > 0:
                 f.seek(length - 1)
@@ -245,6 +704,96 @@ def init_headers_file_for_best_chain():
         b.update_size()
 
 
+# incremented on every write that is not a pure append, i.e. that might change
+# stored headers, so that DGWStates loaded from stored headers can tell they are stale
+_headers_generation = 0
+
+
+class DGWState:
+    """Sliding window over the (target, timestamp) of the DGW_PASTBLOCKS + 1
+    headers preceding a height, from which the Dark Gravity Wave target of
+    that height is computed. Once loaded, the window is moved forward by
+    push()-ing each new header, so consecutive heights need no header reads
+    and no bits conversions; computing a target is then only integer
+    arithmetic over the cached window.
+
+    note: the DGW average uses nested floor divisions, so it cannot be kept
+          as an exact running sum and is recomputed from the window.
+    """
+
+    def __init__(self):
+        # (height, target, timestamp), oldest first
+        self._window = deque(maxlen=DGW_PASTBLOCKS + 1)
+        self._generation = _headers_generation
+
+    def copy(self) -> 'DGWState':
+        state = DGWState()
+        state._window.extend(self._window)
+        state._generation = self._generation
+        return state
+
+    def push(self, height: int, bits: int, timestamp: int) -> None:
+        if self._window and self._window[-1][0] != height - 1:
+            self._window.clear()
+        self._window.append((height, Blockchain.convbignum(bits), timestamp))
+
+    def can_compute(self, height: int) -> bool:
+        return (len(self._window) == self._window.maxlen
+                and self._window[-1][0] == height - 1
+                and self._generation == _headers_generation)
+
+    def load(self, blockchain: 'Blockchain', tip_height: int, chain: Mapping[int, dict] = None) -> None:
+        """Fills the window with the headers up to tip_height, taking them
+        from chain if present there, from blockchain otherwise.
+        """
+        window = []
+        for height in range(tip_height, tip_height - DGW_PASTBLOCKS - 1, -1):
+            header = chain.get(height) if chain is not None else None
+            if header is None:
+                header = blockchain.read_header(height)
+            if header is None:
+                raise NotEnoughHeaders()
+            window.append((height, Blockchain.convbignum(header['bits']), header['timestamp']))
+        self._window.clear()
+        self._window.extend(reversed(window))
+        self._generation = _headers_generation
+
+    def get_target(self, height: int) -> int:
+        assert self.can_compute(height), height
+        nActualTimespan = 0
+        LastBlockTime = 0
+        CountBlocks = 0
+        PastDifficultyAverage = 0
+        PastDifficultyAveragePrev = 0
+
+        for _, target, timestamp in itertools.islice(reversed(self._window), DGW_PASTBLOCKS):
+            CountBlocks += 1
+
+            if CountBlocks == 1:
+                PastDifficultyAverage = target
+            else:
+                PastDifficultyAverage = ((PastDifficultyAveragePrev * CountBlocks) + target) // (CountBlocks + 1)
+            PastDifficultyAveragePrev = PastDifficultyAverage
+
+            if LastBlockTime > 0:
+                Diff = (LastBlockTime - timestamp)
+                nActualTimespan += Diff
+            LastBlockTime = timestamp
+
+        bnNew = PastDifficultyAverage
+        nTargetTimespan = CountBlocks * 60  # 1 min
+
+        nActualTimespan = max(nActualTimespan, nTargetTimespan // 3)
+        nActualTimespan = min(nActualTimespan, nTargetTimespan * 3)
+
+        # retarget
+        bnNew *= nActualTimespan
+        bnNew //= nTargetTimespan
+        bnNew = min(bnNew, MAX_TARGET)
+
+        return bnNew
+
+
 class Blockchain(Logger):
     """
     Manages blockchain headers and their verification
@@ -264,6 +813,11 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._header_store = None  # type: Optional[HeaderStore]
+        self._dgw_state = DGWState()  # window over our own stored headers
+        self._unsynced_start = None  # type: Optional[int]  # offset of oldest write not yet fsynced
+        self._unsynced_since = None  # type: Optional[float]
+        self._tip_chainwork = None  # type: Optional[int]
         self.update_size()
 
     @property
@@ -362,12 +916,42 @@ class Blockchain(Logger):
 
     @with_lock
     def update_size(self) -> None:
+        self._close_header_store()
+        self._tip_chainwork = None
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
 
+    @with_lock
+    def _get_header_store(self) -> HeaderStore:
+        if self._header_store is None:
+            name = self.path()
+            self.assert_headers_file_available(name)
+            self._header_store = HeaderStore(name, self._size)
+        return self._header_store
+
+    @with_lock
+    def _close_header_store(self) -> None:
+        # note: the mapping has to be redone whenever the file changes size or name
+        if self._header_store is not None:
+            self._header_store.close()
+            self._header_store = None
+
+    @with_lock
+    def delete_headers_file(self) -> None:
+        self._close_header_store()
+        os.unlink(self.path())
+        self._unsynced_start = self._unsynced_since = None
+        for path in (HeaderStore.index_path(self.path()), self._unsynced_marker_path(),
+                     self._chainwork_index_path()):
+            if os.path.exists(path):
+                os.unlink(path)
+        self.update_size()
+
     @classmethod
-    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
-        _hash = hash_header(header)
+    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None,
+                      *, header_hash: str = None) -> None:
+        # header_hash, if given, must be hash_header(header); e.g. precomputed by the PoW pool
+        _hash = header_hash if header_hash is not None else hash_header(header)
         if expected_header_hash and expected_header_hash != _hash:
             raise InvalidHeader("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
         if prev_hash != header.get('prev_block_hash'):
@@ -381,42 +965,45 @@ class Blockchain(Logger):
         if block_hash_as_num > target:
             raise InvalidHeader(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
-    def verify_chunk(self, start_height: int, data: bytes) -> None:
-        raw = []
-        p = 0
+    def verify_chunk(self, start_height: int, data: bytes, *, header_hashes: Sequence[str] = None) -> None:
+        """Raises if the chunk does not connect to this chain.
+        header_hashes, if given, are the PoW hashes of the headers in the chunk,
+        as returned by hash_raw_headers. Only the cheap linkage and target checks
+        are then done here.
+        """
+        raw_headers = split_chunk_into_raw_headers(start_height, data)
+        if header_hashes is None:
+            header_hashes = hash_raw_headers(raw_headers)
+        if len(header_hashes) != len(raw_headers):
+            raise Exception(f'expected {len(raw_headers)} header hashes, got {len(header_hashes)}')
         s = start_height
         prev_hash = self.get_hash(start_height - 1)
         headers = {}
-        while p < len(data):
-            if s < constants.net.KawpowActivationHeight:
-                raw = data[p:p + LEGACY_HEADER_SIZE]
-                p += LEGACY_HEADER_SIZE
-            else:
-                raw = data[p:p + HEADER_SIZE]
-                p += HEADER_SIZE
+        with self.lock:
+            dgw_state = self._dgw_state.copy()
+        for raw, header_hash in zip(raw_headers, header_hashes):
             try:
                 expected_header_hash = self.get_hash(s)
             except MissingHeader:
                 expected_header_hash = None
-            if len(raw) not in (LEGACY_HEADER_SIZE, HEADER_SIZE):
-                raise Exception('Invalid header length: {}'.format(len(raw)))
             header = deserialize_header(raw, s)
             headers[header.get('block_height')] = header
-            
+
             # Don't bother with the target of headers in the middle of
             # DGW checkpoints
             target = 0
             if constants.net.DGW_CHECKPOINTS_START <= s <= constants.net.max_checkpoint():
                 if self.is_dgw_height_checkpoint(s) is not None:
-                    target = self.get_target(s, headers)
+                    target = self.get_target(s, headers, dgw_state=dgw_state)
                 else:
                     # Just use the headers own bits for the logic
                     target = self.bits_to_target(header['bits'])
             else:
-                target = self.get_target(s, headers)
-            
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-            prev_hash = hash_header(header)
+                target = self.get_target(s, headers, dgw_state=dgw_state)
+
+            self.verify_header(header, prev_hash, target, expected_header_hash, header_hash=header_hash)
+            dgw_state.push(s, header['bits'], header['timestamp'])
+            prev_hash = header_hash
             s += 1
 
         # DGW must be received in correct chunk sizes to be valid with our checkpoints
@@ -457,20 +1044,19 @@ class Blockchain(Logger):
         truncate = not chunk_within_checkpoint_region
 
         def convert_to_kawpow_len():
-            r = b''
-            p = 0
-            s = start_height
-            while p < len(chunk):
-                if s < constants.net.KawpowActivationHeight:
-                    r += chunk[p:p + LEGACY_HEADER_SIZE] + bytes(40)
-                    p += LEGACY_HEADER_SIZE
-                else:
-                    r += chunk[p:p + HEADER_SIZE]
-                    p += HEADER_SIZE
-                s += 1
-            if len(r) % HEADER_SIZE != 0:
+            # legacy headers are zero-padded to HEADER_SIZE, within a single preallocated buffer
+            num_legacy = max(0, constants.net.KawpowActivationHeight - start_height)
+            legacy_len = min(num_legacy * LEGACY_HEADER_SIZE, len(chunk))
+            num_legacy = legacy_len // LEGACY_HEADER_SIZE
+            if legacy_len % LEGACY_HEADER_SIZE != 0 or (len(chunk) - legacy_len) % HEADER_SIZE != 0:
                 raise Exception('Header extension error')
-            return r
+            src = memoryview(chunk)
+            r = bytearray(num_legacy * HEADER_SIZE + len(chunk) - legacy_len)
+            for i in range(num_legacy):
+                r[i * HEADER_SIZE:i * HEADER_SIZE + LEGACY_HEADER_SIZE] = \
+                    src[i * LEGACY_HEADER_SIZE:(i + 1) * LEGACY_HEADER_SIZE]
+            r[num_legacy * HEADER_SIZE:] = src[legacy_len:]
+            return bytes(r)
 
         chunk = convert_to_kawpow_len()
         self.write(chunk, delta_bytes, truncate)
@@ -527,10 +1113,17 @@ class Blockchain(Logger):
         # swap parameters
         self.parent, parent.parent = parent.parent, self  # type: Optional[Blockchain], Optional[Blockchain]
         self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
-        self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_header(parent_data[:HEADER_SIZE])
+        self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_headers([parent_data[:HEADER_SIZE]])[0]
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
         # parent's new name
+        self.sync_to_disk()
+        parent.sync_to_disk()
+        self._close_header_store()
+        parent._close_header_store()
         os.replace(child_old_name, parent.path())
+        for sidecar_path in (HeaderStore.index_path, lambda path: path + '.work'):
+            if os.path.exists(sidecar_path(child_old_name)):
+                os.replace(sidecar_path(child_old_name), sidecar_path(parent.path()))
         self.update_size()
         parent.update_size()
         # update pointers
@@ -553,16 +1146,166 @@ class Blockchain(Logger):
 
     @with_lock
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
+        global _headers_generation
         filename = self.path()
         self.assert_headers_file_available(filename)
+        self._close_header_store()
+        if offset != self._size * HEADER_SIZE:
+            _headers_generation += 1
+        # Appends, and writes into the (sparse) checkpoint region, only ever fill space that
+        # was empty before. If we crash before they reach the disk, they are detected and
+        # undone on startup (see recover_unsynced_writes). Hence they are committed in groups.
+        # Anything else overwrites headers, and is synced immediately.
+        is_append = offset == self._size * HEADER_SIZE
+        can_defer_fsync = (is_append or not truncate) and self.config.HEADERS_FSYNC_INTERVAL > 0
+        if can_defer_fsync:
+            self._begin_unsynced_write(offset, data)
+        else:
+            self.sync_to_disk()
         with open(filename, 'rb+') as f:
-            if truncate and offset != self._size * HEADER_SIZE:
+            if truncate and not is_append:
                 f.seek(offset)
                 f.truncate()
             f.seek(offset)
             f.write(data)
             f.flush()
+            if not can_defer_fsync:
+                os.fsync(f.fileno())
+        self.update_size()
+        height = self.forkpoint + offset // HEADER_SIZE
+        if truncate or height >= self._chainwork_index_first_height():
+            self._update_chainwork_index(height)
+        if can_defer_fsync:
+            self.sync_to_disk(only_if_due=True)
+
+    def _unsynced_marker_path(self) -> str:
+        return self.path() + '.unsynced'
+
+    @with_lock
+    def _begin_unsynced_write(self, offset: int, data: bytes) -> None:
+        """Before writing data without fsync, make sure a marker file on disk
+        records where unsynced data might be, and journal the write in it.
+
+        The marker starts with the offset of the first unsynced write, and
+        has to be durable before the data it covers. It is followed by one
+        line per write: offset, length and crc32 of the data. These lines
+        are not fsynced: a write whose line did not make it to disk is
+        simply treated as lost.
+        """
+        if self._unsynced_start is not None:
+            start = self._unsynced_start
+            if start <= offset and offset + len(data) <= start + MAX_UNSYNCED_BYTES:
+                self._journal_unsynced_write(offset, data)
+                return
+            self.sync_to_disk()
+        marker = self._unsynced_marker_path()
+        with open(marker + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(f'{offset}\n')
+            f.flush()
             os.fsync(f.fileno())
+        os.replace(marker + '.tmp', marker)
+        util.fsync_dir(os.path.dirname(marker))
+        self._unsynced_start = offset
+        self._unsynced_since = time.monotonic()
+        self._journal_unsynced_write(offset, data)
+
+    def _journal_unsynced_write(self, offset: int, data: bytes) -> None:
+        with open(self._unsynced_marker_path(), 'a', encoding='utf-8') as f:
+            f.write(f'{offset} {len(data)} {zlib.crc32(data)}\n')
+
+    @with_lock
+    def sync_to_disk(self, *, only_if_due: bool = False) -> None:
+        """Commits pending header writes to disk.
+        If only_if_due, only does so if the oldest one is older than config.HEADERS_FSYNC_INTERVAL.
+        """
+        if self._unsynced_start is None:
+            return
+        if only_if_due and time.monotonic() - self._unsynced_since < self.config.HEADERS_FSYNC_INTERVAL:
+            return
+        filename = self.path()
+        if os.path.exists(filename):
+            with open(filename, 'rb+') as f:
+                os.fsync(f.fileno())
+        marker = self._unsynced_marker_path()
+        if os.path.exists(marker):
+            os.unlink(marker)
+            util.fsync_dir(os.path.dirname(marker))
+        self._unsynced_start = None
+        self._unsynced_since = None
+
+    @staticmethod
+    def _read_unsynced_marker(marker: str) -> Tuple[int, Sequence[Tuple[int, int, int]]]:
+        """Returns the start offset recorded in the marker file, and the journaled writes
+        as (offset, length, crc32). A line that is cut or garbled ends the journal.
+        """
+        with open(marker, 'r', encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        try:
+            start = int(lines[0])
+        except ValueError:
+            start = 0  # check everything
+        writes = []
+        for line in lines[1:-1]:  # the last line has no newline yet, if any
+            try:
+                offset, length, crc = map(int, line.split(' '))
+            except ValueError:
+                break
+            writes.append((offset, length, crc))
+        return start, writes
+
+    @with_lock
+    def recover_unsynced_writes(self) -> None:
+        """Undoes header writes that might not have fully reached the disk,
+        as recorded by the marker file, e.g. after a power loss.
+        A stored header in the unsynced range is only kept if it was written by
+        a journaled write whose data is intact (see _begin_unsynced_write).
+        Other headers in the checkpoint region are zeroed out, to be downloaded again.
+        Elsewhere, the chain is truncated before the first such header.
+        """
+        filename = self.path()
+        marker = self._unsynced_marker_path()
+        if not os.path.exists(filename) or not os.path.exists(marker):
+            return
+        try:
+            start, writes = self._read_unsynced_marker(marker)
+        except OSError:
+            start, writes = 0, []
+        self.logger.info(f"checking headers that might not have been synced to disk, from offset {start}")
+        self._close_header_store()
+        with open(filename, 'rb+') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            num_headers = file_size // HEADER_SIZE
+            if file_size != num_headers * HEADER_SIZE:
+                f.truncate(num_headers * HEADER_SIZE)
+            start_delta = start // HEADER_SIZE
+            end_delta = min(num_headers, start_delta + MAX_UNSYNCED_BYTES // HEADER_SIZE + 1)
+            f.seek(start_delta * HEADER_SIZE)
+            data = f.read((end_delta - start_delta) * HEADER_SIZE)
+            complete = set()
+            for offset, length, crc in writes:
+                if offset % HEADER_SIZE or length % HEADER_SIZE or offset < start_delta * HEADER_SIZE:
+                    continue
+                written = data[offset - start_delta * HEADER_SIZE:offset - start_delta * HEADER_SIZE + length]
+                if len(written) == length and zlib.crc32(written) == crc:
+                    complete.update(range(offset // HEADER_SIZE, (offset + length) // HEADER_SIZE))
+            for delta in range(start_delta, end_delta):
+                height = self.forkpoint + delta
+                raw = data[(delta - start_delta) * HEADER_SIZE:(delta - start_delta + 1) * HEADER_SIZE]
+                if delta in complete:
+                    continue
+                if self.parent is None and height <= constants.net.max_checkpoint():
+                    if raw != bytes(HEADER_SIZE):
+                        self.logger.info(f"zeroing incomplete header at height {height}")
+                        f.seek(delta * HEADER_SIZE)
+                        f.write(bytes(HEADER_SIZE))
+                else:
+                    self.logger.info(f"truncating headers from height {height}")
+                    f.truncate(delta * HEADER_SIZE)
+                    break
+            f.flush()
+            os.fsync(f.fileno())
+        os.unlink(marker)
+        util.fsync_dir(os.path.dirname(marker))
         self.update_size()
 
     @with_lock
@@ -573,6 +1316,9 @@ class Blockchain(Logger):
         assert delta == self.size(), (delta, self.size())
         assert len(data) == HEADER_SIZE
         self.write(data, delta*HEADER_SIZE)
+        height = header.get('block_height')
+        if self._dgw_state.can_compute(height):
+            self._dgw_state.push(height, header['bits'], header['timestamp'])
         self.swap_with_parent()
 
     @with_lock
@@ -584,17 +1330,24 @@ class Blockchain(Logger):
         if height > self.height():
             return
         delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        h = self._get_header_store().read_raw_header(delta)
         if h == bytes([0])*HEADER_SIZE:
             return None
         return deserialize_header(h, height)
 
+    @with_lock
+    def get_hash_and_bits(self, height: int) -> Optional[Tuple[str, int]]:
+        """Returns (hash, bits) of the stored header at height, from the index.
+        None if we do not have that header.
+        """
+        if height < 0:
+            return None
+        if height < self.forkpoint:
+            return self.parent.get_hash_and_bits(height)
+        if height > self.height():
+            return None
+        return self._get_header_store().get_hash_and_bits(height - self.forkpoint)
+
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
         height = self.height()
@@ -631,7 +1384,8 @@ class Blockchain(Logger):
             return 1
         return None
 
-    def get_hash(self, height: int) -> str:
+    def get_checkpointed_hash(self, height: int) -> Optional[str]:
+        """Returns the hash at height if it is hardcoded (genesis or checkpoints), else None."""
         def is_height_checkpoint():
             within_cp_range = height <= constants.net.max_legacy_checkpoint()
             at_chunk_boundary = (height + 1) % 2016 == 0
@@ -650,13 +1404,18 @@ class Blockchain(Logger):
             index = height // constants.net.DGW_CHECKPOINTS_SPACING - constants.net.DGW_CHECKPOINTS_START // constants.net.DGW_CHECKPOINTS_SPACING
             h, t = self.checkpoints[index][dgw_height_checkpoint]
             return h
-        else:
-            header = self.read_header(height)
-            if header is None:
-                raise MissingHeader(height)
-            return hash_header(header)
+        return None
 
-    def get_target(self, height: int, chain=None) -> int:         
+    def get_hash(self, height: int) -> str:
+        h = self.get_checkpointed_hash(height)
+        if h is not None:
+            return h
+        hash_and_bits = self.get_hash_and_bits(height)
+        if hash_and_bits is None:
+            raise MissingHeader(height)
+        return hash_and_bits[0]
+
+    def get_target(self, height: int, chain=None, *, dgw_state: DGWState = None) -> int:
         dgw_height_checkpoint = self.is_dgw_height_checkpoint(height)
 
         if constants.net.TESTNET:
@@ -682,13 +1441,14 @@ class Blockchain(Logger):
             return KAWPOW_LIMIT
         # If we have a DWG header already saved to our header cache (i.e. for a reorg), get that
         elif height <= self.height():
-            return self.bits_to_target(self.read_header(height)['bits'])
+            return self.bits_to_target(self.get_hash_and_bits(height)[1])
         else:
             # Now we no longer have cached checkpoints and need to compute our own DWG targets to verify
             # a header
-            return self.get_target_dgwv3(height, chain)
+            return self.get_target_dgwv3(height, chain, dgw_state=dgw_state)
 
-    def convbignum(self, bits):
+    @staticmethod
+    def convbignum(bits):
         MM = 256 * 256 * 256
         a = bits % MM
         if a < 0x8000:
@@ -696,60 +1456,16 @@ class Blockchain(Logger):
         target = a * pow(2, 8 * (bits // MM - 3))
         return target
 
-    def get_target_dgwv3(self, height, chain=None) -> int:
-
-        def get_block_reading_from_height(height):
-            last = None
-            try:
-                last = chain.get(height)
-            except:
-                pass
-            if last is None:
-                last = self.read_header(height)
-            if last is None:
-                raise NotEnoughHeaders()
-            return last
-
-        # params
-        BlockReading = get_block_reading_from_height(height - 1)
-        nActualTimespan = 0
-        LastBlockTime = 0
-        PastBlocksMin = DGW_PASTBLOCKS
-        PastBlocksMax = DGW_PASTBLOCKS
-        CountBlocks = 0
-        PastDifficultyAverage = 0
-        PastDifficultyAveragePrev = 0
-
-        for _ in range(PastBlocksMax):
-            CountBlocks += 1
-
-            if CountBlocks <= PastBlocksMin:
-                if CountBlocks == 1:
-                    PastDifficultyAverage = self.convbignum(BlockReading.get('bits'))
-                else:
-                    bnNum = self.convbignum(BlockReading.get('bits'))
-                    PastDifficultyAverage = ((PastDifficultyAveragePrev * CountBlocks) + (bnNum)) // (CountBlocks + 1)
-                PastDifficultyAveragePrev = PastDifficultyAverage
-
-            if LastBlockTime > 0:
-                Diff = (LastBlockTime - BlockReading.get('timestamp'))
-                nActualTimespan += Diff
-            LastBlockTime = BlockReading.get('timestamp')
-
-            BlockReading = get_block_reading_from_height((height - 1) - CountBlocks)
-
-        bnNew = PastDifficultyAverage
-        nTargetTimespan = CountBlocks * 60  # 1 min
-
-        nActualTimespan = max(nActualTimespan, nTargetTimespan // 3)
-        nActualTimespan = min(nActualTimespan, nTargetTimespan * 3)
-
-        # retarget
-        bnNew *= nActualTimespan
-        bnNew //= nTargetTimespan
-        bnNew = min(bnNew, MAX_TARGET)
-
-        return bnNew
+    def get_target_dgwv3(self, height, chain=None, *, dgw_state: DGWState = None) -> int:
+        """Computes the target at height from the previous DGW_PASTBLOCKS headers,
+        taken from chain if present there, from our stored headers otherwise.
+        If given, dgw_state is used (and loaded if it cannot serve height).
+        """
+        if dgw_state is None:
+            dgw_state = DGWState()
+        if not dgw_state.can_compute(height):
+            dgw_state.load(self, height - 1, chain)
+        return dgw_state.get_target(height)
 
     @classmethod
     def bits_to_target(cls, bits: int) -> int:
@@ -797,30 +1513,139 @@ class Blockchain(Logger):
 
     @with_lock
     def get_chainwork(self, height=None) -> int:
+        """Returns the work done by the headers after the last checkpoint, up to height."""
         if height is None:
             height = max(0, self.height())
         if constants.net.TESTNET:
             # On testnet/regtest, difficulty works somewhat different.
             # It's out of scope to properly implement that.
             return height
-        last_retarget = height // 2016 * 2016 - 1
-        cached_height = last_retarget
-        while _CHAINWORK_CACHE.get(self.get_hash(cached_height)) is None:
-            if cached_height <= -1:
-                break
-            cached_height -= 2016
-        assert cached_height >= -1, cached_height
-        running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
-        while cached_height < last_retarget:
-            cached_height += 2016
-            work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-            work_in_chunk = 2016 * work_in_single_header
-            running_total += work_in_chunk
-            _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
-        cached_height += 2016
-        work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-        work_in_last_partial_chunk = (height % 2016 + 1) * work_in_single_header
-        return running_total + work_in_last_partial_chunk
+        first_height = self._chainwork_index_first_height()
+        if height < first_height:
+            # work is only counted from the last checkpoint on
+            return self.parent.get_chainwork(height) if self.parent is not None else 0
+        if height > self.height():
+            raise MissingHeader(height)
+        if self._tip_chainwork is not None and height == self.height():
+            return self._tip_chainwork
+        work = self._read_chainwork_index(height)
+        if work is None:
+            self.logger.info("rebuilding chainwork index")
+            try:
+                self._update_chainwork_index(first_height)
+            except OSError as e:
+                self.logger.warning(f"cannot rebuild chainwork index: {repr(e)}")
+            work = self._read_chainwork_index(height)
+        if work is None:
+            work = self._compute_chainwork(height)
+        if height == self.height():
+            self._tip_chainwork = work
+        return work
+
+    @with_lock
+    def _compute_chainwork(self, height: int) -> int:
+        """Same as get_chainwork, from the stored headers instead of the index."""
+        first_height = self._chainwork_index_first_height()
+        work = self.get_chainwork(first_height - 1)
+        store = self._get_header_store()
+        for h in range(first_height, height + 1):
+            raw = store.read_raw_header(h - self.forkpoint)
+            if raw == bytes(HEADER_SIZE):
+                raise MissingHeader(h)
+            work += work_from_bits(int.from_bytes(raw[72:76], byteorder='little'))
+        return work
+
+    @with_lock
+    def verify_chainwork_index(self) -> bool:
+        """Recomputes the cumulative work of our headers from their bits, and checks the
+        index against it. The crc32 in a record only tells whether it is about the header
+        stored now, so an index that was tampered with would otherwise go unnoticed.
+        Records from the first mismatch on are dropped, to be rebuilt when needed.
+        Returns whether all records were kept.
+        """
+        path = self._chainwork_index_path()
+        if not os.path.exists(path):
+            return True
+        first_height = self._chainwork_index_first_height()
+        num_headers = max(0, self.height() - first_height + 1)
+        with open(path, 'r+b') as f:
+            num_records = min(os.fstat(f.fileno()).st_size // CHAINWORK_RECORD_SIZE, num_headers)
+            if num_records == 0:
+                return True
+            work = self.get_chainwork(first_height - 1)
+            store = self._get_header_store()
+            for batch_start in range(0, num_records, 2016):
+                data = f.read(min(2016, num_records - batch_start) * CHAINWORK_RECORD_SIZE)
+                for i in range(len(data) // CHAINWORK_RECORD_SIZE):
+                    record = data[i * CHAINWORK_RECORD_SIZE:(i + 1) * CHAINWORK_RECORD_SIZE]
+                    raw = store.read_raw_header(first_height + batch_start + i - self.forkpoint)
+                    work += work_from_bits(int.from_bytes(raw[72:76], byteorder='little'))
+                    if (raw != bytes(HEADER_SIZE)
+                            and int.from_bytes(record[:32], byteorder='big') == work
+                            and int.from_bytes(record[32:36], byteorder='little') == zlib.crc32(raw)):
+                        continue
+                    self.logger.warning(f"chainwork index does not match the headers "
+                                        f"from height {first_height + batch_start + i}. dropping it from there.")
+                    f.truncate((batch_start + i) * CHAINWORK_RECORD_SIZE)
+                    self._tip_chainwork = None
+                    return False
+        return True
+
+    def _chainwork_index_path(self) -> str:
+        return self.path() + '.work'
+
+    def _chainwork_index_first_height(self) -> int:
+        return max(self.forkpoint, constants.net.max_checkpoint() + 1)
+
+    @with_lock
+    def _read_chainwork_index(self, height: int) -> Optional[int]:
+        """Returns the cumulative work up to the stored header at height, from the index.
+        None if the index has no valid record for it.
+        """
+        offset = (height - self._chainwork_index_first_height()) * CHAINWORK_RECORD_SIZE
+        try:
+            with open(self._chainwork_index_path(), 'rb') as f:
+                f.seek(offset)
+                record = f.read(CHAINWORK_RECORD_SIZE)
+        except OSError:
+            return None
+        if len(record) != CHAINWORK_RECORD_SIZE:
+            return None
+        raw = self._get_header_store().read_raw_header(height - self.forkpoint)
+        if int.from_bytes(record[32:36], byteorder='little') != zlib.crc32(raw):
+            return None
+        return int.from_bytes(record[:32], byteorder='big')
+
+    @with_lock
+    def _update_chainwork_index(self, changed_height: int) -> None:
+        """Drops the index records from changed_height on, then adds records
+        for all stored headers that have none. Records are the cumulative work
+        (as in get_chainwork) and the crc32 of the header they are about.
+        """
+        first_height = self._chainwork_index_first_height()
+        num_headers = max(0, self.height() - first_height + 1)
+        path = self._chainwork_index_path()
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+            num_records = os.fstat(f.fileno()).st_size // CHAINWORK_RECORD_SIZE
+            num_records = min(num_records, num_headers, max(0, changed_height - first_height))
+            f.truncate(num_records * CHAINWORK_RECORD_SIZE)
+            if num_records == num_headers:
+                return
+            if num_records == 0:
+                work = self.get_chainwork(first_height - 1)
+            else:
+                f.seek((num_records - 1) * CHAINWORK_RECORD_SIZE)
+                work = int.from_bytes(f.read(32), byteorder='big')
+            store = self._get_header_store()
+            records = []
+            for height in range(first_height + num_records, first_height + num_headers):
+                raw = store.read_raw_header(height - self.forkpoint)
+                if raw == bytes(HEADER_SIZE):
+                    break
+                work += work_from_bits(int.from_bytes(raw[72:76], byteorder='little'))
+                records.append(work.to_bytes(32, byteorder='big') + zlib.crc32(raw).to_bytes(4, byteorder='little'))
+            f.seek(num_records * CHAINWORK_RECORD_SIZE)
+            f.write(b''.join(records))
 
     def can_connect(self, header: dict, check_height: bool=True) -> bool:
         if header is None:
@@ -838,7 +1663,8 @@ class Blockchain(Logger):
             return False
         headers = {header.get('block_height'): header}
         try:
-            target = self.get_target(height, headers)
+            with self.lock:
+                target = self.get_target(height, headers, dgw_state=self._dgw_state)
         except MissingHeader:
             return False
         try:
@@ -851,8 +1677,11 @@ class Blockchain(Logger):
         assert start_height >= 0, start_height
         try:
             data = bfh(hexdata)
-            # This is computationally intensive (thanks DGW)
-            self.verify_chunk(start_height, data)
+            # This is computationally intensive (thanks DGW), so the PoW hashes are
+            # computed by a process pool, and only the linkage is checked here.
+            raw_headers = split_chunk_into_raw_headers(start_height, data)
+            header_hashes = await hash_raw_headers_in_pool(raw_headers, config=self.config)
+            self.verify_chunk(start_height, data, header_hashes=header_hashes)
             self.save_chunk(start_height, data)
             return True
         except BaseException as e:
@@ -22,6 +22,8 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import bisect
+import itertools
 from collections import defaultdict
 from math import floor, log10
 from typing import NamedTuple, List, Callable, Sequence, Union, Dict, Tuple, Mapping, Type, TYPE_CHECKING, Optional
@@ -55,23 +57,30 @@ class PRNG:
         result, self.pool = self.pool[:n], self.pool[n:]
         return bytes(result)
 
+    @staticmethod
+    def _num_bytes(n: int) -> int:
+        # number of big-endian bytes drawn for a random integer in [0, n)
+        return ((n - 1).bit_length() + 7) // 8 if n > 1 else 0
+
     def randint(self, start, end):
         # Returns random integer in [start, end)
         n = end - start
-        r = 0
-        p = 1
-        while p < n:
-            r = self.get_bytes(1)[0] + (r << 8)
-            p = p << 8
+        r = int.from_bytes(self.get_bytes(self._num_bytes(n)), 'big')
         return start + (r % n)
 
     def choice(self, seq):
         return seq[self.randint(0, len(seq))]
 
     def shuffle(self, x):
-        for i in reversed(range(1, len(x))):
+        # same result as calling randint(0, i+1) for each i, but with all bytes drawn at once
+        indices = range(len(x) - 1, 0, -1)
+        sizes = [self._num_bytes(i + 1) for i in indices]
+        pool = self.get_bytes(sum(sizes))
+        pos = 0
+        for i, size in zip(indices, sizes):
             # pick an element in x[:i+1] with which to exchange x[i]
-            j = self.randint(0, i+1)
+            j = int.from_bytes(pool[pos:pos + size], 'big') % (i + 1)
+            pos += size
             x[i], x[j] = x[j], x[i]
 
 
@@ -106,6 +115,25 @@ class ScoredCandidate(NamedTuple):
     buckets: List[Bucket]
 
 
+class SelectionTarget(NamedTuple):
+    """What the chosen buckets have to pay for, on top of the fixed inputs of the tx.
+    sufficient_funds(buckets) is equivalent to funds_are_sufficient(value and weight sums of buckets).
+    """
+    needed: Mapping[Optional[str], int]   # per asset: spent amount minus fixed inputs, fee not included
+    base_weight: int
+    fee_estimator_w: Callable[[int], int]
+    has_fixed_inputs: bool
+    cost_of_change: int                   # excess value for which a change output is not worth it
+
+    def funds_are_sufficient(self, value_sum: Mapping[Optional[str], int], weight_sum: int, num_buckets: int) -> bool:
+        for asset, amount in self.needed.items():
+            if asset is not None and value_sum.get(asset, 0) < amount:
+                return False
+        if not num_buckets and not self.has_fixed_inputs:
+            return False
+        return value_sum.get(None, 0) >= self.needed.get(None, 0) + self.fee_estimator_w(self.base_weight + weight_sum)
+
+
 def strip_unneeded(bkts: List[Bucket], sufficient_funds) -> List[Bucket]:
     '''Remove buckets that are unnecessary in achieving the spend amount'''
     if sufficient_funds([], bucket_value_sum=defaultdict(int)):
@@ -370,7 +398,7 @@ class CoinChooserBase(Logger):
         def fee_estimator_w(weight):
             return fee_estimator_vb(Transaction.virtual_size_from_weight(weight))
 
-        def sufficient_funds(buckets, *, bucket_value_sum: Mapping[Optional[str], int]):
+        def sufficient_funds(buckets, *, bucket_value_sum: Mapping[Optional[str], int], bucket_weight_sum: int = None):
             '''Given a list of buckets, return True if it has enough
             value to pay for the transaction'''
             # assert bucket_value_sum == sum(bucket.value for bucket in buckets)  # expensive!
@@ -389,8 +417,11 @@ class CoinChooserBase(Logger):
                 return False
             
             # note re performance: so far this was constant time
-            # what follows is linear in len(buckets)
-            total_weight = self._get_tx_weight(buckets, base_weight=base_weight)
+            # what follows is linear in len(buckets), unless the caller keeps track of their weight
+            if bucket_weight_sum is not None and not any_witness:
+                total_weight = base_weight + bucket_weight_sum
+            else:
+                total_weight = self._get_tx_weight(buckets, base_weight=base_weight)
             return total_input[None] >= spent_amount[None] + fee_estimator_w(total_weight)
 
         def tx_from_buckets(buckets):
@@ -409,9 +440,22 @@ class CoinChooserBase(Logger):
         # instead of per-coin, as each bucket should be either fully spent or not at all.
         # (e.g. CoinChooserPrivacy ensures that same-address coins go into one bucket)
         all_buckets = list(filter(lambda b: len(b.effective_value) > 1 or b.effective_value[None] > 0, all_buckets))
+        # with segwit buckets, the tx weight is not the sum of the bucket weights, see _get_tx_weight
+        any_witness = any(bucket.witness for bucket in all_buckets)
+        # a change output is only added if it is above the dust threshold after paying for itself
+        change_addr = change_addrs[0] if change_addrs else next((coin.address for coin in coins), None)
+        change_weight = 4 * Transaction.estimated_output_size_for_address(change_addr) if change_addr else 0
+        target = SelectionTarget(
+            needed={asset: spent_amount.get(asset, 0) - input_value.get(asset, 0)
+                    for asset in set(spent_amount) | {None}},
+            base_weight=base_weight,
+            fee_estimator_w=fee_estimator_w,
+            has_fixed_inputs=bool(inputs),
+            cost_of_change=dust_threshold + fee_estimator_w(base_weight + change_weight) - fee_estimator_w(base_weight))
         # Choose a subset of the buckets
         scored_candidate = self.choose_buckets(all_buckets, sufficient_funds,
-                                               self.penalty_func(base_tx, tx_from_buckets=tx_from_buckets))
+                                               self.penalty_func(base_tx, tx_from_buckets=tx_from_buckets),
+                                               target=target)
         tx = scored_candidate.tx
 
         self.logger.info(f"using {len(tx.inputs())} inputs")
@@ -421,7 +465,8 @@ class CoinChooserBase(Logger):
 
     def choose_buckets(self, buckets: List[Bucket],
                        sufficient_funds: Callable,
-                       penalty_func: Callable[[List[Bucket]], ScoredCandidate]) -> ScoredCandidate:
+                       penalty_func: Callable[[List[Bucket]], ScoredCandidate],
+                       *, target: SelectionTarget = None) -> ScoredCandidate:
         raise NotImplemented('To be subclassed')
 
 
@@ -439,7 +484,7 @@ class CoinChooserRandom(CoinChooserBase):
 
         # Add all singletons
         for n, bucket in enumerate(buckets):
-            if sufficient_funds([bucket], bucket_value_sum=bucket.value):
+            if sufficient_funds([bucket], bucket_value_sum=bucket.value, bucket_weight_sum=bucket.weight):
                 candidates.add((n,))
 
         # And now some random ones
@@ -451,12 +496,14 @@ class CoinChooserRandom(CoinChooserBase):
             self.p.shuffle(permutation)
             bkts = []
             bucket_value_sum = defaultdict(int)
+            bucket_weight_sum = 0
             for count, index in enumerate(permutation):
                 bucket = buckets[index]
                 bkts.append(bucket)
                 for asset, amount in bucket.value.items():
                     bucket_value_sum[asset] += amount
-                if sufficient_funds(bkts, bucket_value_sum=bucket_value_sum):
+                bucket_weight_sum += bucket.weight
+                if sufficient_funds(bkts, bucket_value_sum=bucket_value_sum, bucket_weight_sum=bucket_weight_sum):
                     candidates.add(tuple(sorted(permutation[:count + 1])))
                     break
             else:
@@ -489,15 +536,21 @@ class CoinChooserRandom(CoinChooserBase):
 
         for bkts_choose_from in bucket_sets:
             try:
+                already_selected_buckets_weight_sum = sum(bucket.weight for bucket in already_selected_buckets)
+
                 def sfunds(
                     bkts, *, bucket_value_sum,
                     already_selected_buckets_value_sum=already_selected_buckets_value_sum,
                     already_selected_buckets=already_selected_buckets,
+                    already_selected_buckets_weight_sum=already_selected_buckets_weight_sum,
+                    **kwargs,
                 ):
                     for asset, amount in already_selected_buckets_value_sum.items():
                         bucket_value_sum[asset] += amount
+                    if kwargs.get('bucket_weight_sum') is not None:
+                        kwargs['bucket_weight_sum'] += already_selected_buckets_weight_sum
                     return sufficient_funds(already_selected_buckets + bkts,
-                                            bucket_value_sum=bucket_value_sum)
+                                            bucket_value_sum=bucket_value_sum, **kwargs)
 
                 candidates = self.bucket_candidates_any(bkts_choose_from, sfunds)
                 break
@@ -512,8 +565,11 @@ class CoinChooserRandom(CoinChooserBase):
         candidates = [(already_selected_buckets + c) for c in candidates]
         return [strip_unneeded(c, sufficient_funds) for c in candidates]
 
-    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func, *, target=None):
         candidates = self.bucket_candidates_prefer_confirmed(buckets, sufficient_funds)
+        return self._choose_best_candidate(buckets, candidates, penalty_func)
+
+    def _choose_best_candidate(self, buckets, candidates, penalty_func):
         scored_candidates = [penalty_func(cand) for cand in candidates]
         winner = min(scored_candidates, key=lambda x: x.penalty)
         self.logger.info(f"Total number of buckets: {len(buckets)}")
@@ -580,8 +636,254 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+# random candidates drawn by CoinChooserScalable, in addition to the sorted ones
+SCALABLE_RANDOM_ATTEMPTS = 10
+# max number of steps of the branch-and-bound search for a set of buckets needing no change
+BNB_MAX_TRIES = 100_000
+
+
+def _coin_values(coins: Sequence[PartialTxInput]) -> Dict[Optional[str], int]:
+    value = defaultdict(int)
+    for coin in coins:
+        value[coin.asset] += coin.value_sats(asset_aware=True)
+    return value
+
+
+def _sum_values(buckets: Sequence[Bucket]) -> Dict[Optional[str], int]:
+    value_sum = defaultdict(int)
+    for bucket in buckets:
+        for asset, amount in bucket.value_.items():
+            value_sum[asset] += amount
+    return value_sum
+
+
+class CoinChooserScalable(CoinChooserPrivacy):
+    """Like Privacy, but for wallets with many coins.
+    Coins are grouped and candidates are rated the same way, but candidates
+    are built from coins sorted once per asset, using running sums of their
+    value and size. First, it looks for coins paying the exact amount, so
+    that no change output is needed.
+    """
+
+    def bucketize_coins(self, coins, *, fee_estimator_vb):
+        # The value of a bucket is the value of its coins: sufficient_funds deducts
+        # the fee of all inputs from their sum, so it must not be deducted from the
+        # value of each bucket too (see make_Bucket). effective_value_ keeps it deducted.
+        buckets = super().bucketize_coins(coins, fee_estimator_vb=fee_estimator_vb)
+        return [bkt._replace(value_=_coin_values(bkt.coins)) for bkt in buckets]
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func, *, target=None):
+        if target is None:
+            return super().choose_buckets(buckets, sufficient_funds, penalty_func)
+        candidates = self.bucket_candidates_scalable(buckets, target)
+        # candidates are built from value and weight sums: double-check them
+        candidates = [c for c in candidates if sufficient_funds(c, bucket_value_sum=_sum_values(c))]
+        if not candidates:
+            return super().choose_buckets(buckets, sufficient_funds, penalty_func)
+        return self._choose_best_candidate(buckets, candidates, penalty_func)
+
+    def bucket_candidates_scalable(self, buckets: List[Bucket], target: SelectionTarget) -> List[List[Bucket]]:
+        """Returns a list of bucket sets, preferring confirmed coins
+        the same way as bucket_candidates_prefer_confirmed.
+        """
+        if target.funds_are_sufficient({}, 0, 0):
+            return [[]]
+        conf_buckets = [bkt for bkt in buckets if bkt.min_height > 0]
+        unconf_buckets = [bkt for bkt in buckets if bkt.min_height == 0]
+        other_buckets = [bkt for bkt in buckets if bkt.min_height < 0]
+        already_selected_buckets = []
+        for bkts_choose_from in [conf_buckets, unconf_buckets, other_buckets]:
+            available = already_selected_buckets + bkts_choose_from
+            if target.funds_are_sufficient(_sum_values(available), sum(bkt.weight for bkt in available), len(available)):
+                break
+            already_selected_buckets = available
+        else:
+            raise NotEnoughFunds()
+
+        candidates = []
+        seen = set()
+        for candidate in self._bucket_candidates_from(already_selected_buckets, bkts_choose_from, target):
+            candidate = self._strip_unneeded(candidate, target)
+            key = tuple(sorted(bkt.desc for bkt in candidate))
+            if key not in seen:
+                seen.add(key)
+                candidates.append(candidate)
+        return candidates
+
+    def _bucket_candidates_from(self, selected: List[Bucket], pool: List[Bucket],
+                                target: SelectionTarget) -> List[List[Bucket]]:
+        """Candidates made of all of selected, and some buckets of pool.
+        Assumes that all buckets together have enough funds.
+        """
+        def sort_key(asset):
+            # by decreasing value; desc (the bucket key) makes the order deterministic
+            return lambda bkt: (-bkt.value_.get(asset, 0), bkt.desc)
+
+        # pay for the assets first, with the largest buckets holding them
+        chosen = list(selected)
+        chosen_descs = {bkt.desc for bkt in chosen}
+        value_sum = _sum_values(chosen)
+        weight_sum = sum(bkt.weight for bkt in chosen)
+        for asset in sorted(asset for asset in target.needed if asset is not None):
+            missing = target.needed[asset] - value_sum[asset]
+            if missing <= 0:
+                continue
+            bkts = sorted((bkt for bkt in pool if bkt.value_.get(asset, 0) > 0 and bkt.desc not in chosen_descs),
+                          key=sort_key(asset))
+            prefix_sums = list(itertools.accumulate(bkt.value_[asset] for bkt in bkts))
+            count = bisect.bisect_left(prefix_sums, missing) + 1
+            for bkt in bkts[:count]:
+                chosen.append(bkt)
+                chosen_descs.add(bkt.desc)
+                for a, amount in bkt.value_.items():
+                    value_sum[a] += amount
+                weight_sum += bkt.weight
+
+        candidates = []
+        if target.funds_are_sufficient(value_sum, weight_sum, len(chosen)):
+            candidates.append(chosen)
+        else:
+            # then pay for the rest with base coin, preferably from buckets holding no asset
+            rest = [bkt for bkt in pool if bkt.desc not in chosen_descs and bkt.value_.get(None, 0) > 0]
+            base_only = [bkt for bkt in rest if len(bkt.value_) == 1]
+            for bkts in (base_only, rest):
+                new_candidates = self._base_coin_candidates(chosen, value_sum, weight_sum, bkts, target)
+                if new_candidates:
+                    candidates.extend(new_candidates)
+                    break
+
+        candidates.extend(self._random_candidates(selected, pool, target))
+        return candidates
+
+    def _base_coin_candidates(self, chosen: List[Bucket], value_sum: Mapping[Optional[str], int], weight_sum: int,
+                              bkts: List[Bucket], target: SelectionTarget) -> List[List[Bucket]]:
+        fee_w = target.fee_estimator_w
+        fee_before = fee_w(target.base_weight + weight_sum)
+
+        def funds_added(added_value: int, added_weight: int, num_added: int) -> bool:
+            total = dict(value_sum)
+            total[None] = total.get(None, 0) + added_value
+            return target.funds_are_sufficient(total, weight_sum + added_weight, len(chosen) + num_added)
+
+        # value of each bucket, minus the fee it adds. Sorted in decreasing order.
+        effective = sorted(((bkt.value_[None] - (fee_w(target.base_weight + weight_sum + bkt.weight) - fee_before), bkt)
+                            for bkt in bkts), key=lambda x: (-x[0], x[1].desc))
+        effective = [(value, bkt) for value, bkt in effective if value > 0]
+        if not effective:
+            return []
+        values = [value for value, bkt in effective]
+        prefix_sums = list(itertools.accumulate(values))
+        prefix_weights = list(itertools.accumulate(bkt.weight for value, bkt in effective))
+        prefix_raw = list(itertools.accumulate(bkt.value_[None] for value, bkt in effective))
+        # what the buckets have to pay for, including the fee of the tx without them
+        missing = target.needed.get(None, 0) + fee_before - value_sum.get(None, 0)
+        if not funds_added(prefix_raw[-1], prefix_weights[-1], len(effective)):
+            return []
+        candidates = []
+
+        # largest buckets first
+        count = min(bisect.bisect_left(prefix_sums, missing) + 1, len(effective))
+        while count < len(effective) and not funds_added(prefix_raw[count - 1], prefix_weights[count - 1], count):
+            count += 1
+        while count > 1 and funds_added(prefix_raw[count - 2], prefix_weights[count - 2], count - 1):
+            count -= 1
+        candidates.append(chosen + [bkt for value, bkt in effective[:count]])
+
+        # smallest single bucket that is enough
+        negated = [-value for value in values]
+        i = min(bisect.bisect_right(negated, -missing), len(effective)) - 1
+        while i >= 0 and not funds_added(effective[i][1].value_[None], effective[i][1].weight, 1):
+            i -= 1
+        if i >= 0:
+            candidates.append(chosen + [effective[i][1]])
+
+        # buckets paying the amount without change: what they pay in excess of
+        # missing (i.e. the change) is not worth a change output
+        if target.cost_of_change > 0:
+            selection = self._branch_and_bound(values, missing, missing + target.cost_of_change)
+            if selection is not None:
+                candidates.insert(0, chosen + [effective[i][1] for i in selection])
+        return candidates
+
+    @classmethod
+    def _branch_and_bound(cls, values: Sequence[int], lower: int, upper: int) -> Optional[List[int]]:
+        """Depth-first search for indexes of values summing to at least lower,
+        and at most upper. Returns the selection with the smallest sum, or None.
+        values must be sorted in decreasing order.
+        """
+        remaining = sum(values)
+        if remaining < lower:
+            return None
+        best_selection, best_sum = None, None
+        included = []  # type: List[bool]  # decision for values[:len(included)]
+        current = 0
+        for _ in range(BNB_MAX_TRIES):
+            if current + remaining < lower or current > upper:
+                backtrack = True
+            elif current >= lower:
+                if best_sum is None or current < best_sum:
+                    best_sum = current
+                    best_selection = [i for i, inc in enumerate(included) if inc]
+                backtrack = True
+            else:
+                backtrack = False
+            if backtrack:
+                # undo trailing exclusions, then exclude the last included value
+                while included and not included[-1]:
+                    included.pop()
+                    remaining += values[len(included)]
+                if not included:
+                    break
+                included[-1] = False
+                current -= values[len(included) - 1]
+            else:
+                depth = len(included)
+                remaining -= values[depth]
+                current += values[depth]
+                included.append(True)
+        return best_selection
+
+    def _random_candidates(self, selected: List[Bucket], pool: List[Bucket],
+                           target: SelectionTarget) -> List[List[Bucket]]:
+        candidates = []
+        permutation = list(range(len(pool)))
+        for _ in range(SCALABLE_RANDOM_ATTEMPTS):
+            self.p.shuffle(permutation)
+            bkts = list(selected)
+            value_sum = _sum_values(bkts)
+            weight_sum = sum(bkt.weight for bkt in bkts)
+            for index in permutation:
+                bucket = pool[index]
+                bkts.append(bucket)
+                for asset, amount in bucket.value_.items():
+                    value_sum[asset] += amount
+                weight_sum += bucket.weight
+                if target.funds_are_sufficient(value_sum, weight_sum, len(bkts)):
+                    candidates.append(bkts)
+                    break
+        return candidates
+
+    @classmethod
+    def _strip_unneeded(cls, bkts: List[Bucket], target: SelectionTarget) -> List[Bucket]:
+        """Removes buckets that are not needed, smallest first."""
+        value_sum = _sum_values(bkts)
+        weight_sum = sum(bkt.weight for bkt in bkts)
+        kept = set(range(len(bkts)))
+        for i in sorted(kept, key=lambda i: (bkts[i].value_.get(None, 0), bkts[i].desc)):
+            bucket = bkts[i]
+            value_without = dict(value_sum)
+            for asset, amount in bucket.value_.items():
+                value_without[asset] -= amount
+            if target.funds_are_sufficient(value_without, weight_sum - bucket.weight, len(kept) - 1):
+                kept.remove(i)
+                value_sum = value_without
+                weight_sum -= bucket.weight
+        return [bkt for i, bkt in enumerate(bkts) if i in kept]
+
+
 COIN_CHOOSERS = {
     'Privacy': CoinChooserPrivacy,
+    'Scalable': CoinChooserScalable,
 }  # type: Mapping[str, Type[CoinChooserBase]]
 
 def get_name(config: 'SimpleConfig') -> str:
@@ -303,6 +303,12 @@ class Commands:
         wallet.save_db()
         return {'password':wallet.has_password()}
 
+    @command('w')
+    async def convert_to_sqlite(self, wallet: Abstract_Wallet = None):
+        """Move the transactions and history of the wallet to an sqlite database,
+        next to the wallet file. Note that this database is not encrypted."""
+        return wallet.db.convert_to_sqlite()
+
     @command('w')
     async def get(self, key, wallet: Abstract_Wallet = None):
         """Return item from wallet storage"""
@@ -586,6 +592,14 @@ class Commands:
         """Return the list of known servers (candidates for connecting)."""
         return self.network.get_servers()
 
+    @command('n')
+    async def export_header_snapshot(self, path):
+        """Export the headers of the best chain into a binary snapshot file.
+        Other nodes can start from it by setting the 'headers_snapshot' config variable,
+        and 'headers_snapshot_sha256d' to the returned checksum (required)."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.network.export_header_snapshot, path)
+
     @command('')
     async def version(self):
         """Return the version of Electrum."""
@@ -48,6 +48,7 @@ from .util import EventListener, event_listener
 from .wallet import Wallet, Abstract_Wallet
 from .storage import WalletStorage
 from .wallet_db import WalletDB
+from .wallet_sqlite import get_sqlite_path
 from .ipfs_db import IPFSDB
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
@@ -542,6 +543,10 @@ class Daemon(Logger):
         self.stop_wallet(path)
         if os.path.exists(path):
             os.unlink(path)
+            # the sqlite database of the wallet, if it has one
+            sqlite_path = get_sqlite_path(path)
+            if os.path.exists(sqlite_path):
+                os.unlink(sqlite_path)
             return True
         return False
 
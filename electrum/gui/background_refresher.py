@@ -0,0 +1,63 @@
+# Prepares the data of the lists of the GUI on a background thread.
+# This does not depend on any GUI toolkit: the thread is e.g. a TaskThread
+# of the Qt GUI.
+
+from typing import Any, Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from electrum.gui.qt.util import TaskThread
+
+
+class RefreshCancelled(Exception):
+    pass
+
+
+class BackgroundRefresher:
+    """Prepares the data of a list on a TaskThread, off the GUI thread.
+
+    request(compute, apply): compute(check_cancelled) runs on the thread and
+    returns a snapshot of the rows to show, which must not be modified
+    afterwards; apply(snapshot) is then called in the GUI thread.
+    Only the latest request of a refresher counts: earlier ones are skipped if
+    they have not started yet, stop at their next check_cancelled() call if
+    they have, and their results are dropped.
+    """
+
+    def __init__(self, thread: 'TaskThread'):
+        self.thread = thread
+        self._generation = 0
+        self._num_pending = 0
+
+    def is_busy(self) -> bool:
+        """Whether a requested snapshot has not been applied yet."""
+        return self._num_pending > 0
+
+    def cancel(self) -> None:
+        self._generation += 1
+
+    def request(self, compute: Callable[[Callable[[], None]], Any], apply: Callable[[Any], None]) -> None:
+        self._generation += 1
+        generation = self._generation
+
+        def check_cancelled():
+            if generation != self._generation:
+                raise RefreshCancelled()
+
+        def task():
+            check_cancelled()
+            return compute(check_cancelled)
+
+        def on_done():
+            self._num_pending -= 1
+
+        def on_success(snapshot):
+            if generation == self._generation:
+                apply(snapshot)
+
+        def on_error(exc_info):
+            if not isinstance(exc_info[1], RefreshCancelled):
+                self.thread.on_error(exc_info)
+
+        # on_done is only called for a queued task (not if the thread is stopping)
+        if self.thread.add(task, on_success=on_success, on_done=on_done, on_error=on_error, cancel=self.cancel):
+            self._num_pending += 1
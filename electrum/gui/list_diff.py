@@ -0,0 +1,98 @@
+# Computes which rows of a list change, so that the lists of the GUI can be
+# updated in place instead of being rebuilt. These functions do not depend
+# on any GUI toolkit.
+
+from typing import (Any, Hashable, Iterable, List, Mapping, NamedTuple, Optional,
+                    Sequence, Tuple, TYPE_CHECKING, FrozenSet)
+
+if TYPE_CHECKING:
+    from electrum.address_synchronizer import AdbChanges
+
+
+def group_consecutive(rows: Iterable[int]) -> List[Tuple[int, int]]:
+    """Groups increasing row numbers into (first, last) ranges."""
+    ranges = []
+    for row in rows:
+        if ranges and ranges[-1][1] == row - 1:
+            ranges[-1] = (ranges[-1][0], row)
+        else:
+            ranges.append((row, row))
+    return ranges
+
+
+class OrderedDiff(NamedTuple):
+    removed: List[Tuple[int, int]]  # row ranges of the old list, bottom first
+    inserted: List[Tuple[int, int]]  # row ranges of the new list, top first
+    changed: List[Tuple[int, int]]  # row ranges of the new list, of items that differ
+
+
+def diff_ordered(old: Mapping[Hashable, Any], new: Mapping[Hashable, Any]) -> Optional[OrderedDiff]:
+    """Compares two lists of items, given as ordered mappings key -> item.
+    Removing the rows of diff.removed from the old list, then inserting those
+    of diff.inserted, in that order, gives the new list.
+    Returns None if the keys of both lists are not in the same order
+    (e.g. after a reorg), in which case the list has to be rebuilt.
+    """
+    old_keys = list(old)
+    new_keys = list(new)
+    if [k for k in old_keys if k in new] != [k for k in new_keys if k in old]:
+        return None
+    return OrderedDiff(
+        removed=group_consecutive(i for i, k in enumerate(old_keys) if k not in new)[::-1],
+        inserted=group_consecutive(i for i, k in enumerate(new_keys) if k not in old),
+        changed=group_consecutive(i for i, k in enumerate(new_keys) if k in old and old[k] != new[k]),
+    )
+
+
+class KeyedDiff(NamedTuple):
+    removed: List[int]  # rows to remove, bottom first
+    updated: List[Tuple[Hashable, int, Any]]  # (key, row, item) of the rows to update
+    added: List[Tuple[Hashable, Any]]  # (key, item) of the rows to add
+
+
+def diff_keyed(rows: Mapping[Hashable, int], items: Mapping[Hashable, Optional[Any]]) -> KeyedDiff:
+    """Compares the rows of a list, given as key -> row, with the new items
+    of the keys that might have changed. An item is None if its key must not
+    be shown anymore. Keys not in items are left as they are.
+    """
+    removed = []
+    updated = []
+    added = []
+    for key, item in items.items():
+        row = rows.get(key)
+        if item is None:
+            if row is not None:
+                removed.append(row)
+        elif row is not None:
+            updated.append((key, row, item))
+        else:
+            added.append((key, item))
+    removed.sort(reverse=True)
+    return KeyedDiff(removed, updated, added)
+
+
+def get_row_to_insert_descending(values: Sequence, value) -> int:
+    """The row at which to insert value in a list sorted in descending
+    order, after the rows with the same value.
+    """
+    for row, v in enumerate(values):
+        if v < value:
+            return row
+    return len(values)
+
+
+class AffectedRows(NamedTuple):
+    txids: FrozenSet[str]  # txs whose history rows and coins might have changed
+    addresses: FrozenSet[str]  # addresses whose rows and coins might have changed
+
+    def is_empty(self) -> bool:
+        return not self.txids and not self.addresses
+
+
+def get_affected_rows(changes: 'AdbChanges') -> Optional[AffectedRows]:
+    """The rows of the history, address and coin lists that changes might
+    have affected. None if all of them might have changed.
+    """
+    if changes.everything:
+        return None
+    return AffectedRows(txids=frozenset(changes.txids), addresses=frozenset(changes.addresses))
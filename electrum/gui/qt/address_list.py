@@ -25,7 +25,8 @@
 
 import enum
 from enum import IntEnum
-from typing import TYPE_CHECKING
+from functools import partial
+from typing import TYPE_CHECKING, Iterable, List, NamedTuple, Optional, Any, Sequence, Tuple, Set
 
 from PyQt5.QtCore import Qt, QPersistentModelIndex, QModelIndex
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QFont
@@ -37,8 +38,9 @@ from electrum.plugin import run_hook
 from electrum.bitcoin import is_address, is_b58_address, b58_address_to_hash160
 from electrum.wallet import InternalAddressCorruption
 from electrum.simple_config import SimpleConfig
+from electrum.gui.list_diff import diff_keyed
 
-from .util import MONOSPACE_FONT, ColorScheme, webopen
+from .util import MONOSPACE_FONT, ColorScheme, webopen, BackgroundRefresher
 from .my_treeview import MyTreeView, MySortModel
 
 if TYPE_CHECKING:
@@ -75,6 +77,20 @@ class AddressTypeFilter(IntEnum):
         }[self]
 
 
+class AddressRowData(NamedTuple):
+    is_change: bool
+    address_index: Any
+    address_path_str: Optional[str]
+    label: str
+    num_txs: int
+    is_used: bool
+    balance: int
+    base_coin_balance: int
+    num_assets: int
+    tag_count: int
+    is_frozen: bool
+
+
 class AddressList(MyTreeView):
 
     class Columns(MyTreeView.BaseColumnsEnum):
@@ -116,6 +132,8 @@ class AddressList(MyTreeView):
         self.proxy = MySortModel(self, sort_role=self.ROLE_SORT_ORDER)
         self.proxy.setSourceModel(self.std_model)
         self.setModel(self.proxy)
+        self.refresher = BackgroundRefresher(self.main_window.refresh_thread)
+        self.addresses_beyond_gap_limit = set()
         self.update()
         self.sortByColumn(self.Columns.TYPE, Qt.AscendingOrder)
         if self.config:
@@ -174,64 +192,41 @@ class AddressList(MyTreeView):
         self.show_used = AddressUsageStateFilter(state)
         self.update()
 
-    @profiler
     def update(self):
         if self.maybe_defer_update():
             return
-        current_address = self.get_role_data_for_current_item(col=0, role=self.ROLE_ADDRESS_STR)
         if self.show_change == AddressTypeFilter.RECEIVING:
             addr_list = self.wallet.get_receiving_addresses()
         elif self.show_change == AddressTypeFilter.CHANGE:
             addr_list = self.wallet.get_change_addresses()
         else:
             addr_list = self.wallet.get_addresses()
+        self.refresher.request(partial(self.get_rows_snapshot, addr_list), self.apply_rows_snapshot)
+
+    @profiler
+    def get_rows_snapshot(self, addr_list: Sequence[str], check_cancelled) -> Tuple[List[Tuple[str, AddressRowData]], Set[str]]:
+        """Runs on the refresh thread. Returns the rows to show, and the addresses beyond the gap limit."""
+        rows = []
+        for address in addr_list:
+            check_cancelled()
+            data = self.get_row_data(address)
+            if self.should_show_row(data):
+                rows.append((address, data))
+        return rows, self.wallet.get_all_known_addresses_beyond_gap_limit()
+
+    @profiler
+    def apply_rows_snapshot(self, snapshot: Tuple[List[Tuple[str, AddressRowData]], Set[str]]):
+        rows, self.addresses_beyond_gap_limit = snapshot
+        current_address = self.get_role_data_for_current_item(col=0, role=self.ROLE_ADDRESS_STR)
         self.proxy.setDynamicSortFilter(False)  # temp. disable re-sorting after every change
         self.std_model.clear()
         self.refresh_headers()
-        fx = self.main_window.fx
         set_address = None
-        num_shown = 0
-        self.addresses_beyond_gap_limit = self.wallet.get_all_known_addresses_beyond_gap_limit()
-        for address in addr_list:
-            c, u, x = self.wallet.get_addr_balance(address)
-            balance = c + u + x
-            is_used_and_empty = self.wallet.adb.is_used(address) and balance == 0
-            if self.show_used == AddressUsageStateFilter.UNUSED and (balance or is_used_and_empty):
-                continue
-            if self.show_used == AddressUsageStateFilter.FUNDED and balance == 0:
-                continue
-            if self.show_used == AddressUsageStateFilter.USED_AND_EMPTY and not is_used_and_empty:
-                continue
-            if self.show_used == AddressUsageStateFilter.FUNDED_OR_UNUSED and is_used_and_empty:
-                continue
-            num_shown += 1
-            labels = [""] * len(self.Columns)
-            labels[self.Columns.ADDRESS] = address
-            address_item = [QStandardItem(e) for e in labels]
-            # align text and set fonts
-            for i, item in enumerate(address_item):
-                item.setTextAlignment(Qt.AlignVCenter)
-                if i not in (self.Columns.TYPE, self.Columns.LABEL):
-                    item.setFont(QFont(MONOSPACE_FONT))
-            self.set_editability(address_item)
-            address_item[self.Columns.FIAT_BALANCE].setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-            # setup column 0
-            if self.wallet.is_change(address):
-                address_item[self.Columns.TYPE].setText(_('change'))
-                address_item[self.Columns.TYPE].setBackground(ColorScheme.YELLOW.as_color(True))
-            else:
-                address_item[self.Columns.TYPE].setText(_('receiving'))
-                address_item[self.Columns.TYPE].setBackground(ColorScheme.GREEN.as_color(True))
-            address_item[0].setData(address, self.ROLE_ADDRESS_STR)
-            address_path = self.wallet.get_address_index(address)
-            address_item[self.Columns.TYPE].setData(address_path, self.ROLE_SORT_ORDER)
-            address_path_str = self.wallet.get_address_path_str(address)
-            if address_path_str is not None:
-                address_item[self.Columns.TYPE].setToolTip(address_path_str)
+        for address, data in rows:
             # add item
             count = self.std_model.rowCount()
-            self.std_model.insertRow(count, address_item)
-            self.refresh_row(address, count)
+            self.std_model.insertRow(count, self.create_row(address, data))
+            self.set_row_data(address, count, data)
             address_idx = self.std_model.index(count, self.Columns.LABEL)
             if address == current_address:
                 set_address = QPersistentModelIndex(address_idx)
@@ -244,19 +239,108 @@ class AddressList(MyTreeView):
         self.filter()
         self.proxy.setDynamicSortFilter(True)
         # update counter
-        self.num_addr_label.setText(_("{} addresses").format(num_shown))
+        self.num_addr_label.setText(_("{} addresses").format(len(rows)))
+
+    def update_rows(self, addresses: Iterable[str]):
+        """Updates only the rows of the given addresses, e.g. those touched by a
+        new transaction. Rows are added or removed as addresses start or stop
+        passing the filters.
+        """
+        if self._pending_update or self.refresher.is_busy():
+            # a full update is deferred or on its way; it would overwrite these rows
+            self.update()
+            return
+        if not addresses or self.maybe_defer_update():
+            return
+        items = {}
+        for address in addresses:
+            data = self.get_row_data(address) if self.wallet.is_mine(address) else None
+            items[address] = data if data is not None and self.should_show_row(data) else None
+        diff = diff_keyed(self.get_rows_by_key(), items)
+        self.proxy.setDynamicSortFilter(False)
+        for address, row, data in diff.updated:
+            self.set_row_data(address, row, data)
+        for address, data in diff.added:
+            count = self.std_model.rowCount()
+            self.std_model.insertRow(count, self.create_row(address, data))
+            self.set_row_data(address, count, data)
+        # added rows are at the bottom, removed ones refer to the rows before
+        for row in diff.removed:
+            self.std_model.removeRow(row)
+        if diff.added and self.current_filter:
+            self.filter()
+        self.proxy.setDynamicSortFilter(True)
+        self.num_addr_label.setText(_("{} addresses").format(self.std_model.rowCount()))
 
-    def refresh_row(self, key, row):
-        assert row is not None
-        address = key
-        label = self.wallet.get_label_for_address(address)
-        num = self.wallet.adb.get_address_history_len(address)
+    def get_row_data(self, address: str) -> AddressRowData:
+        """The wallet data shown in the row of address. Can be called from any thread."""
+        c, u, x = self.wallet.get_addr_balance(address)
         balance_mapping = self.wallet.get_addr_balance(address, asset_aware=True)
         tag_count = 0
         if is_b58_address(address):
             _, h160 = b58_address_to_hash160(address)
             tag_count = len(self.wallet.adb.get_tags_for_h160(h160.hex()))
-        base_coin_balance = sum(balance_mapping.get(None, [0]))
+        return AddressRowData(
+            is_change=self.wallet.is_change(address),
+            address_index=self.wallet.get_address_index(address),
+            address_path_str=self.wallet.get_address_path_str(address),
+            label=self.wallet.get_label_for_address(address),
+            num_txs=self.wallet.adb.get_address_history_len(address),
+            is_used=self.wallet.adb.is_used(address),
+            balance=c + u + x,
+            base_coin_balance=sum(balance_mapping.get(None, [0])),
+            num_assets=len([key for key, value in balance_mapping.items() if key and sum(value) > 0]),
+            tag_count=tag_count,
+            is_frozen=self.wallet.is_frozen_address(address),
+        )
+
+    def should_show_row(self, data: AddressRowData) -> bool:
+        if self.show_change == AddressTypeFilter.RECEIVING and data.is_change:
+            return False
+        if self.show_change == AddressTypeFilter.CHANGE and not data.is_change:
+            return False
+        balance = data.balance
+        is_used_and_empty = data.is_used and balance == 0
+        if self.show_used == AddressUsageStateFilter.UNUSED and (balance or is_used_and_empty):
+            return False
+        if self.show_used == AddressUsageStateFilter.FUNDED and balance == 0:
+            return False
+        if self.show_used == AddressUsageStateFilter.USED_AND_EMPTY and not is_used_and_empty:
+            return False
+        if self.show_used == AddressUsageStateFilter.FUNDED_OR_UNUSED and is_used_and_empty:
+            return False
+        return True
+
+    def create_row(self, address: str, data: AddressRowData) -> List[QStandardItem]:
+        labels = [""] * len(self.Columns)
+        labels[self.Columns.ADDRESS] = address
+        address_item = [QStandardItem(e) for e in labels]
+        # align text and set fonts
+        for i, item in enumerate(address_item):
+            item.setTextAlignment(Qt.AlignVCenter)
+            if i not in (self.Columns.TYPE, self.Columns.LABEL):
+                item.setFont(QFont(MONOSPACE_FONT))
+        self.set_editability(address_item)
+        address_item[self.Columns.FIAT_BALANCE].setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+        # setup column 0
+        if data.is_change:
+            address_item[self.Columns.TYPE].setText(_('change'))
+            address_item[self.Columns.TYPE].setBackground(ColorScheme.YELLOW.as_color(True))
+        else:
+            address_item[self.Columns.TYPE].setText(_('receiving'))
+            address_item[self.Columns.TYPE].setBackground(ColorScheme.GREEN.as_color(True))
+        address_item[0].setData(address, self.ROLE_ADDRESS_STR)
+        address_item[self.Columns.TYPE].setData(data.address_index, self.ROLE_SORT_ORDER)
+        if data.address_path_str is not None:
+            address_item[self.Columns.TYPE].setToolTip(data.address_path_str)
+        return address_item
+
+    def refresh_row(self, key, row):
+        assert row is not None
+        self.set_row_data(key, row, self.get_row_data(key))
+
+    def set_row_data(self, address: str, row: int, data: AddressRowData):
+        base_coin_balance = data.base_coin_balance
         balance_text = self.main_window.format_amount(base_coin_balance, whitespaces=True)
         balance_text_nots = self.main_window.format_amount(base_coin_balance, whitespaces=False, add_thousands_sep=False)
         # create item
@@ -269,17 +353,17 @@ class AddressList(MyTreeView):
             fiat_balance_str = ''
             fiat_balance_str_nots = ''
         address_item = [self.std_model.item(row, col) for col in self.Columns]
-        address_item[self.Columns.LABEL].setText(label)
+        address_item[self.Columns.LABEL].setText(data.label)
         address_item[self.Columns.COIN_BALANCE].setText(balance_text)
         address_item[self.Columns.COIN_BALANCE].setData(base_coin_balance, self.ROLE_SORT_ORDER)
         address_item[self.Columns.COIN_BALANCE].setData(balance_text_nots, self.ROLE_CLIPBOARD_DATA)
-        address_item[self.Columns.ASSET_COUNT].setText(str(len([key for key, value in balance_mapping.items() if key and sum(value) > 0])))
-        address_item[self.Columns.TAG_COUNT].setText(str(tag_count))
+        address_item[self.Columns.ASSET_COUNT].setText(str(data.num_assets))
+        address_item[self.Columns.TAG_COUNT].setText(str(data.tag_count))
         address_item[self.Columns.FIAT_BALANCE].setText(fiat_balance_str)
         address_item[self.Columns.FIAT_BALANCE].setData(base_coin_balance, self.ROLE_SORT_ORDER)
         address_item[self.Columns.FIAT_BALANCE].setData(fiat_balance_str_nots, self.ROLE_CLIPBOARD_DATA)
-        address_item[self.Columns.NUM_TXS].setText("%d"%num)
-        c = ColorScheme.BLUE.as_color(True) if self.wallet.is_frozen_address(address) else self._default_bg_brush
+        address_item[self.Columns.NUM_TXS].setText("%d"%data.num_txs)
+        c = ColorScheme.BLUE.as_color(True) if data.is_frozen else self._default_bg_brush
         address_item[self.Columns.ADDRESS].setBackground(c)
         if address in self.addresses_beyond_gap_limit:
             address_item[self.Columns.ADDRESS].setBackground(ColorScheme.RED.as_color(True))
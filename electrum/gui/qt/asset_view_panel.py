@@ -14,7 +14,7 @@ from electrum.address_synchronizer import METADATA_UNCONFIRMED, METADATA_UNVERIF
 from electrum.logging import Logger
 
 from .util import HelpLabel, ColorScheme, HelpButton, AutoResizingTextEdit
-from .util import QHSeperationLine, read_QIcon, MONOSPACE_FONT, IPFSViewer, EnterButton
+from .util import QHSeperationLine, read_QIcon, MONOSPACE_FONT, IPFSViewer, EnterButton, BackgroundRefresher
 from .my_treeview import MyTreeView
 from .asset_qualifier_tag_panel import TaggedAddressList
 
@@ -49,6 +49,7 @@ class AssetList(MyTreeView):
         self.setSortingEnabled(True)
         self.last_selected_asset = None
         self.current_assets = []
+        self.refresher = BackgroundRefresher(self.main_window.refresh_thread)
 
         def selectionChange(new, old):
             rows = [x.row() for x in new.indexes()]
@@ -61,11 +62,21 @@ class AssetList(MyTreeView):
 
         self.selectionModel().selectionChanged.connect(selectionChange)
     
-    @profiler(min_threshold=0.05)
     def update(self):
         # not calling maybe_defer_update() as it interferes with coincontrol status bar
-        watching_assets = [asset for asset, balance in self.wallet.get_balance(asset_aware=True).items() if asset and sum(balance) > 0 and not self.wallet.is_asset_in_blacklist(asset)]
+        self.refresher.request(self.get_assets_snapshot, self.apply_assets_snapshot)
+
+    @profiler(min_threshold=0.05)
+    def get_assets_snapshot(self, check_cancelled):
+        """Runs on the refresh thread. Returns the assets to show with their metadata, and our balances."""
+        balances = self.wallet.get_balance(asset_aware=True)
+        watching_assets = [asset for asset, balance in balances.items() if asset and sum(balance) > 0 and not self.wallet.is_asset_in_blacklist(asset)]
+        check_cancelled()
         new_assets = sorted([(asset, (metadata[0].sats_in_circulation, metadata[1]) if ((metadata := self.wallet.adb.get_asset_metadata(asset)) is not None) else None) for asset in watching_assets], key=lambda x: x[0])
+        return new_assets, balances
+
+    def apply_assets_snapshot(self, snapshot):
+        new_assets, balances = snapshot
         if self.current_assets == new_assets:
             return
         self.parent.logger.info('refreshing asset view')
@@ -74,24 +85,25 @@ class AssetList(MyTreeView):
         for idx, (asset, data) in enumerate(new_assets):
             labels = [""] * len(self.Columns)
             labels[self.Columns.ASSET] = asset
-            if self.wallet.do_we_own_this_asset(asset):
-                amount = sum(self.wallet.get_balance(asset_aware=True)[asset])
-                labels[self.Columns.BALANCE] = self.main_window.config.format_amount(amount, whitespaces=True, precision=8)                
+            is_ours = asset in balances and sum(balances[asset]) > 0
+            if is_ours:
+                amount = sum(balances[asset])
+                labels[self.Columns.BALANCE] = self.main_window.config.format_amount(amount, whitespaces=True, precision=8)
             asset_item = [QStandardItem(x) for x in labels]
-            if not self.wallet.do_we_own_this_asset(asset):
+            if not is_ours:
                 asset_item[self.Columns.BALANCE] = QStandardItem(read_QIcon('eye1.png'), labels[self.Columns.BALANCE])
             self.set_editability(asset_item)
             asset_item[self.Columns.ASSET].setData(asset, self.ROLE_ASSET_STR)
             asset_item[self.Columns.ASSET].setFont(QFont(MONOSPACE_FONT))
             asset_item[self.Columns.BALANCE].setFont(QFont(MONOSPACE_FONT))
             self.model().insertRow(idx, asset_item)
-            self.refresh_row(asset, data, idx)
+            self.refresh_row(asset, data, idx, is_ours=is_ours)
             if asset == self.last_selected_asset:
                 self.selectionModel().select(self.model().createIndex(idx, 0), QItemSelectionModel.Rows | QItemSelectionModel.SelectCurrent)
         self.current_assets = new_assets
         self.filter()
 
-    def refresh_row(self, key, data, row):
+    def refresh_row(self, key, data, row, *, is_ours=None):
         assert row is not None
         asset_item = [self.std_model.item(row, col) for col in self.Columns]
         
@@ -108,7 +120,9 @@ class AssetList(MyTreeView):
             elif kind == METADATA_UNVERIFIED:
                 tooltip += ' ' + _('(this metadata was not able to be verified)')
 
-        if not self.wallet.do_we_own_this_asset(key):
+        if is_ours is None:
+            is_ours = self.wallet.do_we_own_this_asset(key)
+        if not is_ours:
             tooltip += ' ' + _('(This is a watch-only asset)')            
 
         for col in asset_item:
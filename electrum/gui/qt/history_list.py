@@ -28,10 +28,11 @@ import sys
 import time
 import datetime
 from datetime import date
-from typing import TYPE_CHECKING, Tuple, Dict, Any
+from typing import TYPE_CHECKING, Tuple, Dict, Any, List
 import threading
 import enum
 from decimal import Decimal
+from functools import partial
 from collections import defaultdict
 
 from PyQt5.QtGui import QFont, QBrush, QColor
@@ -42,6 +43,7 @@ from PyQt5.QtWidgets import (QMenu, QHeaderView, QLabel, QMessageBox,
                              QGridLayout)
 
 from electrum.gui import messages
+from electrum.gui.list_diff import diff_ordered, group_consecutive
 from electrum.asset import ASSET_OWNER_IDENTIFIER
 from electrum.address_synchronizer import TX_HEIGHT_LOCAL, TX_HEIGHT_FUTURE
 from electrum.i18n import _
@@ -54,7 +56,7 @@ from electrum.simple_config import SimpleConfig
 from .custom_model import CustomNode, CustomModel
 from .util import (read_QIcon, MONOSPACE_FONT, Buttons, CancelButton, OkButton,
                    filename_field, AcceptFileDragDrop, WindowModalDialog,
-                   CloseButton, webopen, WWLabel, ColorScheme)
+                   CloseButton, webopen, WWLabel, ColorScheme, BackgroundRefresher)
 from .my_treeview import MyTreeView
 
 if TYPE_CHECKING:
@@ -261,7 +263,10 @@ class HistoryModel(CustomModel, Logger):
         self.window = window
         self.view = None  # type: HistoryList
         self.transactions = OrderedDictWithIndex()
+        # the status of a tx, shared by its rows (one per asset it moves)
         self.tx_status_cache = {}  # type: Dict[str, Tuple[int, str]]
+        self._rows_by_txid: Dict[str, List[int]] = {}
+        self.refresher = BackgroundRefresher(window.refresh_thread)
 
     def set_view(self, history_list: 'HistoryList'):
         # FIXME HistoryModel and HistoryList mutually depend on each other.
@@ -295,44 +300,81 @@ class HistoryModel(CustomModel, Logger):
     def should_show_capital_gains(self):
         return self.should_show_fiat() and self.window.config.FX_HISTORY_RATES_CAPITAL_GAINS
 
-    @profiler
     def refresh(self, reason: str):
         self.logger.info(f"refreshing... reason: {reason}")
         assert self.window.gui_thread == threading.current_thread(), 'must be called from GUI thread'
         assert self.view, 'view not set'
         if self.view.maybe_defer_update():
             return
-        selected = self.view.selectionModel().currentIndex()
-        selected_row = None
-        if selected:
-            selected_row = selected.row()
         fx = self.window.fx
         if fx: fx.history_used_spot = False
-        wallet = self.window.wallet
         self.set_visibility_of_columns()
-        transactions = wallet.get_full_history(
-            self.window.fx,
+        compute = partial(
+            self.get_history_snapshot,
             onchain_domain=self.get_domain(),
             include_lightning=self.should_include_lightning_payments(),
             include_fiat=self.should_show_fiat(),
         )
-        
+        self.refresher.request(compute, self.apply_history_snapshot)
+
+    @profiler
+    def get_history_snapshot(self, check_cancelled, **kwargs) -> Tuple[OrderedDictWithIndex, Dict]:
+        """Runs on the refresh thread. Returns the history items, and their status."""
+        wallet = self.window.wallet
+        transactions = wallet.get_full_history(self.window.fx, **kwargs)
+        check_cancelled()
+        # compute the running balance of each asset
+        balance = defaultdict(int)
+        tx_statuses = {}
+        for key, tx_item in transactions.items():
+            asset = tx_item.get('asset', None)
+            balance[asset] += tx_item['value'].value
+            tx_item['balance'] = Satoshis(balance[asset])
+            txid = tx_item['txid']
+            if not tx_item.get('lightning', False) and txid not in tx_statuses:
+                tx_mined_info = self._tx_mined_info_from_tx_item(tx_item)
+                tx_statuses[txid] = wallet.get_tx_status(txid, tx_mined_info)
+        return transactions, tx_statuses
+
+    @profiler
+    def apply_history_snapshot(self, snapshot: Tuple[OrderedDictWithIndex, Dict]):
+        transactions, tx_statuses = snapshot
         if transactions == self.transactions:
             return
+        selected = self.view.selectionModel().currentIndex()
+        selected_row = None
+        if selected:
+            selected_row = selected.row()
+        self.tx_status_cache = tx_statuses
+        if not self._update_rows(transactions):
+            self._reset_rows(transactions)
+            if selected_row:
+                self.view.selectionModel().select(self.createIndex(selected_row, 0), QItemSelectionModel.Rows | QItemSelectionModel.SelectCurrent)
+        self._rows_by_txid = defaultdict(list)
+        for row, (txid, asset) in enumerate(self.transactions):
+            self._rows_by_txid[txid].append(row)
+        self.view.filter()
+        # update time filter
+        if not self.view.years and self.transactions:
+            start_date = date.today()
+            end_date = date.today()
+            if len(self.transactions) > 0:
+                start_date = self.transactions.value_from_pos(0).get('date') or start_date
+                end_date = self.transactions.value_from_pos(len(self.transactions) - 1).get('date') or end_date
+            self.view.years = [str(i) for i in range(start_date.year, end_date.year + 1)]
+            self.view.period_combo.insertItems(1, self.view.years)
+        # update counter
+        num_tx = len(set(v['txid'] for v in self.transactions.values()))
+        if self.view:
+            self.view.num_tx_label.setText(_("{} transactions").format(num_tx))
 
-        #for transaction in transactions.values():
-        #    print(transaction['txid'])
-        #    print(transaction['asset'])
-        #    print(transaction['bc_value'])
-        #    print('==========')
-        
+    def _reset_rows(self, transactions: OrderedDictWithIndex):
         old_length = self._root.childCount()
         if old_length != 0:
             self.beginRemoveRows(QModelIndex(), 0, old_length)
             self.transactions.clear()
             self._root = HistoryNode(self, None)
             self.endRemoveRows()
-        parents = {}
         for tx_item in transactions.values():
             node = HistoryNode(self, tx_item)
             self._root.addChild(node)
@@ -340,42 +382,43 @@ class HistoryModel(CustomModel, Logger):
                 child_node = HistoryNode(self, child_item)
                 # add child to parent
                 node.addChild(child_node)
-
-        # compute balance once all children have beed added
-        balance = defaultdict(int)
-        for node in self._root._children:
-            asset = node._data.get('asset', None)
-            sats = node._data['value']
-            balance[asset] += sats.value
-            node._data['balance'] = Satoshis(balance[asset])
-
         new_length = self._root.childCount()
         self.beginInsertRows(QModelIndex(), 0, new_length-1)
         self.transactions = transactions
         self.endInsertRows()
 
-        if selected_row:
-            self.view.selectionModel().select(self.createIndex(selected_row, 0), QItemSelectionModel.Rows | QItemSelectionModel.SelectCurrent)
-        self.view.filter()
-        # update time filter
-        if not self.view.years and self.transactions:
-            start_date = date.today()
-            end_date = date.today()
-            if len(self.transactions) > 0:
-                start_date = self.transactions.value_from_pos(0).get('date') or start_date
-                end_date = self.transactions.value_from_pos(len(self.transactions) - 1).get('date') or end_date
-            self.view.years = [str(i) for i in range(start_date.year, end_date.year + 1)]
-            self.view.period_combo.insertItems(1, self.view.years)
-        # update tx_status_cache
-        self.tx_status_cache.clear()
-        for (txid, asset), tx_item in self.transactions.items():
-            if not tx_item.get('lightning', False):
-                tx_mined_info = self._tx_mined_info_from_tx_item(tx_item)
-                self.tx_status_cache[(txid, asset)] = self.window.wallet.get_tx_status(txid, tx_mined_info)
-        # update counter
-        num_tx = len(set(v['txid'] for v in self.transactions.values()))
-        if self.view:
-            self.view.num_tx_label.setText(_("{} transactions").format(num_tx))
+    def _update_rows(self, transactions: OrderedDictWithIndex) -> bool:
+        """Turns the current rows into transactions, removing, inserting and
+        updating only the rows that differ. Returns False if rows were
+        reordered (e.g. by a reorg), in which case the model needs to be reset.
+        """
+        if any(tx_item.get('children') for tx_item in transactions.values()):
+            return False
+        diff = diff_ordered(self.transactions, transactions)
+        if diff is None:
+            return False
+        children = self._root._children
+        tx_items = list(transactions.values())
+        for first, last in diff.removed:
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del children[first:last + 1]
+            self.endRemoveRows()
+        for first, last in diff.inserted:
+            self.beginInsertRows(QModelIndex(), first, last)
+            nodes = []
+            for tx_item in tx_items[first:last + 1]:
+                node = HistoryNode(self, tx_item)
+                node._parent = self._root
+                nodes.append(node)
+            children[first:first] = nodes
+            self.endInsertRows()
+        for i, (node, tx_item) in enumerate(zip(children, tx_items)):
+            node._row = i
+            node._data = tx_item
+        self.transactions = transactions
+        for first, last in diff.changed:
+            self.dataChanged.emit(self.createIndex(first, 0), self.createIndex(last, len(HistoryColumns) - 1))
+        return True
 
     def set_visibility_of_columns(self):
         def set_visible(col: int, b: bool):
@@ -401,24 +444,23 @@ class HistoryModel(CustomModel, Logger):
         self.dataChanged.emit(idx, idx, [Qt.DisplayRole, Qt.ForegroundRole])
 
     def update_tx_mined_status(self, tx_hash: str, tx_mined_info: TxMinedInfo):
-        try:
-            row = self.transactions.pos_from_key(tx_hash)
-            tx_item = self.transactions[tx_hash]
-        except KeyError:
+        rows = self._rows_by_txid.get(tx_hash)
+        if not rows:
             return
         self.tx_status_cache[tx_hash] = self.window.wallet.get_tx_status(tx_hash, tx_mined_info)
-        tx_item.update({
-            'confirmations':  tx_mined_info.conf,
-            'timestamp':      tx_mined_info.timestamp,
-            'txpos_in_block': tx_mined_info.txpos,
-            'date':           timestamp_to_datetime(tx_mined_info.timestamp),
-        })
-        topLeft = self.createIndex(row, 0)
-        bottomRight = self.createIndex(row, len(HistoryColumns) - 1)
-        self.dataChanged.emit(topLeft, bottomRight)
+        for row in rows:
+            self.transactions.value_from_pos(row).update({
+                'confirmations':  tx_mined_info.conf,
+                'timestamp':      tx_mined_info.timestamp,
+                'txpos_in_block': tx_mined_info.txpos,
+                'date':           timestamp_to_datetime(tx_mined_info.timestamp),
+            })
+        for first, last in group_consecutive(rows):
+            self.dataChanged.emit(self.createIndex(first, 0), self.createIndex(last, len(HistoryColumns) - 1))
 
     def on_fee_histogram(self):
-        for (tx_hash, asset), tx_item in list(self.transactions.items()):
+        for tx_hash, rows in list(self._rows_by_txid.items()):
+            tx_item = self.transactions.value_from_pos(rows[0])
             if tx_item.get('lightning'):
                 continue
             tx_mined_info = self._tx_mined_info_from_tx_item(tx_item)
@@ -51,6 +51,7 @@ from PyQt5.QtWidgets import (QMessageBox, QSystemTrayIcon, QTabWidget,
 
 import electrum
 from electrum.gui import messages
+from electrum.gui.list_diff import get_affected_rows, AffectedRows
 from electrum import (keystore, ecc, constants, util, bitcoin, commands,
                       paymentrequest, lnutil)
 from electrum.asset import get_error_for_asset_typed, AssetType, parse_verifier_string, get_error_for_asset_name
@@ -196,12 +197,17 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger, QtEventListener):
         self._coroutines_scheduled = {}  # type: Dict[concurrent.futures.Future, str]
         self._coroutines_scheduled_lock = threading.Lock()
         self.thread = TaskThread(self, self.on_error)
+        # prepares the data of the lists, see BackgroundRefresher
+        self.refresh_thread = TaskThread(self, self.on_error)
 
         self.tx_notification_queue = queue.Queue()
         self.tx_notification_last_time = 0
 
         self.create_status_bar()
         self.need_update = threading.Event()
+        # only refresh the rows affected by what changed in the wallet history
+        self.need_update_rows = threading.Event()
+        self._adb_changes = wallet.adb.add_change_tracker()
 
         self.completions = QStringListModel()
 
@@ -439,7 +445,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger, QtEventListener):
     @event_listener
     def on_event_wallet_updated(self, wallet):
         if wallet == self.wallet:
-            self.need_update.set()
+            self.need_update_rows.set()
 
     @event_listener
     def on_event_new_transaction(self, wallet, tx):
@@ -903,7 +909,11 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger, QtEventListener):
         # Note this runs in the GUI thread
         if self.need_update.is_set():
             self.need_update.clear()
+            self.need_update_rows.clear()
             self.update_wallet()
+        elif self.need_update_rows.is_set():
+            self.need_update_rows.clear()
+            self.update_wallet(only_changed_rows=True)
         elif not self.wallet.is_up_to_date():
             # this updates "synchronizing" progress
             self.update_status()
@@ -1068,10 +1078,15 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger, QtEventListener):
         # so we can use this to disable buttons for rebalance/swap suggestions
         return len(self._coroutines_scheduled)
 
-    def update_wallet(self):
+    def update_wallet(self, *, only_changed_rows: bool = False):
         self.update_status()
         if self.wallet.is_up_to_date() or not self.network or not self.network.is_connected():
-            self.update_tabs()
+            changes = self._adb_changes.take()
+            affected = get_affected_rows(changes) if only_changed_rows else None
+            if affected is None:
+                self.update_tabs()
+            else:
+                self.update_changed_rows(affected)
 
     def update_tabs(self, wallet=None):
         if wallet is None:
@@ -1091,6 +1106,23 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger, QtEventListener):
         self.atomic_swap_tab.update()
         self.update_completions()
 
+    def update_changed_rows(self, affected: AffectedRows):
+        """Like update_tabs, but the history, address and coin lists
+        only update the affected rows.
+        """
+        if affected.txids:
+            self.history_model.refresh('update_changed_rows')
+        self.receive_tab.request_list.update()
+        self.receive_tab.update_current_request()
+        self.send_tab.update()
+        self.address_list.update_rows(affected.addresses)
+        self.utxo_list.update_rows(affected.addresses, affected.txids)
+        self.contact_list.update()
+        self.asset_tab.update()
+        self.broadcast_view_tab.update()
+        self.atomic_swap_tab.update()
+        self.update_completions()
+
     def refresh_tabs(self, wallet=None):
         self.history_model.refresh('refresh_tabs')
         self.receive_tab.request_list.refresh_all()
@@ -2885,11 +2917,15 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger, QtEventListener):
         if self.thread:
             self.thread.stop()
             self.thread = None
+        if self.refresh_thread:
+            self.refresh_thread.stop()
+            self.refresh_thread = None
         with self._coroutines_scheduled_lock:
             coro_keys = list(self._coroutines_scheduled.keys())
         for fut in coro_keys:
             fut.cancel()
         self.unregister_callbacks()
+        self.wallet.adb.remove_change_tracker(self._adb_changes)
         self.config.GUI_QT_WINDOW_IS_MAXIMIZED = self.isMaximized()
         if not self.isMaximized():
             g = self.geometry()
@@ -480,6 +480,13 @@ class MyTreeView(QTreeView):
             if item.data(self.key_role) == key:
                 return row
 
+    def get_rows_by_key(self) -> Dict[Any, int]:
+        rows = {}
+        for row in range(0, self.std_model.rowCount()):
+            item = self.std_model.item(row, 0)
+            rows[item.data(self.key_role)] = row
+        return rows
+
     def refresh_all(self):
         if self.maybe_defer_update():
             return
@@ -40,6 +40,7 @@ from electrum.qrreader import MissingQrDetectionLib
 from electrum.ipfs_db import IPFSDB
 from electrum.bitcoin import base_encode
 from electrum.boolean_ast_tree import AbstractBooleanASTNode
+from electrum.gui.background_refresher import BackgroundRefresher, RefreshCancelled
 
 if TYPE_CHECKING:
     from .main_window import ElectrumWindow
@@ -977,13 +978,15 @@ class TaskThread(QThread, Logger):
         self.doneSig.connect(self.on_done)
         self.start()
 
-    def add(self, task, on_success=None, on_done=None, on_error=None, *, cancel=None):
+    def add(self, task, on_success=None, on_done=None, on_error=None, *, cancel=None) -> bool:
+        """Returns whether the task was queued."""
         if self._stopping:
             self.logger.warning(f"stopping or already stopped but tried to add new task.")
-            return
+            return False
         on_error = on_error or self.on_error
         task_ = TaskThread.Task(task, on_success, on_done, on_error, cancel=cancel)
         self.tasks.put(task_)
+        return True
 
     def run(self):
         while True:
@@ -23,7 +23,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Optional, List, Dict, Sequence, Set, TYPE_CHECKING
+from typing import Optional, List, Dict, Sequence, Set, Iterable, Tuple, TYPE_CHECKING
 import enum
 import copy
 
@@ -36,8 +36,9 @@ from electrum.bitcoin import is_address
 from electrum.transaction import PartialTxInput, PartialTxOutput
 from electrum.lnutil import MIN_FUNDING_SAT
 from electrum.util import profiler
+from electrum.gui.list_diff import diff_keyed, get_row_to_insert_descending
 
-from .util import ColorScheme, MONOSPACE_FONT, EnterButton
+from .util import ColorScheme, MONOSPACE_FONT, EnterButton, BackgroundRefresher
 from .my_treeview import MyTreeView
 from .new_channel_dialog import NewChannelDialog
 
@@ -77,6 +78,8 @@ class UTXOList(MyTreeView):
         )
         self._spend_set = set()
         self._utxo_dict = {}
+        self._num_parents = {}  # type: Dict[str, int]  # txid -> number of parents, see get_num_parents
+        self.refresher = BackgroundRefresher(self.main_window.refresh_thread)
         self.wallet = self.main_window.wallet
         self.std_model = QStandardItemModel(self)
         self.setModel(self.std_model)
@@ -89,11 +92,25 @@ class UTXOList(MyTreeView):
         menu.addAction(_('Coin control'), lambda: self.add_selection_to_coincontrol())
         return toolbar
 
-    @profiler(min_threshold=0.05)
     def update(self):
         # not calling maybe_defer_update() as it interferes with coincontrol status bar
+        self.refresher.request(self.get_utxos_snapshot, self.apply_utxos_snapshot)
+
+    @profiler(min_threshold=0.05)
+    def get_utxos_snapshot(self, check_cancelled) -> Tuple[List[PartialTxInput], Dict[str, int]]:
+        """Runs on the refresh thread. Returns our coins, and their number of parents."""
         utxos = self.wallet.get_utxos()
         utxos.sort(key=lambda x: x.block_height, reverse=True)
+        num_parents = {}
+        for utxo in utxos:
+            check_cancelled()
+            txid = utxo.prevout.txid.hex()
+            num_parents[txid] = self.wallet.get_num_parents(txid)
+        return utxos, num_parents
+
+    @profiler(min_threshold=0.05)
+    def apply_utxos_snapshot(self, snapshot: Tuple[List[PartialTxInput], Dict[str, int]]):
+        utxos, self._num_parents = snapshot
         self._maybe_reset_coincontrol(utxos)
         self._utxo_dict = {}
         self.model().clear()
@@ -101,30 +118,79 @@ class UTXOList(MyTreeView):
         for idx, utxo in enumerate(utxos):
             name = utxo.prevout.to_str()
             self._utxo_dict[name] = utxo
-            labels = [""] * len(self.Columns)
-            amount_str = self.main_window.format_amount(
-                utxo.value_sats(asset_aware=True), whitespaces=True)
-            amount_str_nots = self.main_window.format_amount(
-                utxo.value_sats(asset_aware=True), whitespaces=False, add_thousands_sep=False)
-            labels[self.Columns.OUTPOINT] = str(utxo.short_id)
-            labels[self.Columns.ADDRESS] = utxo.address
-            labels[self.Columns.AMOUNT] = amount_str
-            labels[self.Columns.ASSET] = utxo.asset
-            utxo_item = [QStandardItem(x) for x in labels]
-            self.set_editability(utxo_item)
-            utxo_item[self.Columns.OUTPOINT].setData(name, self.ROLE_PREVOUT_STR)
-            utxo_item[self.Columns.AMOUNT].setData(amount_str_nots, self.ROLE_CLIPBOARD_DATA)
-            utxo_item[self.Columns.ADDRESS].setFont(QFont(MONOSPACE_FONT))
-            utxo_item[self.Columns.AMOUNT].setFont(QFont(MONOSPACE_FONT))
-            utxo_item[self.Columns.PARENTS].setFont(QFont(MONOSPACE_FONT))
-            utxo_item[self.Columns.OUTPOINT].setFont(QFont(MONOSPACE_FONT))
-            utxo_item[self.Columns.ASSET].setFont(QFont(MONOSPACE_FONT))
-            self.model().insertRow(idx, utxo_item)
+            self.model().insertRow(idx, self.create_row(utxo))
             self.refresh_row(name, idx)
         self.filter()
         self.update_coincontrol_bar()
         self.num_coins_label.setText(_('{} unspent transaction outputs').format(len(utxos)))
 
+    def update_rows(self, addresses: Iterable[str], txids: Iterable[str]):
+        """Updates only the coins of the given addresses, and those created by
+        the given txids (e.g. their height changed), instead of the whole list.
+        """
+        if self.refresher.is_busy():
+            # a full update is on its way; it would overwrite these rows
+            self.update()
+            return
+        addresses = set(addresses)
+        txids = set(txids)
+        if not addresses and not txids:
+            return
+        old = {name for name, utxo in self._utxo_dict.items()
+               if utxo.address in addresses or utxo.prevout.txid.hex() in txids}
+        domain = addresses | {self._utxo_dict[name].address for name in old}
+        items = dict.fromkeys(old)  # spent coins are removed
+        items.update((utxo.prevout.to_str(), utxo) for utxo in self.wallet.get_utxos(domain))
+        diff = diff_keyed(self.get_rows_by_key(), items)
+        for row in diff.removed:
+            self.model().removeRow(row)
+        for name, utxo in items.items():
+            if utxo is None:
+                del self._utxo_dict[name]
+            else:
+                self._utxo_dict[name] = utxo
+        rows = self.get_rows_by_key()  # after the removals
+        for name, _old_row, utxo in diff.updated:
+            row = rows[name]
+            self._num_parents.pop(utxo.prevout.txid.hex(), None)
+            self.model().item(row, self.Columns.OUTPOINT).setText(str(utxo.short_id))
+            self.refresh_row(name, row)
+        new_utxos = [utxo for name, utxo in diff.added]
+        for utxo in sorted(new_utxos, key=lambda x: x.block_height, reverse=True):
+            # keep the list ordered by height, newest first
+            heights = [self._utxo_dict[self.model().item(i, 0).data(self.ROLE_PREVOUT_STR)].block_height
+                       for i in range(self.model().rowCount())]
+            row = get_row_to_insert_descending(heights, utxo.block_height)
+            self.model().insertRow(row, self.create_row(utxo))
+            self.refresh_row(utxo.prevout.to_str(), row)
+        self._maybe_reset_coincontrol(list(self._utxo_dict.values()))
+        if new_utxos and self.current_filter:
+            self.filter()
+        self.update_coincontrol_bar()
+        self.num_coins_label.setText(_('{} unspent transaction outputs').format(len(self._utxo_dict)))
+
+    def create_row(self, utxo: PartialTxInput) -> List[QStandardItem]:
+        name = utxo.prevout.to_str()
+        labels = [""] * len(self.Columns)
+        amount_str = self.main_window.format_amount(
+            utxo.value_sats(asset_aware=True), whitespaces=True)
+        amount_str_nots = self.main_window.format_amount(
+            utxo.value_sats(asset_aware=True), whitespaces=False, add_thousands_sep=False)
+        labels[self.Columns.OUTPOINT] = str(utxo.short_id)
+        labels[self.Columns.ADDRESS] = utxo.address
+        labels[self.Columns.AMOUNT] = amount_str
+        labels[self.Columns.ASSET] = utxo.asset
+        utxo_item = [QStandardItem(x) for x in labels]
+        self.set_editability(utxo_item)
+        utxo_item[self.Columns.OUTPOINT].setData(name, self.ROLE_PREVOUT_STR)
+        utxo_item[self.Columns.AMOUNT].setData(amount_str_nots, self.ROLE_CLIPBOARD_DATA)
+        utxo_item[self.Columns.ADDRESS].setFont(QFont(MONOSPACE_FONT))
+        utxo_item[self.Columns.AMOUNT].setFont(QFont(MONOSPACE_FONT))
+        utxo_item[self.Columns.PARENTS].setFont(QFont(MONOSPACE_FONT))
+        utxo_item[self.Columns.OUTPOINT].setFont(QFont(MONOSPACE_FONT))
+        utxo_item[self.Columns.ASSET].setFont(QFont(MONOSPACE_FONT))
+        return utxo_item
+
     def update_coincontrol_bar(self):
         # update coincontrol status bar
         if bool(self._spend_set):
@@ -142,7 +208,9 @@ class UTXOList(MyTreeView):
         utxo = self._utxo_dict[key]
         utxo_item = [self.std_model.item(row, col) for col in self.Columns]
         txid = utxo.prevout.txid.hex()
-        num_parents = self.wallet.get_num_parents(txid)
+        num_parents = self._num_parents.get(txid)
+        if num_parents is None:
+            num_parents = self._num_parents[txid] = self.wallet.get_num_parents(txid)
         utxo_item[self.Columns.PARENTS].setText('%6s'%num_parents if num_parents else '-')
         label = self.wallet.get_label_for_txid(txid) or ''
         utxo_item[self.Columns.LABEL].setText(label)
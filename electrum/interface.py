@@ -73,6 +73,11 @@ _KNOWN_NETWORK_PROTOCOLS = {'t', 's'}
 PREFERRED_NETWORK_PROTOCOL = 's'
 assert PREFERRED_NETWORK_PROTOCOL in _KNOWN_NETWORK_PROTOCOLS
 
+# max number of requests sent in one JSON-RPC batch
+BATCH_MAX_SIZE = 100
+# coalesced requests made within this many seconds are sent as one batch
+BATCH_COALESCE_WINDOW = 0.01
+
 
 class NetworkTimeout:
     # seconds
@@ -140,6 +145,9 @@ class NotificationSession(RPCSession):
         self._msg_counter = itertools.count(start=1)
         self.interface = interface
         self.cost_hard_limit = 0  # disable aiorpcx resource limits
+        self._pending_batch = []  # type: List[Tuple[str, List, asyncio.Future]]
+        self._pending_batch_handle = None  # type: Optional[asyncio.TimerHandle]
+        self._batch_tasks = set()  # type: Set[asyncio.Task]
 
     async def handle_request(self, request):
         self.maybe_log(f"--> {request}")
@@ -179,6 +187,81 @@ class NotificationSession(RPCSession):
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    async def send_request_batch(self, requests: Sequence[Tuple[str, Sequence]], *, timeout=None) -> List[Any]:
+        """Sends (method, params) requests as JSON-RPC batches of at most BATCH_MAX_SIZE.
+        Returns the results in order. If a request failed, its error
+        (e.g. an RPCError) is returned in place of its result.
+        """
+        results = []
+        for i in range(0, len(requests), BATCH_MAX_SIZE):
+            results.extend(await self._send_batch(requests[i:i+BATCH_MAX_SIZE], timeout=timeout))
+        return results
+
+    async def _send_batch(self, requests: Sequence[Tuple[str, Sequence]], *, timeout=None) -> List[Any]:
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch {list(requests)} (id: {msg_id})")
+        batch = self.send_batch()
+        for method, params in requests:
+            batch.add_request(method, params)
+        async def send():
+            async with batch:
+                pass
+        try:
+            await util.wait_for2(send(), timeout)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            raise RequestTimedOut(f'batch request timed out: {len(requests)} requests (id: {msg_id})') from e
+        self.maybe_log(f"--> {batch.results} (id: {msg_id})")
+        return list(batch.results)
+
+    async def send_request_coalesced(self, method: str, params: Sequence, *, timeout=None):
+        """Like send_request, but requests made within BATCH_COALESCE_WINDOW
+        of each other are sent together, in one batch.
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending_batch.append((method, list(params), fut))
+        if len(self._pending_batch) >= BATCH_MAX_SIZE:
+            self._flush_pending_batch()
+        elif self._pending_batch_handle is None:
+            self._pending_batch_handle = loop.call_later(BATCH_COALESCE_WINDOW, self._flush_pending_batch)
+        try:
+            return await util.wait_for2(fut, timeout)
+        except asyncio.TimeoutError as e:
+            raise RequestTimedOut(f'request timed out: {method} {params}') from e
+
+    def _flush_pending_batch(self):
+        if self._pending_batch_handle:
+            self._pending_batch_handle.cancel()
+            self._pending_batch_handle = None
+        items, self._pending_batch = self._pending_batch, []
+        items = [item for item in items if not item[2].done()]  # skip requests given up on
+        if not items:
+            return
+        task = asyncio.ensure_future(self._send_pending_batch(items))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _send_pending_batch(self, items: Sequence[Tuple[str, List, asyncio.Future]]):
+        try:
+            results = await self._send_batch([(method, params) for method, params, fut in items])
+        except asyncio.CancelledError:
+            for _method, _params, fut in items:
+                fut.cancel()
+            raise
+        except Exception as e:
+            # the whole batch failed (e.g. timeout, connection lost)
+            for _method, _params, fut in items:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (method, params, fut), result in zip(items, results):
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
@@ -648,11 +731,22 @@ class Interface(Logger):
         if tip is not None:
             size = min(size, tip - height + 1)
             size = max(size, 0)
+        hexdata = await self._fetch_chunk(height, size)
+        conn = await self.blockchain.connect_chunk(height, hexdata)
+
+        if not conn:
+            return conn, 0
+        return conn, size
+
+    async def _fetch_chunk(self, height: int, size: int) -> str:
+        """Requests `size` headers starting at `height`, and returns them as hex.
+        The headers are sanity-checked but not verified.
+        """
         try:
-            self._requested_chunks.add((height, height + size))            
+            self._requested_chunks.add((height, height + size))
             res = await self.session.send_request('blockchain.block.headers', [height, size])
         finally:
-            self._requested_chunks.discard((height, height + size))        
+            self._requested_chunks.discard((height, height + size))
         assert_dict_contains_field(res, field_name='count')
         assert_dict_contains_field(res, field_name='hex')
         assert_dict_contains_field(res, field_name='max')
@@ -668,11 +762,72 @@ class Interface(Logger):
             raise RequestCorrupted(f"server uses too low 'max' count for block.headers: {res['max']} < 2016")
         if res['count'] != size:
             raise RequestCorrupted(f"expected {size} headers but only got {res['count']}")
-        conn = await self.blockchain.connect_chunk(height, res['hex'])
+        return res['hex']
 
-        if not conn:
-            return conn, 0
-        return conn, res['count']
+    def _get_interfaces_for_chunk_download(self, max_height: int) -> Sequence['Interface']:
+        """Returns the interfaces whose servers can serve headers up to max_height.
+        We are always first in the list.
+        """
+        with self.network.interfaces_lock:
+            interfaces = list(self.network.interfaces.values())
+        others = [iface for iface in interfaces
+                  if iface is not self and iface.is_connected_and_ready() and iface.tip >= max_height]
+        return [self] + others
+
+    async def request_chunks_pipelined(self, height: int, num_chunks: int) -> Tuple[bool, int]:
+        """Catch-up mode for initial sync. Downloads num_chunks full chunks starting at height,
+        keeping up to config.NETWORK_HEADER_PIPELINE_DEPTH requests in flight, spread over the
+        connected interfaces. Chunks are connected in order, each as soon as its predecessor is.
+        Returns (could_connect, num_headers) like request_chunk, where could_connect is
+        only False if the first chunk could not be connected.
+        """
+        size = 2016
+        depth = max(1, self.network.config.NETWORK_HEADER_PIPELINE_DEPTH)
+        chunk_heights = [height]
+        for i in range(1, num_chunks):
+            chunk_height = height + i * size
+            # chunks within DGW checkpoints must be aligned. if they are not, stop here:
+            # sync_until will realign and call us again.
+            if (constants.net.DGW_CHECKPOINTS_START <= chunk_height <= constants.net.max_checkpoint()
+                    and chunk_height % constants.net.DGW_CHECKPOINTS_SPACING != 0):
+                break
+            chunk_heights.append(chunk_height)
+        num_chunks = len(chunk_heights)
+        interfaces = self._get_interfaces_for_chunk_download(chunk_heights[-1] + size - 1)
+        self.logger.info(f"requesting {num_chunks} chunks from height {height} "
+                         f"using {len(interfaces)} interfaces")
+
+        async def fetch(iface: 'Interface', chunk_height: int) -> Tuple[str, 'Interface']:
+            if iface is not self:
+                try:
+                    return await iface._fetch_chunk(chunk_height, size), iface
+                except Exception as e:
+                    self.logger.info(f"failed to get chunk {chunk_height} from {iface.server}: {repr(e)}")
+            return await self._fetch_chunk(chunk_height, size), self
+
+        pending = []  # type: List[asyncio.Task]
+        num_headers = 0
+        try:
+            for i, chunk_height in enumerate(chunk_heights):
+                while len(pending) < depth and i + len(pending) < num_chunks:
+                    j = i + len(pending)
+                    iface = interfaces[j % len(interfaces)]
+                    pending.append(asyncio.ensure_future(fetch(iface, chunk_heights[j])))
+                hexdata, iface = await pending.pop(0)
+                conn = await self.blockchain.connect_chunk(chunk_height, hexdata)
+                if not conn and iface is not self:
+                    # the other server might be on a different chain. only trust our own.
+                    hexdata = await self._fetch_chunk(chunk_height, size)
+                    conn = await self.blockchain.connect_chunk(chunk_height, hexdata)
+                if not conn:
+                    return num_headers > 0, num_headers
+                num_headers += size
+                util.trigger_callback('network_updated')
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return True, num_headers
 
     def is_main_server(self) -> bool:
         return (self.network.interface == self or
@@ -813,7 +968,11 @@ class Interface(Logger):
                     # the start and end block's targets
                     height = (height // constants.net.DGW_CHECKPOINTS_SPACING) * constants.net.DGW_CHECKPOINTS_SPACING
 
-                could_connect, num_headers = await self.request_chunk(height, next_height)
+                num_full_chunks = (next_height - height + 1) // 2016
+                if num_full_chunks >= 2 and self.network.config.NETWORK_HEADER_PIPELINE_DEPTH > 1:
+                    could_connect, num_headers = await self.request_chunks_pipelined(height, num_full_chunks)
+                else:
+                    could_connect, num_headers = await self.request_chunk(height, next_height)
 
                 if not could_connect:
                     if height <= constants.net.max_checkpoint():
@@ -1007,7 +1166,7 @@ class Interface(Logger):
         if not is_non_negative_integer(tx_height):
             raise Exception(f"{repr(tx_height)} is not a block height")
         # do request
-        res = await self.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
+        res = await self.session.send_request_coalesced('blockchain.transaction.get_merkle', [tx_hash, tx_height])
         # check response
         block_height = assert_dict_contains_field(res, field_name='block_height')
         merkle = assert_dict_contains_field(res, field_name='merkle')
@@ -1023,7 +1182,7 @@ class Interface(Logger):
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
-        raw = await self.session.send_request('blockchain.transaction.get', [tx_hash], timeout=timeout)
+        raw = await self.session.send_request_coalesced('blockchain.transaction.get', [tx_hash], timeout=timeout)
         # validate response
         if not is_hex_str(raw):
             raise RequestCorrupted(f"received garbage (non-hex) as tx data (txid {tx_hash}): {raw!r}")
@@ -1040,7 +1199,7 @@ class Interface(Logger):
         if not is_hash256_str(sh):
             raise Exception(f"{repr(sh)} is not a scripthash")
         # do request
-        res = await self.session.send_request('blockchain.scripthash.get_history', [sh])
+        res = await self.session.send_request_coalesced('blockchain.scripthash.get_history', [sh])
         # check response
         assert_list_or_tuple(res)
         prev_height = 1
@@ -25,7 +25,8 @@
 import threading
 import copy
 import json
-from typing import TYPE_CHECKING
+import zlib
+from typing import TYPE_CHECKING, List, Sequence
 
 from . import util
 from .util import WalletFileException, profiler
@@ -36,11 +37,21 @@ if TYPE_CHECKING:
 
 JsonDBJsonEncoder = util.MyEncoder
 
+# separates the journal records appended to a json file.
+# note: neither the (indented or compact) json dump, nor a journal record, contains it
+JOURNAL_SEPARATOR = '\n,'
+
 def modifier(func):
     def wrapper(self, *args, **kwargs):
         with self.lock:
             self._modified = True
-            return func(self, *args, **kwargs)
+            num_patches = self._num_journaled
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                if self._num_journaled == num_patches:
+                    # the change was not journaled (e.g. a list or set modified in place)
+                    self._needs_full_write = True
     return wrapper
 
 def locked(func):
@@ -74,6 +85,15 @@ def stored_as(name, _type=dict):
         return func
     return decorator
 
+def key_path(path: Sequence, key=None) -> List[str]:
+    """Returns the path of a stored value, with keys as they appear in the json file."""
+    def to_str(x):
+        if isinstance(x, int) and not isinstance(x, bool):
+            return str(int(x))
+        return str(x)
+    items = list(path) if key is None else list(path) + [key]
+    return [to_str(x) for x in items]
+
 def stored_in(name, _type=dict):
     """ decorator that indicates the storage key of an element in a StoredDict"""
     def decorator(func):
@@ -86,14 +106,19 @@ def stored_in(name, _type=dict):
 class StoredObject:
 
     db = None
+    _path = None
 
     def __setattr__(self, key, value):
-        if self.db:
-            self.db.set_modified(True)
         object.__setattr__(self, key, value)
+        if self.db and not key.startswith('_') and key != 'db':
+            if self._path is not None:
+                self.db.add_patch({'op': 'replace', 'path': self._path, 'value': self})
+            else:
+                self.db.set_modified(True)
 
-    def set_db(self, db):
+    def set_db(self, db, path=None):
         self.db = db
+        object.__setattr__(self, '_path', key_path(path) if path is not None else None)
 
     def to_json(self):
         d = dict(vars(self))
@@ -112,15 +137,21 @@ class StoredDict(dict):
         self.db = db
         self.lock = self.db.lock if self.db else threading.RLock()
         self.path = path
+        # items set while initializing are part of the value
+        # given to our parent, they are not journaled separately
+        self._initialized = False
         # recursively convert dicts to StoredDict
         for k, v in list(data.items()):
             self.__setitem__(k, v)
+        self._initialized = True
 
     @locked
     def __setitem__(self, key, v):
         is_new = key not in self
         # early return to prevent unnecessary disk writes
         if not is_new and self[key] == v:
+            if self.db:
+                self.db.note_journaled(modified=False)
             return
         # recursively set db and path
         if isinstance(v, StoredDict):
@@ -141,38 +172,105 @@ class StoredDict(dict):
                 v = self.db._convert_value(self.path, key, v)
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
+            v.set_db(self.db, self.path + [key])
         # set item
         dict.__setitem__(self, key, v)
-        if self.db:
-            self.db.set_modified(True)
+        if self.db and self._initialized:
+            self.db.add_patch({'op': 'add' if is_new else 'replace', 'path': key_path(self.path, key), 'value': v})
 
     @locked
     def __delitem__(self, key):
         dict.__delitem__(self, key)
         if self.db:
-            self.db.set_modified(True)
+            self.db.add_patch({'op': 'remove', 'path': key_path(self.path, key)})
 
     @locked
     def pop(self, key, v=_RaiseKeyError):
         if v is _RaiseKeyError:
             r = dict.pop(self, key)
+        elif key not in self:
+            if self.db:
+                self.db.note_journaled(modified=False)
+            return v
         else:
-            r = dict.pop(self, key, v)
+            r = dict.pop(self, key)
         if self.db:
-            self.db.set_modified(True)
+            self.db.add_patch({'op': 'remove', 'path': key_path(self.path, key)})
         return r
 
-
+    @locked
+    def clear(self):
+        dict.clear(self)
+        if self.db:
+            self.db.add_patch({'op': 'replace', 'path': key_path(self.path), 'value': {}})
+
+
+
+
+def frame_journal_record(patches: Sequence[str]) -> str:
+    """Returns the record appended to the file for one write: the serialized
+    patches as a json list, preceded by their checksum, so that a record that
+    was only partially written is dropped as a whole.
+    """
+    body = '[' + ','.join(patches) + ']'
+    return JOURNAL_SEPARATOR + '%08x' % zlib.crc32(body.encode('utf8')) + body
+
+
+def parse_journal_record(record: str) -> Sequence[dict]:
+    """Returns the patches of a record (without separator), see frame_journal_record.
+    Raises ValueError if the record is incomplete or corrupted.
+    """
+    checksum, body = record[:8], record[8:]
+    if '%08x' % zlib.crc32(body.encode('utf8')) != checksum:
+        raise ValueError('bad checksum')
+    patches = json.loads(body)
+    if not isinstance(patches, list):
+        raise ValueError('not a list')
+    return patches
+
+
+def apply_patch(data: dict, patch: dict) -> None:
+    """Applies a journaled operation (see JsonDB.add_patch) to raw json data."""
+    op, path = patch['op'], patch['path']
+    parent = data
+    for key in path[:-1]:
+        parent = parent[int(key)] if isinstance(parent, list) else parent[key]
+    if not path:
+        raise WalletFileException(f"Malformed journal entry: {patch!r}")
+    key = path[-1]
+    if isinstance(parent, list):
+        if op == 'add' and key == '-':
+            parent.append(patch['value'])
+        elif op == 'remove':
+            del parent[int(key)]
+        else:
+            parent[int(key)] = patch['value']
+    elif op == 'remove':
+        parent.pop(key, None)
+    elif op in ('add', 'replace'):
+        parent[key] = patch['value']
+    else:
+        raise WalletFileException(f"Malformed journal entry: {patch!r}")
 
 
 class JsonDB(Logger):
+    """A json document, saved to storage.
+
+    Changes made through StoredDict/StoredObject are recorded as json-patch
+    style operations, and written by appending them to the file as one
+    record per write (see WalletStorage.append). The whole document is only
+    rewritten when the storage asks for it, or when a change could not be
+    journaled, e.g. when a @modifier method did not record any patch.
+    """
 
     def __init__(self, data, storage=None):
         Logger.__init__(self)
         self.lock = threading.RLock()
         self.storage = storage
         self._modified = False
+        self.pending_changes = []  # type: List[str]  # serialized patches, not yet written
+        self._num_journaled = 0  # number of changes accounted for so far, see modifier
+        self._needs_full_write = False
         # load data
         if data:
             self.load_data(data)
@@ -180,16 +278,78 @@ class JsonDB(Logger):
             self.data = {}
 
     def load_data(self, s):
+        base, *journal = s.split(JOURNAL_SEPARATOR)
         try:
-            self.data = json.loads(s)
+            self.data = json.loads(base)
         except Exception:
             raise WalletFileException("Cannot read wallet file. (parsing failed)")
         if not isinstance(self.data, dict):
             raise WalletFileException("Malformed wallet file (not dict)")
+        for i, record in enumerate(journal):
+            try:
+                patches = parse_journal_record(record)
+            except Exception:
+                if i == len(journal) - 1:
+                    # torn write at the end of the file: none of its changes are applied
+                    self.logger.warning('ignoring incomplete journal record')
+                    self._needs_full_write = True
+                    break
+                raise WalletFileException("Cannot read wallet file. (parsing journal failed)")
+            try:
+                for patch in patches:
+                    apply_patch(self.data, patch)
+            except (KeyError, IndexError, ValueError, TypeError) as e:
+                raise WalletFileException(f"Cannot read wallet file. (applying journal failed: {e!r})") from e
+        if journal:
+            self.logger.info(f'applied {len(journal)} journal records')
 
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            if b:
+                # we do not know what changed
+                self._needs_full_write = True
+
+    def add_patch(self, patch: dict) -> None:
+        """Records a change to self.data, to be appended to storage on the next write.
+        'path' is the list of keys leading to the changed value, see key_path.
+        """
+        with self.lock:
+            self._modified = True
+            self._num_journaled += 1
+            if self.storage is None or self._needs_full_write:
+                return
+            try:
+                s = json.dumps(patch, cls=JsonDBJsonEncoder)
+            except Exception:
+                self.logger.info(f"json error: cannot journal change of {patch['path']!r}")
+                self._needs_full_write = True
+                return
+            self.pending_changes.append(s)
+
+    def note_journaled(self, *, modified: bool = True) -> None:
+        """Accounts for a change that needs no patch, because it is persisted
+        elsewhere or turned out to change nothing, so that the @modifier
+        making it does not force a full write.
+        """
+        with self.lock:
+            self._num_journaled += 1
+            if modified:
+                self._modified = True
+
+    def journal_value(self, path: Sequence) -> None:
+        """Journals the current value at path. To be used after modifying
+        a value in place (e.g. a list or set), which StoredDict cannot see.
+        """
+        with self.lock:
+            value = self.data
+            for key in path:
+                value = value[key]
+            self.add_patch({'op': 'replace', 'path': key_path(path), 'value': value})
+
+    def journal_append(self, path: Sequence, item) -> None:
+        """Journals that item was appended to the list at path."""
+        self.add_patch({'op': 'add', 'path': key_path(path, '-'), 'value': item})
 
     def modified(self):
         return self._modified
@@ -201,7 +361,7 @@ class JsonDB(Logger):
             v = default
         return v
 
-    @modifier
+    @locked
     def put(self, key, value):
         try:
             json.dumps(key, cls=JsonDBJsonEncoder)
@@ -209,6 +369,9 @@ class JsonDB(Logger):
         except Exception:
             self.logger.info(f"json error: cannot save {repr(key)} ({repr(value)})")
             return False
+        if not isinstance(self.data, StoredDict) and self.data.get(key) != value:
+            # changes to plain data are not journaled
+            self.set_modified(True)
         if value is not None:
             if self.data.get(key) != value:
                 self.data[key] = copy.deepcopy(value)
@@ -227,9 +390,10 @@ class JsonDB(Logger):
         return self.data[name]
 
     @locked
-    def dump(self, *, human_readable: bool = True) -> str:
+    def dump(self, *, human_readable: bool = True, for_storage: bool = False) -> str:
         """Serializes the DB as a string.
         'human_readable': makes the json indented and sorted, but this is ~2x slower
+        'for_storage': the string is written to self.storage
         """
         return json.dumps(
             self.data,
@@ -280,6 +444,22 @@ class JsonDB(Logger):
             return
         if not self.modified():
             return
-        json_str = self.dump(human_readable=not self.storage.is_encrypted())
-        self.storage.write(json_str)
-        self.set_modified(False)
+        journal = frame_journal_record(self.pending_changes) if self.pending_changes else ''
+        if (self._needs_full_write
+                or not self.storage.can_append()
+                or self.storage.needs_consolidation(len(journal))):
+            self.write_and_force_consolidation()
+            return
+        if journal:
+            self.storage.append(journal)
+            self.pending_changes = []
+        self._modified = False
+
+    def write_and_force_consolidation(self):
+        """Rewrites the whole file, folding the journal into it."""
+        with self.lock:
+            json_str = self.dump(human_readable=not self.storage.is_encrypted(), for_storage=True)
+            self.storage.write(json_str)
+            self.pending_changes = []
+            self._needs_full_write = False
+            self._modified = False
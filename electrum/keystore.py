@@ -223,7 +223,7 @@ class Software_KeyStore(KeyStore):
         decrypted = ec.decrypt_message(message)
         return decrypted
 
-    def sign_transaction(self, tx, password, wallet: 'Abstract_Wallet'):
+    def sign_transaction(self, tx, password, wallet: 'Abstract_Wallet', *, num_workers: int = 1):
         if self.is_watching_only():
             return
         # Raise if password is not correct.
@@ -234,7 +234,7 @@ class Software_KeyStore(KeyStore):
             keypairs[k] = self.get_private_key(v, password)
         # Sign
         if keypairs:
-            tx.sign(keypairs, wallet)
+            tx.sign(keypairs, wallet, num_workers=num_workers)
 
     @abstractmethod
     def update_password(self, old_password, new_password):
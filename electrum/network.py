@@ -510,6 +510,22 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         with self.interfaces_lock:
             return list(self.interfaces)
 
+    def get_interfaces_for_sync_fanout(self) -> List[Interface]:
+        """The main interface, followed by the other connected interfaces
+        that follow the same chain and are part of a healthy spread of servers.
+        """
+        main_iface = self.interface
+        if main_iface is None:
+            return []
+        with self.interfaces_lock:
+            interfaces = list(self.interfaces.values())
+        return [main_iface] + [
+            iface for iface in interfaces
+            if iface is not main_iface
+            and iface.is_connected_and_ready()
+            and iface.blockchain is main_iface.blockchain
+            and self.check_interface_against_healthy_spread_of_connected_servers(iface)]
+
     def get_status(self):
         n = len(self.get_interfaces())
         return _("Connected to {0} nodes.").format(n) if n > 1 else _("Connected to {0} node.").format(n) if n == 1 else _("Not connected")
@@ -1291,6 +1307,12 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         with open(path, 'w', encoding='utf-8') as f:
             f.write(json.dumps(cp, indent=4))
 
+    def export_header_snapshot(self, path: str) -> dict:
+        """Writes the stored headers of the best chain into a binary snapshot,
+        that can be imported on startup (config.HEADERS_SNAPSHOT_PATH).
+        """
+        return blockchain.export_header_snapshot(blockchain.get_best_chain(), path)
+
     async def _start(self):
         assert not self.taskgroup
         self.taskgroup = taskgroup = OldTaskGroup()
@@ -1346,7 +1368,10 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.interfaces = {}
         self._connecting_ifaces.clear()
         self._closing_ifaces.clear()
-        if not full_shutdown:
+        if full_shutdown:
+            blockchain.shutdown_pow_executor()
+            blockchain.sync_headers_to_disk()
+        else:
             util.trigger_callback('network_updated')
 
     async def _ensure_there_is_a_main_interface(self):
@@ -1386,6 +1411,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             await maybe_start_new_interfaces()
             await maintain_healthy_spread_of_connected_servers()
             await maintain_main_interface()
+            blockchain.sync_headers_to_disk(only_if_due=True)
             await asyncio.sleep(0.1)
 
     @classmethod
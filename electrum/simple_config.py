@@ -876,6 +876,12 @@ class SimpleConfig(Logger):
     NETWORK_SERVERFINGERPRINT = ConfigVar('serverfingerprint', default=None, type_=str)
     NETWORK_MAX_INCOMING_MSG_SIZE = ConfigVar('network_max_incoming_msg_size', default=1_000_000, type_=int)  # in bytes
     NETWORK_TIMEOUT = ConfigVar('network_timeout', default=None, type_=int)
+    NETWORK_HEADER_VERIFY_WORKERS = ConfigVar('header_verify_workers', default=None, type_=int)  # None: one per CPU core
+    NETWORK_HEADER_PIPELINE_DEPTH = ConfigVar('header_pipeline_depth', default=4, type_=int)  # chunk requests in flight
+    NETWORK_SYNC_FANOUT = ConfigVar('sync_fanout', default=False, type_=bool)  # spread initial history sync over servers
+    HEADERS_FSYNC_INTERVAL = ConfigVar('headers_fsync_interval', default=5, type_=int)  # seconds. 0: fsync every write
+    HEADERS_SNAPSHOT_PATH = ConfigVar('headers_snapshot', default=None, type_=str)  # imported on startup if it is ahead of us
+    HEADERS_SNAPSHOT_CHECKSUM = ConfigVar('headers_snapshot_sha256d', default=None, type_=str)  # required to import HEADERS_SNAPSHOT_PATH
 
     WALLET_BATCH_RBF = ConfigVar('batch_rbf', default=False, type_=bool)
     WALLET_SPEND_CONFIRMED_ONLY = ConfigVar('confirmed_only', default=False, type_=bool)
@@ -886,6 +892,7 @@ class SimpleConfig(Logger):
     WALLET_BOLT11_FALLBACK = ConfigVar('bolt11_fallback', default=True, type_=bool)
     WALLET_PAYREQ_EXPIRY_SECONDS = ConfigVar('request_expiry', default=invoices.PR_DEFAULT_EXPIRATION_WHEN_CREATING, type_=int)
     WALLET_USE_SINGLE_PASSWORD = ConfigVar('single_password', default=False, type_=bool)
+    WALLET_SIGNING_NUM_WORKERS = ConfigVar('signing_num_workers', default=1, type_=int)  # >1: sign inputs on a thread pool
     # note: 'use_change' and 'multiple_change' are per-wallet settings
     WALLET_SEND_CHANGE_TO_LIGHTNING = ConfigVar('send_change_to_lightning', default=False, type_=bool)
 
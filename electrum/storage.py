@@ -36,6 +36,7 @@ from .util import (profiler, InvalidPassword, WalletFileException, bfh, standard
                    test_read_write_permissions, os_chmod)
 
 from .wallet_db import WalletDB
+from .json_db import JOURNAL_SEPARATOR
 from .logging import Logger
 
 
@@ -54,6 +55,13 @@ class StorageEncryptionVersion(IntEnum):
 class StorageReadWriteError(Exception): pass
 
 
+# The journal appended to the wallet file is folded back into a new base
+# snapshot once it is larger than this fraction of the snapshot
+# (and larger than JOURNAL_MIN_COMPACTION_SIZE bytes).
+JOURNAL_COMPACTION_RATIO = 1.0
+JOURNAL_MIN_COMPACTION_SIZE = 64 * 1024
+
+
 # TODO: Rename to Storage
 class WalletStorage(Logger):
 
@@ -75,11 +83,24 @@ class WalletStorage(Logger):
         else:
             self.raw = ''
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+        # layout of the file: a base snapshot, followed by appended journal records
+        self._file_size = len(self.raw)
+        self._base_size = self._get_base_size(self.raw)
+        self._can_append = self.file_exists()
+
+    def _get_base_size(self, raw: str) -> int:
+        if self.is_encrypted():
+            # one encrypted record per line
+            sep = raw.find('\n')
+        else:
+            sep = raw.find(JOURNAL_SEPARATOR)
+        return len(raw) if sep == -1 else sep
 
     def read(self):
         return self.decrypted if self.is_encrypted() else self.raw
 
     def write(self, data: str) -> None:
+        """Replaces the file with data, as a new base snapshot."""
         s = self.encrypt_before_writing(data)
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w", encoding='utf-8') as f:
@@ -98,8 +119,35 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os_chmod(self.path, mode)
         self._file_exists = True
+        self._file_size = self._base_size = len(s)
+        self._can_append = True
         self.logger.info(f"saved {self.path}")
 
+    def append(self, data: str) -> None:
+        """Appends a journal record to the file.
+        If the storage is encrypted, the record is encrypted on its own, on a new line.
+        """
+        assert self.can_append()
+        s = '\n' + self.encrypt_before_writing(data) if self.pubkey else data
+        with open(self.path, "a", encoding='utf-8') as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        self._file_size += len(s)
+
+    def can_append(self) -> bool:
+        """Whether the file on disk can be extended with append(),
+        i.e. it exists and is written with the current encryption settings.
+        """
+        return self.file_exists() and self._can_append
+
+    def needs_consolidation(self, pending_size: int = 0) -> bool:
+        """Whether the journal, once pending_size more bytes are appended,
+        has grown past the compaction threshold.
+        """
+        journal_size = self._file_size - self._base_size + pending_size
+        return journal_size > max(JOURNAL_COMPACTION_RATIO * self._base_size, JOURNAL_MIN_COMPACTION_SIZE)
+
     def file_exists(self) -> bool:
         return self._file_exists
 
@@ -135,7 +183,8 @@ class WalletStorage(Logger):
 
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
+            # the base snapshot is on the first line
+            magic = base64.b64decode(self.raw.split('\n', 1)[0])[0:4]
             if magic == b'BIE1':
                 return StorageEncryptionVersion.USER_PASSWORD
             elif magic == b'BIE2':
@@ -169,8 +218,17 @@ class WalletStorage(Logger):
         ec_key = self.get_eckey_from_password(password)
         if self.raw:
             enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
-            s = s.decode('utf8')
+            base, *journal = self.raw.split('\n')
+            s = zlib.decompress(ec_key.decrypt_message(base, enc_magic)).decode('utf8')
+            for i, record in enumerate(journal):
+                try:
+                    s += zlib.decompress(ec_key.decrypt_message(record, enc_magic)).decode('utf8')
+                except Exception:
+                    if i < len(journal) - 1:
+                        raise
+                    # torn write at the end of the file
+                    self.logger.warning('ignoring incomplete journal record')
+                    self._can_append = False
         else:
             s = ''
         self.pubkey = ec_key.get_public_key_hex()
@@ -212,6 +270,8 @@ class WalletStorage(Logger):
         else:
             self.pubkey = None
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+        # the file has to be rewritten with the new key
+        self._can_append = False
 
     def basename(self) -> str:
         return os.path.basename(self.path)
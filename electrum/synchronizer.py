@@ -24,6 +24,7 @@
 # SOFTWARE.
 import asyncio
 import hashlib
+import itertools
 from typing import Dict, List, TYPE_CHECKING, Tuple, Set
 from collections import defaultdict
 import logging
@@ -41,6 +42,7 @@ from .i18n import _
 
 if TYPE_CHECKING:
     from .network import Network
+    from .interface import Interface
     from .address_synchronizer import AddressSynchronizer
 
 
@@ -149,6 +151,9 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         self._handling_qualifier_association_statuses = set()
         self._processed_some_qualifier_associations = False
 
+        # set when the state that main() acts on changed, see notify_state_changed
+        self._state_changed = asyncio.Event()
+
         # Queues
         self.asset_status_queue = asyncio.Queue()
         self.status_queue = asyncio.Queue()
@@ -186,37 +191,45 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     def add(self, addr):
         if not is_address(addr): raise ValueError(f"invalid bitcoin address {addr}")
         self._adding_addrs.add(addr)  # this lets is_up_to_date already know about addr
+        self.notify_state_changed()
 
     def add_asset(self, asset):
         if error := get_error_for_asset_name(asset): raise ValueError(f'invalid asset: {error}')
         self._adding_assets.add(asset)
+        self.notify_state_changed()
 
     def add_qualifier_for_tag(self, asset):
         if get_error_for_asset_typed(asset, AssetType.QUALIFIER) and \
             get_error_for_asset_typed(asset, AssetType.SUB_QUALIFIER) and \
             get_error_for_asset_typed(asset, AssetType.RESTRICTED): raise ValueError(f'invalid asset')
         self._adding_qualifiers_for_tags.add(asset)
+        self.notify_state_changed()
 
     def add_h160_for_tag(self, h160: str):
         if len(h160) != 40: raise ValueError(f'{h160} is not a valid h160 hex string')
         self._adding_h160s_for_tags.add(h160)
+        self.notify_state_changed()
 
     def add_restricted_for_verifier(self, asset: str):
         if error := get_error_for_asset_typed(asset, AssetType.RESTRICTED): raise ValueError(f'invalid asset: {error}')
         self._adding_restricted_for_verifier.add(asset)
+        self.notify_state_changed()
 
     def add_restricted_for_freeze(self, asset: str):
         if error := get_error_for_asset_typed(asset, AssetType.RESTRICTED): raise ValueError(f'invalid asset: {error}')
         self._adding_restricted_for_freeze.add(asset)
+        self.notify_state_changed()
 
     def add_broadcast(self, asset: str):
         if error := get_error_for_asset_name(asset): raise ValueError(f'invalid asset: {error}')
         self._adding_broadcasts.add(asset)
+        self.notify_state_changed()
 
     def add_associations_for_qualifier(self, asset: str):
         if (error := get_error_for_asset_typed(asset, AssetType.QUALIFIER)) and \
             (error := get_error_for_asset_typed(AssetType.SUB_QUALIFIER)): raise ValueError(f'invalid asset: {error}')
         self._adding_qualifier_associations.add(asset)
+        self.notify_state_changed()
 
     async def _add_address(self, addr: str):
         try:
@@ -284,6 +297,18 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         finally:
             self._adding_qualifier_associations.discard(asset)
 
+    def notify_state_changed(self) -> None:
+        """Wakes up main(), e.g. after something was added or a request completed.
+        Can be called from any thread.
+        """
+        self.asyncio_loop.call_soon_threadsafe(self._state_changed.set)
+
+    async def _run_handler(self, handler, *args):
+        try:
+            await handler(*args)
+        finally:
+            self.notify_state_changed()
+
     async def _on_address_status(self, addr, status):
         """Handle the change of the status of an address.
         Should remove addr from self._handling_addr_statuses when done.
@@ -372,7 +397,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             addr = self.scripthash_to_address[h]
             self._handling_addr_statuses.add(addr)
             self.requested_addrs.discard(addr)  # ok for addr not to be present
-            await self.taskgroup.spawn(self._on_address_status, addr, status)
+            await self.taskgroup.spawn(self._run_handler, self._on_address_status, addr, status)
             self._processed_some_notifications = True
 
     async def handle_asset_status(self):
@@ -380,7 +405,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, status = await self.asset_status_queue.get()
             self._handling_asset_statuses.add(asset)
             self.requested_assets.discard(asset)
-            await self.taskgroup.spawn(self._on_asset_status, asset, status)
+            await self.taskgroup.spawn(self._run_handler, self._on_asset_status, asset, status)
             self._processed_some_asset_notifications = True
 
     async def handle_qualifier_for_tags_status(self):
@@ -388,7 +413,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, status = await self.qualifier_tags_status_queue.get()
             self._handling_qualifiers_for_tags_statuses.add(asset)
             self.requested_qualifiers_for_tags.discard(asset)
-            await self.taskgroup.spawn(self._on_qualifier_for_tags_status, asset, status)
+            await self.taskgroup.spawn(self._run_handler, self._on_qualifier_for_tags_status, asset, status)
             self._processed_some_qualifier_for_tags_notifications = True
 
     async def handle_h160_for_tags_status(self):
@@ -396,7 +421,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             h160, status = await self.h160_tags_status_queue.get()
             self._handling_h160s_for_tags_statuses.add(h160)
             self.requested_h160s_for_tags.discard(h160)
-            await self.taskgroup.spawn(self._on_h160_for_tags_status, h160, status)
+            await self.taskgroup.spawn(self._run_handler, self._on_h160_for_tags_status, h160, status)
             self._processed_some_h160_for_tags_notifications = True
 
     async def handle_restricted_for_verifier_update(self):
@@ -404,7 +429,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, data = await self.restricted_verifier_queue.get()
             self._handling_restricted_for_verifier.add(asset)
             self.requested_restricted_for_verifier.discard(asset)
-            await self.taskgroup.spawn(self._on_restricted_for_verifier_update, asset, data)
+            await self.taskgroup.spawn(self._run_handler, self._on_restricted_for_verifier_update, asset, data)
             self._processed_some_restricted_for_verifier = True
 
     async def handle_restricted_for_freeze_update(self):
@@ -412,7 +437,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, data = await self.restricted_freeze_queue.get()
             self._handling_restricted_for_freeze.add(asset)
             self.requested_restricted_for_freeze.discard(asset)
-            await self.taskgroup.spawn(self._on_restricted_for_freeze_update, asset, data)
+            await self.taskgroup.spawn(self._run_handler, self._on_restricted_for_freeze_update, asset, data)
             self._processed_some_restricted_for_freeze = True
 
     async def handle_broadcast_status(self):
@@ -420,7 +445,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, status = await self.broadcast_status_queue.get()
             self._handling_broadcast_statuses.add(asset)
             self.requested_broadcasts.discard(asset)
-            await self.taskgroup.spawn(self._on_broadcast_status, asset, status)
+            await self.taskgroup.spawn(self._run_handler, self._on_broadcast_status, asset, status)
             self._processed_some_broadcasts = True
 
     async def handle_qualifier_associations_status(self):
@@ -428,7 +453,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, status = await self.qualifier_association_status_queue.get()
             self._handling_qualifier_association_statuses.add(asset)
             self.requested_qualifier_associations.discard(asset)
-            await self.taskgroup.spawn(self._on_qualifier_associations_status, asset, status)
+            await self.taskgroup.spawn(self._run_handler, self._on_qualifier_associations_status, asset, status)
             self._processed_some_qualifier_associations = True
 
     async def main(self):
@@ -450,6 +475,8 @@ class Synchronizer(SynchronizerBase):
     def _reset(self):
         super()._reset()
         self._init_done = False
+        self._catching_up = True  # until up to date for the first time
+        self._fanout_counter = itertools.count()
         self.requested_tx = {}
 
         self.requested_histories = set()
@@ -761,7 +788,7 @@ class Synchronizer(SynchronizerBase):
         h = address_to_scripthash(addr)
         self._requests_sent += 1
         async with self._network_request_semaphore:
-            result = await self.interface.get_history_for_scripthash(h)
+            result = await self._get_history_for_scripthash(h, status)
         self._requests_answered += 1
         self.logger.info(f"receiving history {addr} {len(result)}")
         hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
@@ -789,6 +816,41 @@ class Synchronizer(SynchronizerBase):
         # Remove request; this allows up_to_date to be True
         self.requested_histories.discard((addr, status))
 
+    def _get_interface_for_fetching(self) -> 'Interface':
+        """While catching up (e.g. when restoring a wallet), histories and
+        transactions are fetched from several servers in turn, if NETWORK_SYNC_FANOUT
+        is set. Subscriptions and SPV always use the main server.
+        """
+        if not (self._catching_up and self.network.config.NETWORK_SYNC_FANOUT):
+            return self.interface
+        interfaces = self.network.get_interfaces_for_sync_fanout()
+        if self.interface not in interfaces:  # main server is being switched
+            return self.interface
+        return interfaces[next(self._fanout_counter) % len(interfaces)]
+
+    async def _get_history_for_scripthash(self, h: str, status: str) -> List[dict]:
+        iface = self._get_interface_for_fetching()
+        if iface is not self.interface:
+            try:
+                result = await iface.get_history_for_scripthash(h)
+            except Exception as e:
+                self.logger.info(f"cannot get history from {iface.server}: {e!r}")
+            else:
+                if history_status([(item['tx_hash'], item['height']) for item in result]) == status:
+                    return result
+                # this server might lag behind the main server, which announced the status
+        return await self.interface.get_history_for_scripthash(h)
+
+    async def _get_raw_transaction(self, tx_hash: str) -> str:
+        iface = self._get_interface_for_fetching()
+        if iface is not self.interface:
+            try:
+                # note: the txid of the tx is checked
+                return await iface.get_transaction(tx_hash)
+            except Exception as e:
+                self.logger.info(f"cannot get tx from {iface.server}: {e!r}")
+        return await self.interface.get_transaction(tx_hash)
+
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
         transaction_hashes = []
@@ -802,6 +864,7 @@ class Synchronizer(SynchronizerBase):
             self.requested_tx[tx_hash] = tx_height
 
         if not transaction_hashes: return
+        # note: concurrent requests are coalesced into batches by the session
         async with OldTaskGroup() as group:
             for tx_hash in transaction_hashes:
                 await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
@@ -810,7 +873,7 @@ class Synchronizer(SynchronizerBase):
         self._requests_sent += 1
         try:
             async with self._network_request_semaphore:
-                raw_tx = await self.interface.get_transaction(tx_hash)
+                raw_tx = await self._get_raw_transaction(tx_hash)
         except RPCError as e:
             # most likely, "No such mempool or blockchain transaction"
             if allow_server_not_finding_tx:
@@ -829,13 +892,16 @@ class Synchronizer(SynchronizerBase):
 
     async def main(self):
         self.adb.up_to_date_changed()
-        # request missing txns, if any
+        # request missing txns, if any.
+        # all at once, so that the requests get batched (see Interface.get_transaction)
+        missing = []
         for addr in random_shuffled_copy(self.adb.db.get_history()):
             history = self.adb.db.get_addr_history(addr)
             # Old electrum servers returned ['*'] when all history for the address
             # was pruned. This no longer happens but may remain in old wallets.
             if history == ['*']: continue
-            await self._request_missing_txs(history, allow_server_not_finding_tx=True)
+            missing.extend(history)
+        await self._request_missing_txs(missing, allow_server_not_finding_tx=True)
         # add addresses to bootstrap
         for addr in random_shuffled_copy(self.adb.get_addresses()):
             await self._add_address(addr)
@@ -871,9 +937,11 @@ class Synchronizer(SynchronizerBase):
 
         # main loop
         self._init_done = True
+        self._state_changed.set()
         prev_uptodate = False
         while True:
-            await asyncio.sleep(0.1)
+            await self._state_changed.wait()
+            self._state_changed.clear()
             for addr in self._adding_addrs.copy(): # copy set to ensure iterator stability
                 await self._add_address(addr)
             for asset in self._adding_assets.copy():
@@ -891,6 +959,8 @@ class Synchronizer(SynchronizerBase):
             for asset in self._adding_qualifier_associations.copy():
                 await self._add_associations_for_qualifier(asset)
             up_to_date = self.adb.is_up_to_date()
+            if up_to_date:
+                self._catching_up = False
             # see if status changed
             if (up_to_date != prev_uptodate
                     or up_to_date and (self._processed_some_notifications or self._processed_some_asset_notifications or
@@ -0,0 +1,69 @@
+from electrum import asset
+from electrum.asset import (get_asset_info_from_script, get_asset_info_from_outputs, generate_create_script,
+                            generate_owner_script_from_base, generate_transfer_script_from_base, AssetVoutType,
+                            NoAssetVoutInformation, TransferAssetVoutInformation, MetadataAssetVoutInformation)
+from electrum.bitcoin import address_to_script, hash160_to_p2pkh, hash160_to_p2sh
+from electrum.transaction import TxOutput
+from electrum.util import bfh
+
+from . import ElectrumTestCase
+
+
+class TestAssetInfoFromScript(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.p2pkh_address = hash160_to_p2pkh(bytes(range(20)))
+        self.p2sh_address = hash160_to_p2sh(bytes(range(20)))
+
+    def _scripts(self):
+        for address in (self.p2pkh_address, self.p2sh_address):
+            base_script = address_to_script(address)
+            yield bfh(base_script)
+            yield bfh(generate_owner_script_from_base('ASSET', base_script))
+            yield bfh(generate_transfer_script_from_base('ASSET', 12_345, base_script))
+            yield bfh(generate_create_script(address, 'ASSET', 100_000_000, 2, True, None))
+            yield bfh(generate_create_script(address, 'ASSET', 100_000_000, 2, False, b'\x12\x20' + bytes(32)))
+
+    def _assert_same_info(self, expected, info):
+        self.assertIs(type(expected), type(info))
+        if expected is None:
+            return
+        for cls in type(expected).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                self.assertEqual(getattr(expected, name), getattr(info, name), name)
+
+    def test_fast_path_matches_full_decoding(self):
+        for script in self._scripts():
+            self.assertIsNotNone(asset._classify_standard_script(script))
+            self._assert_same_info(asset._decode_asset_info_from_script(script), get_asset_info_from_script(script))
+            # corrupted asset portions are left to the full decoder
+            for corrupted in (script[:-1], script + b'\x75', script[:-1] + b'\x00'):
+                self._assert_same_info(asset._decode_asset_info_from_script(corrupted),
+                                       get_asset_info_from_script(corrupted))
+
+    def test_transfer_script(self):
+        base_script = address_to_script(self.p2pkh_address)
+        script = bfh(generate_transfer_script_from_base('ASSET', 12_345, base_script))
+        info = get_asset_info_from_script(script)
+        self.assertIsInstance(info, TransferAssetVoutInformation)
+        self.assertEqual(AssetVoutType.TRANSFER, info.get_type())
+        self.assertEqual('ASSET', info.asset)
+        self.assertEqual(12_345, info.amount)
+        self.assertTrue(info.well_formed_script)
+        # memoized by script
+        self.assertIs(info, get_asset_info_from_script(bytes(script)))
+        self.assertIs(info, get_asset_info_from_script(bytearray(script)))
+
+    def test_non_standard_script(self):
+        self.assertIsNone(asset._classify_standard_script(bfh('0014' + '00' * 20)))
+        self.assertIsInstance(get_asset_info_from_script(bfh('0014' + '00' * 20)), NoAssetVoutInformation)
+        self.assertIsNone(get_asset_info_from_script(bfh('4c')))  # malformed
+
+    def test_get_asset_info_from_outputs(self):
+        scripts = list(self._scripts())
+        outputs = [TxOutput(scriptpubkey=script, value=0) for script in scripts]
+        infos = get_asset_info_from_outputs(outputs)
+        self.assertEqual([get_asset_info_from_script(script) for script in scripts], infos)
+        self.assertIsInstance(infos[3], MetadataAssetVoutInformation)
+        self.assertEqual(AssetVoutType.CREATE, infos[3].get_type())
@@ -0,0 +1,136 @@
+import sys
+
+from electrum.gui.background_refresher import BackgroundRefresher
+
+from . import ElectrumTestCase
+
+
+class MockTaskThread:
+    """Runs the tasks of a TaskThread one step at a time: compute_next() runs
+    a task as the thread would, and returns the callback that the GUI thread
+    would then call with the result.
+    """
+
+    def __init__(self):
+        self.tasks = []
+        self.errors = []
+        self.stopping = False
+
+    def add(self, task, on_success=None, on_done=None, on_error=None, *, cancel=None):
+        if self.stopping:
+            return False
+        self.tasks.append((task, on_success, on_done, on_error))
+        return True
+
+    def on_error(self, exc_info):
+        self.errors.append(exc_info[1])
+
+    def compute_next(self):
+        task, on_success, on_done, on_error = self.tasks.pop(0)
+        try:
+            result, cb = task(), on_success
+        except BaseException:
+            result, cb = sys.exc_info(), on_error
+
+        def deliver():
+            on_done()
+            cb(result)
+        return deliver
+
+    def run_all(self):
+        while self.tasks:
+            self.compute_next()()
+
+
+class TestBackgroundRefresher(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.thread = MockTaskThread()
+        self.refresher = BackgroundRefresher(self.thread)
+        self.computed = []
+        self.applied = []
+
+    def compute(self, name, check_cancelled):
+        self.computed.append(name)
+        return name
+
+    def request(self, name):
+        self.refresher.request(lambda check_cancelled: self.compute(name, check_cancelled), self.applied.append)
+
+    def test_only_latest_request_is_computed_and_applied(self):
+        self.request('a')
+        self.request('b')
+        self.request('c')
+        self.assertTrue(self.refresher.is_busy())
+        self.thread.run_all()
+        self.assertEqual(['c'], self.computed)
+        self.assertEqual(['c'], self.applied)
+        self.assertFalse(self.refresher.is_busy())
+        self.assertEqual([], self.thread.errors)
+
+    def test_stale_result_does_not_overwrite_newer_request(self):
+        self.request('a')
+        deliver_a = self.thread.compute_next()
+        self.request('b')  # while the result of 'a' is on its way to the GUI thread
+        deliver_a()
+        self.assertEqual([], self.applied)
+        self.assertTrue(self.refresher.is_busy())
+        self.thread.run_all()
+        self.assertEqual(['b'], self.applied)
+        self.assertFalse(self.refresher.is_busy())
+
+    def test_stale_result_delivered_after_newer_one_is_dropped(self):
+        self.request('a')
+        deliver_a = self.thread.compute_next()
+        self.request('b')
+        self.thread.compute_next()()
+        deliver_a()
+        self.assertEqual(['b'], self.applied)
+        self.assertFalse(self.refresher.is_busy())
+
+    def test_running_computation_stops_when_cancelled(self):
+        def compute(check_cancelled):
+            self.computed.append('a')
+            self.request('b')  # e.g. the wallet changed in the meantime
+            check_cancelled()
+            self.computed.append('a finished')
+            return 'a'
+        self.refresher.request(compute, self.applied.append)
+        self.thread.run_all()
+        self.assertEqual(['a', 'b'], self.computed)
+        self.assertEqual(['b'], self.applied)
+        self.assertEqual([], self.thread.errors)  # cancellations are not errors
+
+    def test_cancel(self):
+        self.request('a')
+        self.refresher.cancel()
+        self.thread.run_all()
+        self.assertEqual([], self.computed)
+        self.assertEqual([], self.applied)
+        self.assertFalse(self.refresher.is_busy())
+
+    def test_errors_are_reported(self):
+        def compute(check_cancelled):
+            raise ValueError('boom')
+        self.refresher.request(compute, self.applied.append)
+        self.thread.run_all()
+        self.assertEqual([], self.applied)
+        self.assertEqual(1, len(self.thread.errors))
+        self.assertIsInstance(self.thread.errors[0], ValueError)
+        self.assertFalse(self.refresher.is_busy())
+
+    def test_refreshers_are_independent(self):
+        other = BackgroundRefresher(self.thread)
+        other_applied = []
+        other.request(lambda check_cancelled: 'x', other_applied.append)
+        self.request('a')
+        self.thread.run_all()
+        self.assertEqual(['x'], other_applied)
+        self.assertEqual(['a'], self.applied)
+
+    def test_request_while_thread_is_stopping(self):
+        self.thread.stopping = True
+        self.request('a')
+        self.assertFalse(self.refresher.is_busy())
+        self.assertEqual([], self.applied)
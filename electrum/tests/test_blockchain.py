@@ -1,10 +1,16 @@
 import shutil
 import tempfile
 import os
+from unittest import mock
 
 from electrum import constants, blockchain
 from electrum.simple_config import SimpleConfig
-from electrum.blockchain import Blockchain, deserialize_header, hash_header, InvalidHeader
+from electrum.blockchain import (Blockchain, deserialize_header, hash_header, InvalidHeader,
+                                 split_chunk_into_raw_headers, hash_raw_headers, HeaderStore,
+                                 DGWState, NotEnoughHeaders, HEADER_SIZE, LEGACY_HEADER_SIZE, DGW_PASTBLOCKS,
+                                 export_header_snapshot, import_header_snapshot, InvalidHeaderSnapshot,
+                                 work_from_bits)
+from electrum.crypto import sha256d
 from electrum.util import bfh, make_dir
 
 from . import ElectrumTestCase
@@ -458,3 +464,436 @@ class TestVerifyHeader(ElectrumTestCase):
         with self.assertRaises(InvalidHeader):
             self.header["nonce"] = 42
             Blockchain.verify_header(self.header, self.prev_hash, self.target)
+
+
+class TestSplitChunk(ElectrumTestCase):
+
+    def test_split_across_kawpow_activation(self):
+        start_height = constants.net.KawpowActivationHeight - 2
+        data = bytes(LEGACY_HEADER_SIZE) * 2 + bytes(HEADER_SIZE) * 2
+        raw_headers = split_chunk_into_raw_headers(start_height, data)
+        self.assertEqual([LEGACY_HEADER_SIZE, LEGACY_HEADER_SIZE, HEADER_SIZE, HEADER_SIZE],
+                         [len(raw) for raw in raw_headers])
+
+    def test_truncated_chunk(self):
+        start_height = constants.net.KawpowActivationHeight
+        data = bytes(HEADER_SIZE) + bytes(HEADER_SIZE - 1)
+        with self.assertRaisesRegex(Exception, 'Invalid header length'):
+            split_chunk_into_raw_headers(start_height, data)
+
+
+class TestHeaderStore(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.electrum_path, 'blockchain_headers')
+        # kawpow headers, as kawpow hashes any junk
+        ts = constants.net.KawpowActivationTS
+        self.raw_headers = [bytes([i]) * 68 + (ts + i).to_bytes(4, 'little') + bytes([i]) * 48
+                            for i in range(1, 4)]
+        with open(self.path, 'wb') as f:
+            f.write(b''.join(self.raw_headers) + bytes(HEADER_SIZE))
+
+    def test_hash_and_bits(self):
+        store = HeaderStore(self.path, 4)
+        try:
+            for delta, raw in enumerate(self.raw_headers):
+                bits = int.from_bytes(raw[72:76], 'little')
+                self.assertEqual((hash_raw_headers([raw])[0], bits), store.get_hash_and_bits(delta))
+            self.assertIsNone(store.get_hash_and_bits(3))
+        finally:
+            store.close()
+        with open(HeaderStore.index_path(self.path), 'rb') as f:
+            index = f.read()
+        self.assertEqual(4 * HeaderStore.INDEX_RECORD_SIZE, len(index))
+        self.assertEqual(hash_raw_headers(self.raw_headers[:1])[0], index[:32].hex())
+
+    def test_stale_index_record_is_recomputed(self):
+        store = HeaderStore(self.path, 4)
+        store.get_hash_and_bits(1)
+        store.close()
+        new_raw = bytes([7]) * 68 + self.raw_headers[1][68:72] + bytes([7]) * 48
+        with open(self.path, 'rb+') as f:
+            f.seek(HEADER_SIZE)
+            f.write(new_raw)
+        store = HeaderStore(self.path, 4)
+        try:
+            self.assertEqual(hash_raw_headers([new_raw])[0], store.get_hash_and_bits(1)[0])
+        finally:
+            store.close()
+
+    def test_damaged_index_record_is_recomputed(self):
+        store = HeaderStore(self.path, 4)
+        for delta in range(3):
+            store.get_hash_and_bits(delta)
+        store.close()
+        # a damaged hash, and damaged bits, below the tip
+        with open(HeaderStore.index_path(self.path), 'rb+') as f:
+            f.seek(0)
+            f.write(bytes([0xee]) * 32)
+            f.seek(HeaderStore.INDEX_RECORD_SIZE + 32)
+            f.write(bytes([0xee]) * 4)
+        store = HeaderStore(self.path, 4)
+        try:
+            for delta, raw in enumerate(self.raw_headers):
+                bits = int.from_bytes(raw[72:76], 'little')
+                self.assertEqual((hash_raw_headers([raw])[0], bits), store.get_hash_and_bits(delta))
+        finally:
+            store.close()
+        with open(HeaderStore.index_path(self.path), 'rb') as f:
+            self.assertEqual(hash_raw_headers(self.raw_headers[:1])[0], f.read(32).hex())
+
+
+class TestDGWState(ElectrumTestCase):
+
+    class NoHeaders:
+        def read_header(self, height):
+            return None
+
+    def setUp(self):
+        super().setUp()
+        self.chain = {}
+        timestamp = 1600000000
+        for height in range(DGW_PASTBLOCKS + 50):
+            timestamp += (height * 7919) % 190 - 40
+            bits = 0x1b0404cb + (height * 104729) % 0xffff
+            self.chain[height] = {'bits': bits, 'timestamp': timestamp}
+
+    def test_not_enough_headers(self):
+        with self.assertRaises(NotEnoughHeaders):
+            DGWState().load(self.NoHeaders(), DGW_PASTBLOCKS - 1, self.chain)
+
+    def test_sliding_window_matches_fresh_load(self):
+        blockchain_ = self.NoHeaders()
+        state = DGWState()
+        state.load(blockchain_, DGW_PASTBLOCKS, self.chain)
+        for height in range(DGW_PASTBLOCKS + 1, len(self.chain)):
+            self.assertTrue(state.can_compute(height))
+            fresh_state = DGWState()
+            fresh_state.load(blockchain_, height - 1, self.chain)
+            self.assertEqual(fresh_state.get_target(height), state.get_target(height))
+            state.push(height, self.chain[height]['bits'], self.chain[height]['timestamp'])
+
+    def test_push_gap_resets_window(self):
+        state = DGWState()
+        state.load(self.NoHeaders(), DGW_PASTBLOCKS, self.chain)
+        state.push(DGW_PASTBLOCKS + 2, 0x1b0404cb, 1600000000)
+        self.assertFalse(state.can_compute(DGW_PASTBLOCKS + 3))
+
+
+class TestHeadersDurability(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_dir(os.path.join(self.electrum_path, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        blockchain.blockchains = {}
+        self.chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(self.chain.path(), 'w+').close()
+        self.raw_headers = [bytes([i]) * 68 + bytes([i]) * 52 for i in range(1, 4)]
+
+    def test_appends_are_synced_in_groups(self):
+        marker = self.chain.path() + '.unsynced'
+        for delta, raw in enumerate(self.raw_headers):
+            self.chain.write(raw, delta * HEADER_SIZE)
+            self.assertTrue(os.path.exists(marker))
+        self.chain.sync_to_disk()
+        self.assertFalse(os.path.exists(marker))
+        self.assertEqual(2, self.chain.height())
+
+    def test_fsync_every_write(self):
+        self.config.HEADERS_FSYNC_INTERVAL = 0
+        self.chain.write(self.raw_headers[0], 0)
+        self.assertFalse(os.path.exists(self.chain.path() + '.unsynced'))
+
+    def test_recover_zeroes_incomplete_header_in_checkpoint_region(self):
+        for delta, raw in enumerate(self.raw_headers):
+            self.chain.write(raw, delta * HEADER_SIZE)
+        # crash: the start of the second header never made it to disk
+        with open(self.chain.path(), 'rb+') as f:
+            f.seek(HEADER_SIZE)
+            f.write(bytes(HEADER_SIZE // 2))
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        chain.recover_unsynced_writes()
+        self.assertFalse(os.path.exists(chain.path() + '.unsynced'))
+        self.assertEqual(2, chain.height())
+        self.assertIsNone(chain.read_header(1))
+        self.assertIsNotNone(chain.read_header(2))
+
+
+    def test_recover_keeps_journaled_headers(self):
+        # headers that start or end with zeroes are fine, if they were written completely
+        raw_headers = [bytes(4) + raw[4:] for raw in self.raw_headers[:2]] + [self.raw_headers[2][:-4] + bytes(4)]
+        for delta, raw in enumerate(raw_headers):
+            self.chain.write(raw, delta * HEADER_SIZE)
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        chain.recover_unsynced_writes()
+        self.assertEqual(raw_headers, [chain._get_header_store().read_raw_header(delta) for delta in range(3)])
+
+    def test_recover_drops_headers_that_were_not_journaled(self):
+        fork_height = constants.net.max_checkpoint() + 1
+        fork = Blockchain(config=self.config, forkpoint=fork_height, parent=self.chain,
+                          forkpoint_hash=64 * 'a', prev_hash=64 * 'b')
+        open(fork.path(), 'w+').close()
+        for delta, raw in enumerate(self.raw_headers):
+            fork.write(raw, delta * HEADER_SIZE)
+        # crash: the journal line of the last write is cut
+        marker = fork.path() + '.unsynced'
+        with open(marker, 'rb+') as f:
+            f.truncate(os.path.getsize(marker) - 3)
+        fork = Blockchain(config=self.config, forkpoint=fork_height, parent=self.chain,
+                          forkpoint_hash=64 * 'a', prev_hash=64 * 'b')
+        fork.recover_unsynced_writes()
+        self.assertFalse(os.path.exists(marker))
+        self.assertEqual(fork_height + 1, fork.height())
+
+
+def make_kawpow_headers(start_height: int, prev_hash: str, bits: int, timestamps) -> list:
+    """Returns raw headers that link up with each other, starting after prev_hash."""
+    raw_headers = []
+    for i, timestamp in enumerate(timestamps):
+        height = start_height + i
+        raw = (bytes([1, 0, 0, 0]) + bytes.fromhex(prev_hash)[::-1] + bytes([i + 1]) * 32
+               + timestamp.to_bytes(4, 'little') + bits.to_bytes(4, 'little')
+               + height.to_bytes(4, 'little') + bytes([i + 1]) * 40)
+        raw_headers.append(raw)
+        prev_hash = hash_raw_headers([raw])[0]
+    return raw_headers
+
+
+def rewrite_snapshot(path: str, offset: int, data: bytes) -> str:
+    """Overwrites part of a header snapshot, and fixes up its checksum. Returns the new one."""
+    with open(path, 'rb+') as f:
+        f.seek(offset)
+        f.write(data)
+        f.seek(0)
+        content = f.read()[:-32]
+        checksum = sha256d(content)
+        f.seek(len(content))
+        f.write(checksum)
+    return checksum.hex()
+
+
+class TestHeaderSnapshot(ElectrumTestCase):
+    # no PoW on testnet, so that made-up headers are valid
+    TESTNET = True
+
+    def setUp(self):
+        super().setUp()
+        self.src_dir = os.path.join(self.electrum_path, 'src')
+        self.dst_dir = os.path.join(self.electrum_path, 'dst')
+        for d in (self.src_dir, self.dst_dir):
+            os.makedirs(os.path.join(d, 'forks'))
+        self.snapshot_path = os.path.join(self.electrum_path, 'headers.snapshot')
+        self.start_height = constants.net.max_checkpoint() + 1
+        self.bits = Blockchain.target_to_bits(blockchain.MAX_TARGET)
+        src_chain = self._new_chain(self.src_dir)
+        self.raw_headers = make_kawpow_headers(
+            self.start_height, src_chain.get_checkpointed_hash(self.start_height - 1), self.bits,
+            [constants.net.KawpowActivationTS + 60 * i for i in range(3)])
+        open(src_chain.path(), 'w+').close()
+        src_chain.write(b''.join(self.raw_headers), self.start_height * HEADER_SIZE, truncate=False)
+        self.result = export_header_snapshot(src_chain, self.snapshot_path)
+
+    def _new_chain(self, path) -> Blockchain:
+        blockchain.blockchains = {}
+        config = SimpleConfig({'electrum_path': path})
+        return Blockchain(config=config, forkpoint=0, parent=None,
+                          forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+
+    def test_export_then_import(self):
+        self.assertEqual(self.start_height, self.result['start_height'])
+        self.assertEqual(self.start_height + 2, self.result['height'])
+        chain = self._new_chain(self.dst_dir)
+        self.assertTrue(import_header_snapshot(chain, self.snapshot_path,
+                                               expected_checksum=self.result['sha256d']))
+        self.assertEqual(self.start_height + 2, chain.height())
+        self.assertEqual(hash_raw_headers(self.raw_headers[2:])[0], chain.get_hash(self.start_height + 2))
+        self.assertEqual(self.bits, chain.get_hash_and_bits(self.start_height + 1)[1])
+        # nothing to do once we have all the headers
+        self.assertFalse(import_header_snapshot(chain, self.snapshot_path,
+                                                expected_checksum=self.result['sha256d']))
+
+    def test_snapshot_chainwork(self):
+        with open(self.snapshot_path, 'rb') as f:
+            data = f.read()
+        last_record_end = len(data) - 32
+        self.assertEqual(3 * work_from_bits(self.bits),
+                         int.from_bytes(data[last_record_end - 32:last_record_end], 'big'))
+
+    def test_checksum_has_to_be_pinned(self):
+        chain = self._new_chain(self.dst_dir)
+        with self.assertRaises(InvalidHeaderSnapshot):
+            import_header_snapshot(chain, self.snapshot_path, expected_checksum=None)
+        self.assertEqual(-1, chain.height())
+
+    def test_corrupt_snapshot_is_rejected(self):
+        with open(self.snapshot_path, 'rb+') as f:
+            f.seek(blockchain.HEADER_SNAPSHOT_PREAMBLE.size + 50)
+            f.write(b'\xff')
+        chain = self._new_chain(self.dst_dir)
+        with self.assertRaises(InvalidHeaderSnapshot):
+            import_header_snapshot(chain, self.snapshot_path, expected_checksum=self.result['sha256d'])
+        self.assertEqual(-1, chain.height())
+
+    def test_unexpected_checksum_is_rejected(self):
+        chain = self._new_chain(self.dst_dir)
+        with self.assertRaises(InvalidHeaderSnapshot):
+            import_header_snapshot(chain, self.snapshot_path, expected_checksum='00' * 32)
+
+    def test_forged_hash_is_rejected(self):
+        # even if its checksum is pinned
+        offset = blockchain.HEADER_SNAPSHOT_PREAMBLE.size + 2 * blockchain.HEADER_SNAPSHOT_RECORD_SIZE + HEADER_SIZE
+        checksum = rewrite_snapshot(self.snapshot_path, offset, bytes(32))
+        chain = self._new_chain(self.dst_dir)
+        with self.assertRaises(InvalidHeaderSnapshot) as ctx:
+            import_header_snapshot(chain, self.snapshot_path, expected_checksum=checksum)
+        self.assertIn('wrong hash', str(ctx.exception))
+        self.assertEqual(-1, chain.height())
+
+    def test_checkpointed_headers_are_not_hashed(self):
+        hashed = []
+        def hash_raw_headers_blocking(raw_headers, *, config=None):
+            hashed.extend(raw_headers)
+            return hash_raw_headers(raw_headers)
+        is_dgw_height_checkpoint = Blockchain.is_dgw_height_checkpoint
+        def is_real_checkpoint(height):
+            return is_dgw_height_checkpoint(height) if height < self.start_height else None
+        chain = self._new_chain(self.dst_dir)
+        # as if the first header of the snapshot was covered by the last checkpoint
+        with mock.patch.object(constants.net, 'max_checkpoint', return_value=self.start_height), \
+                mock.patch.object(Blockchain, 'is_dgw_height_checkpoint', staticmethod(is_real_checkpoint)), \
+                mock.patch.object(blockchain, 'hash_raw_headers_blocking', hash_raw_headers_blocking):
+            self.assertTrue(import_header_snapshot(chain, self.snapshot_path,
+                                                   expected_checksum=self.result['sha256d']))
+        self.assertEqual(self.raw_headers[1:], hashed)
+        self.assertEqual(hash_raw_headers(self.raw_headers[:1])[0], chain.get_hash(self.start_height))
+
+
+class TestHeaderSnapshotProofOfWork(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join(self.electrum_path, 'forks'))
+        blockchain.blockchains = {}
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(self.chain.path(), 'w+').close()
+        self.max_checkpoint = constants.net.max_checkpoint()
+        # the headers before the last checkpoint, that the first DGW targets after it are computed from
+        self.bits = Blockchain.target_to_bits(blockchain.MAX_TARGET)
+        self.timestamps = [constants.net.KawpowActivationTS + 60 * i for i in range(DGW_PASTBLOCKS + 4)]
+        dgw_start = self.max_checkpoint - DGW_PASTBLOCKS
+        self.stored_headers = make_kawpow_headers(dgw_start, 64 * '0', self.bits, self.timestamps[:DGW_PASTBLOCKS + 1])
+        self.chain.write(b''.join(self.stored_headers), dgw_start * HEADER_SIZE, truncate=False)
+        dgw_state = DGWState()
+        dgw_state.load(self.chain, self.max_checkpoint)
+        self.target = dgw_state.get_target(self.max_checkpoint + 1)
+        self.snapshot_path = os.path.join(self.electrum_path, 'headers.snapshot')
+
+    def _write_snapshot(self, bits: int) -> str:
+        start_height = self.max_checkpoint + 1
+        raw_headers = make_kawpow_headers(start_height, self.chain.get_checkpointed_hash(self.max_checkpoint),
+                                          bits, self.timestamps[DGW_PASTBLOCKS + 1:])
+        chainwork = 0
+        records = []
+        for raw, header_hash in zip(raw_headers, hash_raw_headers(raw_headers)):
+            chainwork += work_from_bits(bits)
+            records.append(raw + bytes.fromhex(header_hash) + chainwork.to_bytes(32, 'big'))
+        data = blockchain.HEADER_SNAPSHOT_PREAMBLE.pack(
+            blockchain.HEADER_SNAPSHOT_MAGIC, bytes.fromhex(constants.net.GENESIS), start_height, len(records))
+        data += b''.join(records)
+        with open(self.snapshot_path, 'wb') as f:
+            f.write(data + sha256d(data))
+        return sha256d(data).hex()
+
+    def _assert_rejected(self, checksum: str, reason: str):
+        with self.assertRaises(InvalidHeaderSnapshot) as ctx:
+            import_header_snapshot(self.chain, self.snapshot_path, expected_checksum=checksum)
+        self.assertIn(reason, str(ctx.exception))
+        # our headers were not touched
+        self.assertEqual(self.max_checkpoint, self.chain.height())
+        self.assertEqual(self.stored_headers[-1], self.chain._get_header_store().read_raw_header(self.max_checkpoint))
+
+    def test_insufficient_pow_is_rejected(self):
+        self._assert_rejected(self._write_snapshot(Blockchain.target_to_bits(self.target)), 'insufficient proof of work')
+
+    def test_wrong_target_is_rejected(self):
+        self._assert_rejected(self._write_snapshot(self.bits), 'bits mismatch')
+
+class TestChainworkIndex(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_dir(os.path.join(self.electrum_path, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        blockchain.blockchains = {}
+        self.chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(self.chain.path(), 'w+').close()
+        self.first_height = constants.net.max_checkpoint() + 1
+        self.bits = [Blockchain.target_to_bits(blockchain.MAX_TARGET >> i) for i in range(3)]
+        self.raw_headers = [bytes([i + 1]) * 72 + bits.to_bytes(4, 'little') + bytes([i + 1]) * 44
+                            for i, bits in enumerate(self.bits)]
+        self.chain.write(b''.join(self.raw_headers), self.first_height * HEADER_SIZE, truncate=False)
+
+    def test_work_is_counted_from_last_checkpoint(self):
+        self.assertEqual(0, self.chain.get_chainwork(self.first_height - 1))
+        work = 0
+        for i, bits in enumerate(self.bits):
+            work += work_from_bits(bits)
+            self.assertEqual(work, self.chain.get_chainwork(self.first_height + i))
+        self.assertEqual(work, self.chain.get_chainwork())
+
+    def test_overwrite_updates_index(self):
+        new_raw = bytes([9]) * 72 + self.bits[0].to_bytes(4, 'little') + bytes([9]) * 44
+        self.chain.write(new_raw, (self.first_height + 1) * HEADER_SIZE)
+        self.assertEqual(self.first_height + 1, self.chain.height())
+        self.assertEqual(2 * work_from_bits(self.bits[0]), self.chain.get_chainwork())
+
+    def test_stale_index_is_rebuilt(self):
+        expected = self.chain.get_chainwork()
+        with open(self.chain.path() + '.work', 'rb+') as f:
+            f.truncate(0)
+        self.chain.update_size()
+        self.assertEqual(expected, self.chain.get_chainwork())
+
+    def test_tampered_index_is_dropped(self):
+        expected = self.chain.get_chainwork()
+        self.assertTrue(self.chain.verify_chainwork_index())
+        # a wrong work, with a crc that matches the header
+        with open(self.chain.path() + '.work', 'rb+') as f:
+            f.seek(blockchain.CHAINWORK_RECORD_SIZE)
+            f.write((10 ** 30).to_bytes(32, 'big'))
+        self.chain.update_size()
+        self.assertFalse(self.chain.verify_chainwork_index())
+        self.assertEqual(blockchain.CHAINWORK_RECORD_SIZE, os.path.getsize(self.chain.path() + '.work'))
+        self.assertEqual(expected, self.chain.get_chainwork())
+        self.assertTrue(self.chain.verify_chainwork_index())
+
+    def test_work_is_recomputed_without_index(self):
+        expected = self.chain.get_chainwork()
+        os.unlink(self.chain.path() + '.work')
+        os.mkdir(self.chain.path() + '.work')  # cannot be written
+        self.chain.update_size()
+        self.assertEqual(expected, self.chain.get_chainwork())
+        with self.assertRaises(blockchain.MissingHeader):
+            self.chain.get_chainwork(self.chain.height() + 1)
+
+    def test_missing_header_raises(self):
+        self.chain.write(bytes(HEADER_SIZE) + self.raw_headers[0], (self.first_height + 3) * HEADER_SIZE)
+        with self.assertRaises(blockchain.MissingHeader):
+            self.chain.get_chainwork()
+
+    def test_fork_adds_to_parent_work(self):
+        fork_height = self.first_height + 2
+        fork = Blockchain(config=self.config, forkpoint=fork_height, parent=self.chain,
+                          forkpoint_hash=64 * 'a', prev_hash=64 * 'b')
+        open(fork.path(), 'w+').close()
+        fork.write(self.raw_headers[0], 0)
+        self.assertEqual(self.chain.get_chainwork(fork_height - 1) + work_from_bits(self.bits[0]),
+                         fork.get_chainwork())
@@ -1,4 +1,6 @@
-from electrum.coinchooser import CoinChooserPrivacy
+import itertools
+
+from electrum.coinchooser import CoinChooserPrivacy, CoinChooserScalable, PRNG
 from electrum.util import NotEnoughFunds
 
 from . import ElectrumTestCase
@@ -18,3 +20,23 @@ class TestCoinChooser(ElectrumTestCase):
             coin_chooser.bucket_candidates_any([], sufficient_funds)
         with self.assertRaises(NotEnoughFunds):
             coin_chooser.bucket_candidates_prefer_confirmed([], sufficient_funds)
+
+    def test_prng_is_deterministic(self):
+        p = PRNG(b'seed')
+        self.assertEqual([1, 178, 88, 139, 69130], [p.randint(0, n) for n in (2, 255, 256, 257, 70000)])
+        x = list(range(20))
+        p.shuffle(x)
+        self.assertEqual([18, 14, 8, 10, 16, 1, 12, 6, 19, 2, 17, 9, 4, 7, 15, 5, 13, 3, 0, 11], x)
+
+    def test_branch_and_bound(self):
+        values = [90, 70, 55, 40, 33, 21, 13, 8, 5, 2]
+        for lower in range(0, 350, 7):
+            for window in (0, 3, 10):
+                upper = lower + window
+                feasible = [sum(c) for r in range(len(values) + 1)
+                            for c in itertools.combinations(values, r) if lower <= sum(c) <= upper]
+                selection = CoinChooserScalable._branch_and_bound(values, lower, upper)
+                if not feasible:
+                    self.assertIsNone(selection)
+                    continue
+                self.assertEqual(min(feasible), sum(values[i] for i in selection))
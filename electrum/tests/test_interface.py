@@ -1,4 +1,13 @@
-from electrum.interface import ServerAddr
+import asyncio
+import threading
+
+from aiorpcx import RPCError
+
+from electrum import constants
+from electrum import interface
+from electrum import util
+from electrum.interface import Interface, ServerAddr, NotificationSession, RequestCorrupted
+from electrum.simple_config import SimpleConfig
 
 from . import ElectrumTestCase
 
@@ -46,3 +55,150 @@ class TestServerAddr(ElectrumTestCase):
                          ServerAddr(host="2400:6180:0:d1::86b:e001", port=50002, protocol="s").to_friendly_name())
         self.assertEqual("[2400:6180:0:d1::86b:e001]:50001:t",
                          ServerAddr(host="2400:6180:0:d1::86b:e001", port=50001, protocol="t").to_friendly_name())
+
+
+class MockTransport:
+    kind = 'TCP'
+
+    def remote_address(self):
+        return None
+
+
+class MockBatchingSession(NotificationSession):
+
+    def __init__(self):
+        super().__init__(MockTransport(), interface=None)
+        self.batches = []
+
+    async def _send_batch(self, requests, *, timeout=None):
+        self.batches.append(list(requests))
+        return [RPCError(1, 'not found') if params == ['bad'] else params[0]
+                for method, params in requests]
+
+
+class TestNotificationSession(ElectrumTestCase):
+
+    async def test_requests_are_coalesced(self):
+        session = MockBatchingSession()
+        results = await asyncio.gather(
+            *[session.send_request_coalesced('m', [i]) for i in range(5)],
+            session.send_request_coalesced('m', ['bad']),
+            return_exceptions=True)
+        self.assertEqual([0, 1, 2, 3, 4], results[:5])
+        self.assertIsInstance(results[5], RPCError)
+        self.assertEqual(1, len(session.batches))
+
+    async def test_batch_size_is_limited(self):
+        session = MockBatchingSession()
+        n = interface.BATCH_MAX_SIZE + 1
+        results = await asyncio.gather(*[session.send_request_coalesced('m', [i]) for i in range(n)])
+        self.assertEqual(list(range(n)), results)
+        self.assertEqual([interface.BATCH_MAX_SIZE, 1], [len(b) for b in session.batches])
+        results = await session.send_request_batch([('m', [i]) for i in range(n)])
+        self.assertEqual(list(range(n)), results)
+        self.assertEqual([interface.BATCH_MAX_SIZE, 1], [len(b) for b in session.batches[2:]])
+
+
+class MockNetwork:
+
+    def __init__(self, config):
+        self.asyncio_loop = util.get_asyncio_loop()
+        self.taskgroup = util.OldTaskGroup()
+        self.config = config
+        self.interfaces = {}
+        self.interfaces_lock = threading.Lock()
+
+
+class MockChunkBlockchain:
+
+    def __init__(self, good_chunks):
+        self.good_chunks = good_chunks
+        self.connected = []
+
+    async def connect_chunk(self, height, hexdata):
+        if hexdata != self.good_chunks[height]:
+            return False
+        self.connected.append(height)
+        return True
+
+
+class MockChunkInterface(Interface):
+
+    def __init__(self, network, host, chunks, *, delays=None, failing=()):
+        super().__init__(network=network, server=ServerAddr(host, 50001, protocol='t'), proxy=None)
+        network.interfaces[self.server] = self
+        self.tip = 10 ** 8
+        self.chunks = chunks
+        self.delays = delays or {}
+        self.failing = failing
+        self.fetched = []
+
+    async def _fetch_chunk(self, height, size):
+        self.fetched.append(height)
+        await asyncio.sleep(self.delays.get(height, 0))
+        if height in self.failing:
+            raise RequestCorrupted(f'no chunk at {height}')
+        return self.chunks[height]
+
+    def is_connected_and_ready(self):
+        return True
+
+    async def run(self):
+        return
+
+
+class TestPipelinedChunks(ElectrumTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.config.NETWORK_HEADER_PIPELINE_DEPTH = 3
+        self.network = MockNetwork(self.config)
+        # above the checkpoints, so that chunks need no alignment
+        self.start = (constants.net.max_checkpoint() // 2016 + 1) * 2016
+        self.heights = [self.start + i * 2016 for i in range(6)]
+        self.good_chunks = {height: f'chunk{height}' for height in self.heights}
+
+    def _make_interface(self, host, chunks=None, **kwargs):
+        iface = MockChunkInterface(self.network, host, chunks or self.good_chunks, **kwargs)
+        iface.blockchain = MockChunkBlockchain(self.good_chunks)
+        return iface
+
+    async def test_out_of_order_completion(self):
+        # the first chunks complete last
+        delays = {height: 0.01 * (len(self.heights) - i) for i, height in enumerate(self.heights)}
+        iface = self._make_interface('main', delays=delays)
+        other = self._make_interface('other', delays=delays)
+        self.assertEqual((True, 6 * 2016), await iface.request_chunks_pipelined(self.start, 6))
+        self.assertEqual(self.heights, iface.blockchain.connected)
+        # requests were spread over both interfaces
+        self.assertEqual(self.heights[0::2], iface.fetched)
+        self.assertEqual(self.heights[1::2], other.fetched)
+
+    async def test_bad_chunk_from_other_server_is_refetched(self):
+        iface = self._make_interface('main')
+        bad_chunks = dict(self.good_chunks)
+        bad_chunks[self.heights[1]] = 'forked'
+        self._make_interface('other', bad_chunks, failing=(self.heights[3],))
+        self.assertEqual((True, 6 * 2016), await iface.request_chunks_pipelined(self.start, 6))
+        self.assertEqual(self.heights, iface.blockchain.connected)
+        self.assertEqual(sorted(self.heights[0::2] + [self.heights[1], self.heights[3]]), sorted(iface.fetched))
+
+    async def test_chunk_that_does_not_connect(self):
+        bad_chunks = dict(self.good_chunks)
+        bad_chunks[self.heights[2]] = 'forked'
+        iface = self._make_interface('main', bad_chunks)
+        self.assertEqual((True, 2 * 2016), await iface.request_chunks_pipelined(self.start, 6))
+        self.assertEqual(self.heights[:2], iface.blockchain.connected)
+        bad_chunks[self.heights[0]] = 'forked'
+        iface = self._make_interface('main2', bad_chunks)
+        self.assertEqual((False, 0), await iface.request_chunks_pipelined(self.start, 6))
+
+    async def test_failure_mid_pipeline(self):
+        delays = {self.heights[4]: 10}
+        iface = self._make_interface('main', failing=(self.heights[2],), delays=delays)
+        with self.assertRaises(RequestCorrupted):
+            await iface.request_chunks_pipelined(self.start, 6)
+        # chunks before the failure stay connected, the requests in flight are cancelled
+        self.assertEqual(self.heights[:2], iface.blockchain.connected)
+        self.assertNotIn(self.heights[5], iface.fetched)
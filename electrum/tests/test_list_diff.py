@@ -0,0 +1,94 @@
+import random
+from collections import OrderedDict
+
+from electrum.address_synchronizer import AdbChanges
+from electrum.gui.list_diff import (group_consecutive, diff_ordered, diff_keyed,
+                                    get_row_to_insert_descending, get_affected_rows)
+
+from . import ElectrumTestCase
+
+
+def apply_ordered_diff(old: OrderedDict, new: OrderedDict, diff) -> list:
+    """Applies diff to the rows of old, the way a list model would."""
+    rows = list(old.items())
+    for first, last in diff.removed:
+        del rows[first:last + 1]
+    new_items = list(new.items())
+    for first, last in diff.inserted:
+        rows[first:first] = new_items[first:last + 1]
+    changed = {row for first, last in diff.changed for row in range(first, last + 1)}
+    for row, (key, item) in enumerate(rows):
+        if item != new[key]:
+            assert row in changed, row
+            rows[row] = (key, new[key])
+    return rows
+
+
+class TestListDiff(ElectrumTestCase):
+
+    def test_group_consecutive(self):
+        self.assertEqual([], group_consecutive([]))
+        self.assertEqual([(0, 2), (4, 4), (6, 7)], group_consecutive([0, 1, 2, 4, 6, 7]))
+
+    def test_diff_ordered(self):
+        old = OrderedDict([('a', 1), ('b', 2), ('c', 3), ('d', 4), ('e', 5)])
+        new = OrderedDict([('x', 0), ('a', 1), ('c', 30), ('d', 40), ('y', 0), ('z', 0)])
+        diff = diff_ordered(old, new)
+        self.assertEqual([(4, 4), (1, 1)], diff.removed)
+        self.assertEqual([(0, 0), (4, 5)], diff.inserted)
+        self.assertEqual([(2, 3)], diff.changed)
+        self.assertEqual(list(new.items()), apply_ordered_diff(old, new, diff))
+
+    def test_diff_ordered_unchanged(self):
+        old = OrderedDict([('a', 1), ('b', 2)])
+        self.assertEqual(([], [], []), diff_ordered(old, OrderedDict(old)))
+        self.assertEqual(([], [], []), diff_ordered(OrderedDict(), OrderedDict()))
+
+    def test_diff_ordered_reordered(self):
+        old = OrderedDict([('a', 1), ('b', 2), ('c', 3)])
+        self.assertIsNone(diff_ordered(old, OrderedDict([('b', 2), ('a', 1), ('c', 3)])))
+        # reordered and partly removed
+        self.assertIsNone(diff_ordered(old, OrderedDict([('c', 3), ('x', 0), ('a', 1)])))
+
+    def test_diff_ordered_random(self):
+        rng = random.Random(42)
+        for i in range(300):
+            keys = [k for k in range(20) if rng.random() < 0.5]
+            old = OrderedDict((k, rng.randrange(3)) for k in keys)
+            new = OrderedDict()
+            for k in range(20):
+                if k in old and rng.random() < 0.7:
+                    new[k] = old[k] if rng.random() < 0.5 else rng.randrange(3)
+                elif k not in old and rng.random() < 0.3:
+                    new[k] = rng.randrange(3)
+            diff = diff_ordered(old, new)
+            self.assertEqual(list(new.items()), apply_ordered_diff(old, new, diff))
+            num_changed = sum(last - first + 1 for first, last in diff.changed)
+            self.assertEqual(len([k for k in old if k in new and old[k] != new[k]]), num_changed)
+
+    def test_diff_keyed(self):
+        rows = {'a': 0, 'b': 1, 'c': 2, 'd': 3}
+        diff = diff_keyed(rows, {'a': None, 'c': None, 'b': 'B', 'x': 'X', 'y': None})
+        self.assertEqual([2, 0], diff.removed)
+        self.assertEqual([('b', 1, 'B')], diff.updated)
+        self.assertEqual([('x', 'X')], diff.added)
+        self.assertEqual(([], [], []), diff_keyed(rows, {}))
+
+    def test_get_row_to_insert_descending(self):
+        heights = [900, 800, 800, 0]
+        self.assertEqual(0, get_row_to_insert_descending(heights, 1000))
+        self.assertEqual(3, get_row_to_insert_descending(heights, 800))
+        self.assertEqual(3, get_row_to_insert_descending(heights, 1))
+        self.assertEqual(4, get_row_to_insert_descending(heights, 0))
+        self.assertEqual(4, get_row_to_insert_descending(heights, -1))
+        self.assertEqual(0, get_row_to_insert_descending([], 5))
+
+    def test_get_affected_rows(self):
+        changes = AdbChanges()
+        changes.add(txids=['aa'], addresses=['addr1'], assets=['FOO'])
+        affected = get_affected_rows(changes.take())
+        self.assertEqual({'aa'}, affected.txids)
+        self.assertEqual({'addr1'}, affected.addresses)
+        self.assertTrue(get_affected_rows(changes.take()).is_empty())
+        changes.add(addresses=['addr2'], everything=True)
+        self.assertIsNone(get_affected_rows(changes.take()))
@@ -0,0 +1,140 @@
+import asyncio
+from collections import Counter
+
+from aiorpcx import RPCError
+
+from electrum.address_synchronizer import AddressSynchronizer
+from electrum.bitcoin import address_to_scripthash, hash160_to_p2pkh
+from electrum.simple_config import SimpleConfig
+from electrum.synchronizer import Synchronizer, history_status
+from electrum.transaction import Transaction
+from electrum.wallet_db import WalletDB
+
+from . import ElectrumTestCase
+from .test_wallet import make_raw_tx
+
+
+class MockInterface:
+
+    def __init__(self, server, histories, txs, *, stale_histories=None, fail_txs=False):
+        self.server = server
+        self.histories = histories  # scripthash -> list of history items
+        self.stale_histories = stale_histories or {}  # served instead, as a lagging server would
+        self.txs = txs  # txid -> raw tx
+        self.fail_txs = fail_txs
+        self.calls = Counter()
+
+    async def get_history_for_scripthash(self, sh):
+        self.calls['history'] += 1
+        return self.stale_histories.get(sh, self.histories.get(sh, []))
+
+    async def get_transaction(self, tx_hash):
+        self.calls['tx'] += 1
+        if self.fail_txs:
+            raise RPCError(1, 'No such mempool or blockchain transaction')
+        return self.txs[tx_hash]
+
+
+class MockNetwork:
+
+    def __init__(self, config, interfaces):
+        self.config = config
+        self.asyncio_loop = asyncio.get_running_loop()
+        self.interface = None  # so that the Synchronizer does not start its tasks
+        self.interfaces = interfaces
+
+    def get_interfaces_for_sync_fanout(self):
+        return self.interfaces
+
+    def get_local_height(self):
+        return 1000
+
+    def get_network_timeout_seconds(self, *args):
+        return 10
+
+
+class TestSyncFanout(ElectrumTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.addrs = [hash160_to_p2pkh(bytes([i]) * 20) for i in range(1, 7)]
+        self.txs = {}
+        self.histories = {}
+        funding = make_raw_tx(['coinbase'], [(addr, 10_000 * (i + 1)) for i, addr in enumerate(self.addrs)])
+        self._add_tx(funding, 900)
+        prev = (funding.txid(), 0)
+        for i, addr in enumerate(self.addrs[1:]):
+            tx = make_raw_tx([prev], [(addr, 9_000 - i * 1_000)])
+            self._add_tx(tx, 901 + i if i < 3 else 0)
+            prev = (tx.txid(), 0)
+
+    def _add_tx(self, tx, height):
+        self.txs[tx.txid()] = tx.serialize()
+        related = {o.address for o in tx.outputs()}
+        for txin in tx.inputs():
+            prev_tx = self.txs.get(txin.prevout.txid.hex())
+            if prev_tx is not None:
+                related.add(Transaction(prev_tx).outputs()[txin.prevout.out_idx].address)
+        for addr in related:
+            self.histories.setdefault(address_to_scripthash(addr), []).append(
+                {'tx_hash': tx.txid(), 'height': height})
+
+    async def _sync(self, interfaces, *, fanout: bool) -> AddressSynchronizer:
+        config = SimpleConfig({'electrum_path': self.electrum_path})
+        config.NETWORK_SYNC_FANOUT = fanout
+        db = WalletDB('', storage=None, manual_upgrades=False)
+        db._load_assets()
+        db.put('stored_height', 1000)
+        adb = AddressSynchronizer(db, config)
+        adb.network = MockNetwork(config, interfaces)
+        synchronizer = Synchronizer(adb)
+        synchronizer.interface = interfaces[0]
+        try:
+            for addr in self.addrs:
+                adb.add_address(addr)
+            for addr in self.addrs:
+                h = self.histories[address_to_scripthash(addr)]
+                status = history_status([(item['tx_hash'], item['height']) for item in h])
+                await synchronizer._on_address_status(addr, status)
+            self.assertFalse(synchronizer.requested_histories)
+            self.assertFalse(synchronizer.requested_tx)
+        finally:
+            await synchronizer.stop()
+        return adb
+
+    def _snapshot(self, adb):
+        return {
+            'histories': {addr: adb.db.get_addr_history(addr) for addr in self.addrs},
+            'statuses': {addr: history_status(adb.db.get_addr_history(addr)) for addr in self.addrs},
+            'txs': {txid: adb.db.get_transaction(txid).serialize() for txid in adb.db.list_transactions()},
+            'history': [(item.txid, item.tx_mined_status.height, item.delta, item.balance)
+                        for item in adb.get_history(self.addrs)],
+            'balance': adb.get_balance(self.addrs),
+        }
+
+    async def test_fanout_matches_sequential_sync(self):
+        main = MockInterface('main', self.histories, self.txs)
+        expected = self._snapshot(await self._sync([main], fanout=False))
+        self.assertEqual(set(self.txs), set(expected['txs']))
+
+        # a server that lags behind the main server, and one that cannot find txs
+        stale = {sh: h[:-1] for sh, h in self.histories.items()}
+        main = MockInterface('main', self.histories, self.txs)
+        lagging = MockInterface('lagging', self.histories, self.txs, stale_histories=stale)
+        failing = MockInterface('failing', self.histories, self.txs, fail_txs=True)
+        adb = await self._sync([main, lagging, failing], fanout=True)
+        self.assertEqual(expected, self._snapshot(adb))
+        # the other servers were actually used
+        self.assertGreater(lagging.calls['history'], 0)
+        self.assertGreater(lagging.calls['tx'], 0)
+        self.assertGreater(failing.calls['history'], 0)
+        self.assertGreater(failing.calls['tx'], 0)
+        self.assertLess(main.calls['history'], len(self.addrs))
+
+    async def test_fanout_off_uses_main_server_only(self):
+        main = MockInterface('main', self.histories, self.txs)
+        other = MockInterface('other', self.histories, self.txs)
+        await self._sync([main, other], fanout=False)
+        self.assertEqual(Counter(), other.calls)
+        self.assertEqual(len(self.addrs), main.calls['history'])
+
@@ -9,6 +9,7 @@ from electrum.util import bfh
 from electrum.bitcoin import (deserialize_privkey, opcodes,
                               construct_script, construct_witness)
 from electrum.ecc import ECPrivkey
+from electrum.crypto import sha256d
 from electrum import descriptor
 
 from .test_bitcoin import disable_ecdsa_r_value_grinding
@@ -78,6 +79,21 @@ class TestBCDataStream(ElectrumTestCase):
         self.assertEqual(b'\x01\x00', s.read_bytes(2))
         self.assertFalse(s.can_read_more())
 
+    def test_load(self):
+        s = transaction.BCDataStream()
+        data = b'\x03foo\x01\x00\x00\x00'
+        s.load(data)
+        self.assertEqual(s.read_bytes(s.read_compact_size()), b'foo')
+        self.assertIsInstance(s.read_bytes(0), bytes)
+        self.assertEqual(s.read_uint32(), 1)
+        self.assertFalse(s.can_read_more())
+        with self.assertRaises(transaction.SerializationError):
+            s.read_bytes(1)
+        # writing after load copies, and leaves the loaded buffer alone
+        s.write(b'bar')
+        self.assertEqual(s.read_bytes(3), b'bar')
+        self.assertEqual(data, b'\x03foo\x01\x00\x00\x00')
+
 
 class TestTransaction(ElectrumTestCase):
     def test_match_against_script_template(self):
@@ -97,6 +113,27 @@ class TestTransaction(ElectrumTestCase):
         tx.update_signatures(signed_blob_signatures)
         self.assertEqual(tx.serialize(), signed_blob)
 
+    def test_sign_with_num_workers_matches_serial_signing(self):
+        def make_tx():
+            inputs = []
+            for i, script_type in enumerate(['p2pkh', 'p2wpkh', 'p2pkh', 'p2wpkh-p2sh', 'p2pkh']):
+                privkey = ECPrivkey(bytes([i + 1]) * 32)
+                txin = PartialTxInput(prevout=TxOutpoint(txid=bytes([i + 100]) * 32, out_idx=i))
+                txin.script_descriptor = descriptor.get_singlesig_descriptor_from_legacy_leaf(
+                    pubkey=privkey.get_public_key_hex(), script_type=script_type)
+                txin._trusted_value_sats = 200000 + i
+                inputs.append(txin)
+            outputs = [PartialTxOutput(scriptpubkey=bfh('76a914230ac37834073a42146f11ef8414ae929feaafc388ac'), value=900000)]
+            return PartialTransaction.from_io(inputs, outputs, locktime=0, version=2, BIP69_sort=False)
+        keypairs = {ECPrivkey(bytes([i + 1]) * 32).get_public_key_hex(): (bytes([i + 1]) * 32, True)
+                    for i in range(5)}
+        serial_tx = make_tx()
+        serial_tx.sign(keypairs, None)
+        self.assertTrue(serial_tx.is_complete())
+        parallel_tx = make_tx()
+        parallel_tx.sign(keypairs, None, num_workers=3)
+        self.assertEqual(serial_tx.serialize(), parallel_tx.serialize())
+
     def test_tx_setting_locktime_invalidates_ser_cache(self):
         tx = tx_from_any("cHNidP8BAJICAAAAAdAEtnw/IOVkr4oexG2xYnm+Vevsn3J7nbZsGpiBWS8MAQAAAAD9////A2Q5AwAAAAAAF6kUF6jKG6BuNVhq1RilflIDCitepw6H/NEEAAAAAAAXqRQx9SsFxDAaaOWbLB2ely1ZoZ61DYeIbQoAAAAAABYAFItCjFDsC28Z1R3tFaoi//pcInvnI3AZAAABAR+weRIAAAAAABYAFEK0I6qyqoA/lXCEgysQNZvqokaQIgYC9tgRn6/8hlDLEvEg3lKD1HmNim0gGRYwt4x3aJURIq4MqAq7DwEAAAAUAAAAAAAAIgICXYdVjyDIufLQ3yeDA4M8016luFER2SWaGPk6UF8CbuQMqAq7DwEAAAAXAAAAAA==")
         self.assertEqual("2774c819a05e44861a0555401d2741e6c03079cc4d892c69b910c0f52f407859", tx.txid())
@@ -279,6 +316,12 @@ class TestTransaction(ElectrumTestCase):
         self.assertEqual(txid, tx.txid())
         self.assertEqual(raw_tx, tx.serialize())
         self.assertTrue(tx.estimated_size() >= 0)
+        # the txid above is hashed from the raw bytes: check it against the re-serialized tx
+        wtxid = tx.wtxid()
+        tx.invalidate_ser_cache()
+        self.assertEqual(txid, tx.txid())
+        self.assertEqual(wtxid, tx.wtxid())
+        self.assertEqual(raw_tx, tx.serialize())
 
     def test_txid_coinbase_to_p2pk(self):
         raw_tx = '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4103400d0302ef02062f503253482f522cfabe6d6dd90d39663d10f8fd25ec88338295d4c6ce1c90d4aeb368d8bdbadcc1da3b635801000000000000000474073e03ffffffff013c25cf2d01000000434104b0bd634234abbb1ba1e986e884185c61cf43e001f9137f23c2c409273eb16e6537a576782eba668a7ef8bd3b3cfb1edb7117ab65129b8a2e681f3c1e0908ef7bac00000000'
@@ -992,3 +1035,67 @@ class TestSighashTypes(ElectrumTestCase):
         sig = tx.sign_txin(0,privkey)
         self.assertEqual('30440220525406a1482936d5a21888260dc165497a90a15669636d8edca6b9fe490d309c022032af0c646a34a44d1f4576bf6a4a74b67940f8faa84c7df9abe12a01a11e2b4783',
                          sig)
+
+
+class TestLegacySighashTypes(ElectrumTestCase):
+    # three non-segwit (bare multisig redeem script) inputs, two outputs
+
+    def _make_tx(self, sighash: int) -> PartialTransaction:
+        inputs = []
+        for i in range(3):
+            txin = PartialTxInput(prevout=TxOutpoint(txid=bytes([i + 1]) * 32, out_idx=i))
+            txin.redeem_script = bfh('5121' + '02' + '%02x' % (i + 1) * 32 + '51ae')
+            txin.nsequence = 0xfffffffd - i
+            txin.sighash = sighash
+            inputs.append(txin)
+        outputs = [PartialTxOutput(scriptpubkey=bfh('76a914' + '%02x' % (j + 10) * 20 + '88ac'), value=100000 * (j + 1))
+                   for j in range(2)]
+        return PartialTransaction.from_io(inputs, outputs, locktime=1234, version=2, BIP69_sort=False)
+
+    def _check_sighashes(self, sighash: int, expected_sighashes):
+        tx = self._make_tx(sighash)
+        shared_fields = tx._calc_legacy_shared_txdigest_fields()
+        for txin_index, expected in enumerate(expected_sighashes):
+            if expected is None:
+                with self.assertRaisesRegex(Exception, 'Not enough outputs for SIGHASH_SINGLE'):
+                    tx.serialize_preimage(txin_index, None)
+                continue
+            preimage = tx.serialize_preimage(txin_index, None)
+            self.assertEqual(expected, sha256d(bfh(preimage)).hex())
+            self.assertEqual(preimage, tx.serialize_preimage(txin_index, None, legacy_shared_txdigest_fields=shared_fields))
+
+    def test_legacy_sighash_all(self):
+        self._check_sighashes(Sighash.ALL, [
+            '4ecc388c19d438245efcd5a12f3b55571a00c74a8d6e156ad49ae0e327061cdf',
+            'db9f3ffd24a3f4b53c986c6f1afe27db3a31a42b1435b2184e0e0fbce48868c0',
+            '4eefc2afce3d21842cce5a23775519c0b49abf2c20698a6247d7d9db2594e334'])
+
+    def test_legacy_sighash_none(self):
+        self._check_sighashes(Sighash.NONE, [
+            '8ba5f2724c34c11a4ce5a5a92a0ec50fc9530306088614102fd5cbbb44dd7165',
+            '18087b5441487e91da640fb450f30ca3dee0ece75928f25e425087a16d619e09',
+            '60d9bb105c2af1b076c084b45e3ca5a2cfaa572ebc18e72d241f07bbc8742500'])
+
+    def test_legacy_sighash_single(self):
+        self._check_sighashes(Sighash.SINGLE, [
+            '79178774d00f51c4304922ede15330f23010583230815500a068ed85154b806d',
+            '1adabaa89c7293e07f4ac509b5a0cf10a40ddcfbd2fec7856dd8fbdc471471cc',
+            None])
+
+    def test_legacy_sighash_all_anyonecanpay(self):
+        self._check_sighashes(Sighash.ALL | Sighash.ANYONECANPAY, [
+            '051a409c45fa6c297987d080d37d9002b77c5ecf17fc6f20ad3e0ad5d72205b0',
+            'a506bcf4c28edfb15e35accd6a063b9a838add75d206428ffecbf5af59623113',
+            '69f2a6fa9796b350f00618f9ad0aea60a5b709047a5c65892524be3522d7254e'])
+
+    def test_legacy_sighash_none_anyonecanpay(self):
+        self._check_sighashes(Sighash.NONE | Sighash.ANYONECANPAY, [
+            '8b718f0fc16cd07dd6e548523255391179acf0178d54e4dfde9001c35d94055c',
+            'f25a41c6eed1b698ce3658d1219dbe7f45d032c0f6099fd9a018ebd56beb181c',
+            '79ffaad6de414822a3d8e484c22d4b93b0d814dfbbdc180cf53fe05b25af99f9'])
+
+    def test_legacy_sighash_single_anyonecanpay(self):
+        self._check_sighashes(Sighash.SINGLE | Sighash.ANYONECANPAY, [
+            'df3ed75cfd87c6efc7e9f42f14d80ed2a2eae61fc597f621b0d8df1c2800da58',
+            '81a8b110fc5716350f8a76cf79b3f03c486f7f7ce80373ab40b060087d6ee6a8',
+            None])
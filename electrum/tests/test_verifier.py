@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+import asyncio
+from collections import Counter
+
+from aiorpcx import RPCError
 
 from electrum.bitcoin import hash_encode
 from electrum.transaction import Transaction
@@ -49,3 +53,108 @@ class VerifierTestCase(ElectrumTestCase):
         f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[:64]))
         with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
             SPV.hash_merkle_root(fake_mbranch, f_tx_hash, 6)
+
+
+class MockNetwork:
+
+    def __init__(self):
+        self.asyncio_loop = asyncio.get_running_loop()
+        self.interface = None  # so that the SPV does not start its tasks
+
+
+class MockInterface:
+
+    def __init__(self):
+        self.calls = Counter()
+        self.release = asyncio.Event()
+        self.missing = set()
+
+    async def get_transaction(self, tx_hash):
+        self.calls[tx_hash] += 1
+        await self.release.wait()
+        if tx_hash in self.missing:
+            raise RPCError(1, 'No such mempool or blockchain transaction')
+        return VALID_64_BYTE_TX
+
+
+class MockWallet:
+
+    def get_transaction(self, tx_hash):
+        return None
+
+    def diagnostic_name(self):
+        return 'mock'
+
+
+class SharedRequestsTestCase(ElectrumTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.spv = SPV(MockNetwork(), MockWallet())
+        self.spv.interface = self.interface = MockInterface()
+
+    async def asyncTearDown(self):
+        await self.spv.stop()
+        await super().asyncTearDown()
+
+    async def test_concurrent_requests_are_coalesced(self):
+        tasks = [asyncio.create_task(self.spv._get_transaction('aa')) for i in range(3)]
+        await asyncio.sleep(0)
+        self.interface.release.set()
+        txs = await asyncio.gather(*tasks)
+        self.assertEqual(1, self.interface.calls['aa'])
+        self.assertTrue(all(tx is txs[0] for tx in txs))
+        # the result is kept for later callers
+        self.assertIs(txs[0], await self.spv._get_transaction('aa'))
+        self.assertEqual(1, self.interface.calls['aa'])
+
+    async def test_cancelled_caller_does_not_cancel_others(self):
+        first = asyncio.create_task(self.spv._get_transaction('aa'))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(self.spv._get_transaction('aa'))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        self.interface.release.set()
+        self.assertEqual(VALID_64_BYTE_TX, (await second).serialize())
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+        self.assertEqual(1, self.interface.calls['aa'])
+
+    async def test_failures_are_not_cached(self):
+        self.interface.missing.add('aa')
+        tasks = [asyncio.create_task(self.spv._get_transaction('aa')) for i in range(2)]
+        await asyncio.sleep(0)
+        self.interface.release.set()
+        for task in tasks:
+            with self.assertRaises(RPCError):
+                await task
+        self.assertEqual(1, self.interface.calls['aa'])
+        self.interface.missing.clear()
+        await self.spv._get_transaction('aa')
+        self.assertEqual(2, self.interface.calls['aa'])
+
+    async def test_least_recently_used_txs_are_evicted(self):
+        self.spv.MAX_CACHED_ITEMS = 2
+        self.interface.release.set()
+        await self.spv._get_transaction('aa')
+        await self.spv._get_transaction('bb')
+        await self.spv._get_transaction('aa')  # now more recent than 'bb'
+        await self.spv._get_transaction('cc')
+        self.assertEqual(['aa', 'cc'], list(self.spv._txs))
+        await self.spv._get_transaction('bb')
+        self.assertEqual(Counter({'aa': 1, 'bb': 2, 'cc': 1}), self.interface.calls)
+
+    async def test_txs_are_kept_on_reorg(self):
+        self.interface.release.set()
+        await self.spv._get_transaction('aa')
+        self.spv._forget_cached_above_height(0)
+        self.assertEqual(['aa'], list(self.spv._txs))
+
+    async def test_stop_cancels_pending_requests(self):
+        task = asyncio.create_task(self.spv._get_transaction('aa'))
+        await asyncio.sleep(0)
+        await self.spv.stop()
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.wait_for(task, timeout=1)
+        self.assertEqual({}, dict(self.spv._txs))
@@ -7,17 +7,26 @@ from decimal import Decimal
 import time
 from io import StringIO
 import asyncio
+import struct
+import sqlite3
+import itertools
+from collections import defaultdict
 
-from electrum.storage import WalletStorage
+from electrum.storage import WalletStorage, StorageEncryptionVersion
 from electrum.wallet_db import FINAL_SEED_VERSION
 from electrum.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
                              restore_wallet_from_text, Imported_Wallet, Wallet)
 from electrum.exchange_rate import ExchangeBase, FxThread
-from electrum.util import TxMinedInfo, InvalidPassword
-from electrum.bitcoin import COIN
+from electrum.util import TxMinedInfo, InvalidPassword, WalletFileException
+from electrum.transaction import Transaction, PartialTxOutput, TxOutpoint
+from electrum.bitcoin import COIN, COINBASE_MATURITY, address_to_script, hash160_to_p2pkh, serialize_privkey
+from electrum.asset import generate_transfer_script_from_base, AssetMetadata
+from electrum.blockchain import MissingHeader
 from electrum.wallet_db import WalletDB
+from electrum.wallet_sqlite import get_sqlite_path
+from electrum.address_synchronizer import AddressSynchronizer, HistoryItem
 from electrum.simple_config import SimpleConfig
-from electrum import util
+from electrum import util, json_db
 
 from . import ElectrumTestCase
 
@@ -32,6 +41,11 @@ class FakeSynchronizer(object):
         self.store.append(address)
 
 
+@json_db.modifier
+def append_in_place(db, key, item):
+    db.data[key].append(item)
+
+
 class WalletTestCase(ElectrumTestCase):
 
     def setUp(self):
@@ -84,6 +98,519 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def _write_and_journal(self, storage):
+        db = WalletDB('', storage=storage, manual_upgrades=True)
+        db.put('seed_version', FINAL_SEED_VERSION)
+        db.put('a', {'b': 1})
+        db.write()
+        base_size = os.path.getsize(self.wallet_path)
+        db._after_upgrade_tasks()  # makes data a StoredDict
+        db.put('c', [1, 2])
+        db.get_dict('a')['d'] = 2
+        db.get_dict('a').pop('b')
+        db.write()
+        self.assertGreater(os.path.getsize(self.wallet_path), base_size)
+        return db
+
+    def test_journaled_write_is_appended(self):
+        storage = WalletStorage(self.wallet_path)
+        self._write_and_journal(storage)
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        # one record for the three changes
+        self.assertEqual(1, contents.count(json_db.JOURNAL_SEPARATOR))
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), storage=storage, manual_upgrades=True)
+        self.assertEqual([1, 2], db.get('c'))
+        self.assertEqual({'d': 2}, db.get('a'))
+
+    def test_journaled_write_encrypted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        self._write_and_journal(storage)
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted())
+        storage.decrypt('secret')
+        db = WalletDB(storage.read(), storage=storage, manual_upgrades=True)
+        self.assertEqual([1, 2], db.get('c'))
+        self.assertEqual({'d': 2}, db.get('a'))
+
+    def test_journal_is_compacted(self):
+        storage = WalletStorage(self.wallet_path)
+        db = self._write_and_journal(storage)
+        for i in range(2000):
+            db.put(f'key{i}', 'x' * 40)
+        db.write()
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertNotIn(json_db.JOURNAL_SEPARATOR, contents)
+        self.assertEqual('x' * 40, json.loads(contents)['key1999'])
+
+    def test_torn_journal_record_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        self._write_and_journal(storage)
+        with open(self.wallet_path, "a") as f:
+            f.write(json_db.JOURNAL_SEPARATOR + '{"op": "add", "pa')
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), storage=storage, manual_upgrades=True)
+        self.assertEqual([1, 2], db.get('c'))
+
+    def test_torn_journal_record_is_dropped_as_a_whole(self):
+        storage = WalletStorage(self.wallet_path)
+        self._write_and_journal(storage)
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        # the record has all three changes; cut it after the first two
+        cut = contents.index('"path": ["a", "b"]')
+        with open(self.wallet_path, "w") as f:
+            f.write(contents[:cut])
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), storage=storage, manual_upgrades=True)
+        self.assertIsNone(db.get('c'))
+        self.assertEqual({'b': 1}, db.get('a'))
+        self.assertTrue(db._needs_full_write)
+
+    def test_corrupted_journal_record_is_rejected(self):
+        storage = WalletStorage(self.wallet_path)
+        db = self._write_and_journal(storage)
+        db.put('e', 3)
+        db.write()
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        with open(self.wallet_path, "w") as f:
+            f.write(contents.replace('[1, 2]', '[1, 3]'))
+        storage = WalletStorage(self.wallet_path)
+        with self.assertRaises(WalletFileException):
+            WalletDB(storage.read(), storage=storage, manual_upgrades=True)
+
+    def test_modifier_without_patch_forces_full_write(self):
+        storage = WalletStorage(self.wallet_path)
+        db = self._write_and_journal(storage)
+        db.add_tx_fee_we_calculated('00' * 32, None)  # changes nothing
+        self.assertFalse(db._needs_full_write)
+        # a list modified in place, which is not journaled
+        db.put('c', [1, 2, 3])
+        append_in_place(db, 'c', 4)
+        self.assertTrue(db._needs_full_write)
+        db.write()
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertNotIn(json_db.JOURNAL_SEPARATOR, contents)
+        self.assertEqual([1, 2, 3, 4], json.loads(contents)['c'])
+
+    def test_transactions_stored_as_raw_bytes(self):
+        raw_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+        tx = Transaction(raw_tx)
+        txid = tx.txid()
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', storage=storage, manual_upgrades=False)
+        db.add_transaction(txid, tx)
+        db.add_txo_addr(txid, 'addr', 0, 1000000, None, False)  # otherwise removed as unreferenced
+        db.write()
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), storage=storage, manual_upgrades=False)
+        self.assertEqual(bytes.fromhex(raw_tx), db.transactions[txid])
+        tx2 = db.get_transaction(txid)
+        self.assertEqual(raw_tx, tx2.serialize())
+        self.assertIs(tx2, db.get_transaction(txid))
+        self.assertEqual(txid, db.remove_transaction(txid).txid())
+        self.assertIsNone(db.get_transaction(txid))
+
+    def test_verified_tx_height_index(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', storage=storage, manual_upgrades=False)
+        for i, height in enumerate((5, 7, 7, 9)):
+            db.add_verified_tx(f'{i:064x}', TxMinedInfo(height=height, timestamp=0, txpos=0, header_hash='00' * 32))
+        db.remove_verified_tx(f'{3:064x}')
+        self.assertEqual({f'{1:064x}', f'{2:064x}'}, set(db.get_verified_tx_after_height(5)))
+        db.add_verified_tx(f'{0:064x}', TxMinedInfo(height=8, timestamp=0, txpos=0, header_hash='00' * 32))
+        self.assertEqual([f'{0:064x}'], db.get_verified_tx_after_height(7))
+        db.write()
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), storage=storage, manual_upgrades=False)
+        self.assertEqual([f'{1:064x}', f'{2:064x}', f'{0:064x}'], db.get_verified_tx_after_height(6))
+        self.assertEqual([], db.get_verified_tx_after_height(8))
+
+    async def test_adb_change_tracker(self):
+        raw_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+        tx = Transaction(raw_tx)
+        addr = tx.outputs()[0].address
+        db = WalletDB('', storage=None, manual_upgrades=False)
+        db._load_assets()
+        adb = AddressSynchronizer(db, self.config)
+        tracker = adb.add_change_tracker()
+        adb.add_address(addr)
+        adb.add_transaction(tx)
+        changes = tracker.take()
+        self.assertEqual({tx.txid()}, changes.txids)
+        self.assertEqual({addr}, changes.addresses)
+        self.assertFalse(changes.everything)
+        self.assertTrue(tracker.is_empty())
+        adb.clear_history()
+        self.assertTrue(tracker.take().everything)
+        adb.remove_change_tracker(tracker)
+        adb.add_transaction(tx, allow_unrelated=True)
+        self.assertTrue(tracker.is_empty())
+
+    def test_convert_to_sqlite(self):
+        raw_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+        tx = Transaction(raw_tx)
+        txid = tx.txid()
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', storage=storage, manual_upgrades=False)
+        db.add_transaction(txid, tx)
+        db.add_txo_addr(txid, 'addr', 0, 1000000, None, False)
+        db.write()
+        self.assertTrue(db.convert_to_sqlite())
+        self.assertFalse(db.convert_to_sqlite())
+        with open(self.wallet_path, "r") as f:
+            self.assertNotIn('txo', json.loads(f.read()))
+        # changes below a row are saved too
+        db.add_txo_addr(txid, 'addr', 1, 2000, None, False)
+        db.write()
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), storage=storage, manual_upgrades=False)
+        self.assertTrue(db.is_using_sqlite())
+        self.assertEqual(bytes.fromhex(raw_tx), db.transactions[txid])
+        self.assertEqual({0: (1000000, None, False), 1: (2000, None, False)},
+                         db.get_txo_addr(txid, 'addr'))
+        # a dump is a json wallet, without the sqlite database
+        d = json.loads(db.dump())
+        self.assertNotIn('use_sqlite', d)
+        self.assertIn(txid, d['transactions'])
+
+
+def make_raw_tx(inputs, outputs) -> Transaction:
+    """Builds an unsigned legacy tx. inputs are (txid, out_idx), or a str
+    to use as the scriptSig of a coinbase input; outputs are (address, value)
+    or (address, value, asset, amount).
+    """
+    raw = struct.pack('<iB', 1, len(inputs))
+    for txin in inputs:
+        if isinstance(txin, str):
+            script_sig = txin.encode()
+            raw += bytes(32) + struct.pack('<IB', 0xffffffff, len(script_sig)) + script_sig
+        else:
+            raw += bytes.fromhex(txin[0])[::-1] + struct.pack('<IB', txin[1], 0)
+        raw += struct.pack('<I', 0xffffffff)
+    raw += struct.pack('<B', len(outputs))
+    for address, value, *asset in outputs:
+        script = address_to_script(address)
+        if asset:
+            script = generate_transfer_script_from_base(asset[0], asset[1], script)
+        script = bytes.fromhex(script)
+        raw += struct.pack('<qB', value, len(script)) + script
+    raw += struct.pack('<I', 0)
+    return Transaction(raw.hex())
+
+
+class FakeBlockchain:
+    """A chain that has none of the headers our txs were verified against,
+    except those in hashes (height -> header hash).
+    """
+
+    def __init__(self, hashes=None):
+        self.hashes = hashes or {}
+
+    def get_hash(self, height):
+        if height not in self.hashes:
+            raise MissingHeader(height)
+        return self.hashes[height]
+
+
+class AdbIndexTestCase(WalletTestCase):
+    """Checks the incremental indexes of AddressSynchronizer against
+    a recomputation from the txo/txi tables.
+    """
+
+    ASSET = 'FOO'
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.addrs = [hash160_to_p2pkh(bytes([i]) * 20) for i in range(1, 5)]
+        self.other = hash160_to_p2pkh(bytes([0xee]) * 20)
+        db = WalletDB('', storage=None, manual_upgrades=False)
+        db._load_assets()
+        db.add_asset_to_watch(self.ASSET)
+        db.put('stored_height', 1000)
+        self.adb = AddressSynchronizer(db, self.config)
+        for addr in self.addrs:
+            self.adb.add_address(addr)
+
+    def add_tx(self, inputs, outputs, height=None) -> str:
+        tx = make_raw_tx(inputs, outputs)
+        self.assertTrue(self.adb.add_transaction(tx))
+        if height is not None:
+            self.set_height(tx.txid(), height)
+        return tx.txid()
+
+    def set_height(self, txid, height):
+        if height > 0:
+            self.adb.add_verified_tx(txid, TxMinedInfo(height=height, timestamp=0, txpos=1, header_hash='00' * 32))
+        else:
+            self.adb.add_unverified_or_unconfirmed_tx(txid, height)
+
+    def set_local_height(self, height):
+        self.adb.db.put('stored_height', height)
+
+    def build_history(self):
+        """coinbase -> confirmed spend -> chain of mempool txs, plus an asset
+        transfer and a local tx. Returns the txids by name.
+        """
+        a, b, c, d = self.addrs
+        t = {}
+        t['cb'] = self.add_tx(['cb1'], [(a, 50_000)], height=950)
+        t['cb_old'] = self.add_tx(['cb2'], [(d, 70_000)], height=500)
+        t['fund'] = self.add_tx([('11' * 32, 0)], [(b, 40_000), (c, 1_000, self.ASSET, 500), (self.other, 5)], height=600)
+        t['spend'] = self.add_tx([(t['fund'], 0)], [(c, 30_000), (d, 9_000)], height=700)
+        t['mem1'] = self.add_tx([(t['spend'], 0), (t['cb_old'], 0)], [(a, 60_000), (self.other, 39_000)], height=0)
+        t['mem2'] = self.add_tx([(t['mem1'], 0), (t['spend'], 1)], [(b, 20_000), (c, 48_000)], height=-1)
+        t['asset'] = self.add_tx([(t['fund'], 1)], [(d, 1_000, self.ASSET, 300), (a, 1_000, self.ASSET, 200)], height=0)
+        t['local'] = self.add_tx([(t['mem2'], 1)], [(a, 47_000)])
+        return t
+
+
+class TestUtxoIndex(AdbIndexTestCase):
+
+    def assert_utxo_index(self):
+        expected = {}
+        for addr in self.addrs:
+            for prevout, txo in self.adb.get_addr_outputs(addr).items():
+                if txo.spent_height is None:
+                    expected[prevout] = (addr, txo.asset, txo.value_sats(asset_aware=True), txo.is_coinbase_output())
+        self.assertEqual(expected, self.adb._utxos)
+        for addr in self.addrs:
+            self.assertEqual({p for p, v in expected.items() if v[0] == addr}, set(self.adb.get_addr_utxo(addr)))
+        self.assertEqual({p for p, v in expected.items() if v[1] == self.ASSET},
+                         {txo.prevout for txo in self.adb.get_utxos(self.addrs, assets=[self.ASSET])})
+        self.assertEqual({p for p, v in expected.items() if v[0] != self.addrs[0]},
+                         {txo.prevout for txo in self.adb.get_utxos(self.addrs, excluded_addresses={self.addrs[0]})})
+
+    async def test_add_and_remove(self):
+        t = self.build_history()
+        self.assert_utxo_index()
+        self.adb.remove_transaction(t['mem1'])
+        self.assertIsNone(self.adb.db.get_transaction(t['local']))
+        self.assert_utxo_index()
+        self.adb.remove_transaction(t['fund'])
+        self.assert_utxo_index()
+        self.add_tx([('11' * 32, 0)], [(self.addrs[1], 40_000), (self.addrs[2], 1_000, self.ASSET, 500), (self.other, 5)], height=600)
+        self.assert_utxo_index()
+
+    async def test_reorg(self):
+        self.build_history()
+        self.adb.undo_verifications(FakeBlockchain(), above_height=650)
+        self.assert_utxo_index()
+        self.set_local_height(600)
+        self.assert_utxo_index()
+
+    async def test_rbf(self):
+        t = self.build_history()
+        replacement = make_raw_tx([(t['spend'], 0)], [(self.addrs[3], 29_000)])
+        self.set_height(replacement.txid(), 0)
+        self.assertTrue(self.adb.add_transaction(replacement))
+        for name in ('mem1', 'mem2', 'local'):
+            self.assertIsNone(self.adb.db.get_transaction(t[name]))
+        self.assert_utxo_index()
+
+    async def test_index_is_rebuilt_on_load(self):
+        self.build_history()
+        utxos = dict(self.adb._utxos)
+        self.adb.load_utxo_index()
+        self.assertEqual(utxos, self.adb._utxos)
+        self.assert_utxo_index()
+
+
+class TestBalanceCounters(AdbIndexTestCase):
+
+    def compute_balance(self, domain, excluded_coins=(), asset_aware=False):
+        """get_balance, computed from scratch over the outputs of domain."""
+        coins = {}
+        for addr in domain:
+            coins.update(self.adb.get_addr_outputs(addr))
+        c, u, x = defaultdict(int), defaultdict(int), defaultdict(int)
+        mempool_height = self.adb.get_local_height() + 1
+        for utxo in coins.values():
+            if utxo.spent_height is not None or utxo.prevout.to_str() in excluded_coins:
+                continue
+            v = utxo.value_sats(asset_aware=asset_aware)
+            if utxo.is_coinbase_output() and utxo.block_height + COINBASE_MATURITY > mempool_height:
+                x[utxo.asset] += v
+            elif utxo.block_height > 0:
+                c[utxo.asset] += v
+            else:
+                tx = self.adb.db.get_transaction(utxo.prevout.txid.hex())
+                confirmed_spent_amount = sum(
+                    coins[txin.prevout].value_sats(asset_aware=asset_aware) for txin in tx.inputs()
+                    if txin.prevout in coins and coins[txin.prevout].block_height > 0
+                    and coins[txin.prevout].asset == utxo.asset)
+                c[utxo.asset] += min(v, confirmed_spent_amount)
+                u[utxo.asset] += v - min(v, confirmed_spent_amount)
+        if asset_aware:
+            return {asset: (c[asset], u[asset], x[asset]) for asset in set(c) | set(u) | set(x)}
+        return sum(c.values()), sum(u.values()), sum(x.values())
+
+    def assert_balances(self, excluded_coins=()):
+        excluded_coins = set(excluded_coins)
+        domains = [set(domain) for n in range(len(self.addrs) + 1)
+                   for domain in itertools.combinations(self.addrs, n)]
+        for domain in domains:
+            with self.subTest(domain=sorted(self.addrs.index(addr) for addr in domain)):
+                self.assertEqual(self.compute_balance(domain, excluded_coins),
+                                 self.adb.get_balance(domain, excluded_coins=excluded_coins))
+                self.assertEqual(self.compute_balance(domain, excluded_coins, asset_aware=True),
+                                 dict(self.adb.get_balance(domain, excluded_coins=excluded_coins, asset_aware=True)))
+
+    async def test_domains(self):
+        self.build_history()
+        self.assert_balances()
+        # mem2 spends a confirmed coin of d: it only counts if d is in the domain
+        a, b, c, d = self.addrs
+        self.assertEqual((0, 67_000, 50_000), self.adb.get_balance([a, b, c]))
+        self.assertEqual((9_000, 58_000, 50_000), self.adb.get_balance(self.addrs))
+        self.assertEqual({None: (0, 47_000, 50_000), self.ASSET: (0, 200, 0)},
+                         dict(self.adb.get_balance([a], asset_aware=True)))
+        self.assertEqual({None: (0, 47_000, 50_000), self.ASSET: (200, 0, 0)},
+                         dict(self.adb.get_balance([a, c], asset_aware=True)))
+        # coins without value still have their row
+        self.add_tx([('22' * 32, 0)], [(c, 0)], height=800)
+        self.assertEqual({None: (0, 0, 0)}, dict(self.adb.get_balance([c], asset_aware=True)))
+        self.assert_balances()
+
+    async def test_excluded_coins(self):
+        t = self.build_history()
+        self.assert_balances(excluded_coins={f"{t['mem2']}:0", f"{t['cb']}:0", f"{t['asset']}:1"})
+
+    async def test_coinbase_maturity(self):
+        self.build_history()
+        self.set_local_height(1048)
+        self.assert_balances()
+        self.set_local_height(1049)
+        self.assert_balances()
+        self.adb.undo_verifications(FakeBlockchain(), above_height=900)
+        self.set_local_height(1000)
+        self.assert_balances()
+
+    async def test_mempool_chain(self):
+        t = self.build_history()
+        self.set_height(t['mem1'], 1001)
+        self.assert_balances()
+        self.set_height(t['mem1'], 0)
+        self.assert_balances()
+        self.adb.remove_transaction(t['mem2'])
+        self.assert_balances()
+        self.adb.undo_verifications(FakeBlockchain(), above_height=650)
+        self.assert_balances()
+
+
+class TestHistoryIndex(AdbIndexTestCase):
+
+    def compute_history(self, domain):
+        """get_history, rebuilt from scratch from the history of each address."""
+        tx_deltas = defaultdict(lambda: defaultdict(int))
+        for addr in domain:
+            for tx_hash in self.adb.get_address_history(addr):
+                for asset, value in self.adb.get_tx_delta(tx_hash, addr).items():
+                    tx_deltas[tx_hash][asset] += value
+        history = []
+        balance = defaultdict(int)
+        for tx_hash in sorted(tx_deltas, key=lambda txid: (self.adb._get_tx_sort_key(txid), txid)):
+            for asset, delta in tx_deltas[tx_hash].items():
+                balance[asset] += delta
+                history.append(HistoryItem(
+                    txid=tx_hash,
+                    tx_mined_status=self.adb.get_tx_height(tx_hash),
+                    asset=asset,
+                    delta=delta,
+                    fee=self.adb.get_tx_fee(tx_hash),
+                    balance=balance[asset]))
+        return history
+
+    def assert_history(self):
+        related = defaultdict(set)
+        for tx_hash in self.adb.db.list_transactions():
+            for addr in itertools.chain(self.adb.db.get_txi_addresses(tx_hash), self.adb.db.get_txo_addresses(tx_hash)):
+                related[addr].add(tx_hash)
+        for addr in self.addrs:
+            self.assertEqual({tx_hash: self.adb.get_tx_height(tx_hash).height for tx_hash in related[addr]},
+                             self.adb.get_address_history(addr))
+        for domain in (self.addrs, self.addrs[1:]):
+            self.assertEqual(self.by_tx(self.compute_history(domain)),
+                             self.by_tx(self.adb.get_history(domain, sanity_check=True)))
+
+    @staticmethod
+    def by_tx(history):
+        # the rows of a tx, one per asset, come in no particular order
+        return [(txid, sorted(items, key=lambda item: item.asset or ''))
+                for txid, items in itertools.groupby(history, key=lambda item: item.txid)]
+
+    def add_deposits(self, n):
+        """Enough confirmed txs that single changes are spliced into the index."""
+        return [self.add_tx([(f'{i + 1:064x}', 0)], [(self.addrs[i % 4], 1_000 + i)], height=100 + 7 * i)
+                for i in range(n)]
+
+    async def test_insert_and_remove(self):
+        deposits = self.add_deposits(40)
+        self.assert_history()
+        t = self.build_history()
+        self.assert_history()
+        self.add_tx([(deposits[5], 0)], [(self.addrs[2], 900)], height=290)
+        self.assert_history()
+        self.adb.remove_transaction(t['mem1'])
+        self.assert_history()
+        self.adb.remove_transaction(deposits[5])
+        self.assert_history()
+
+    async def test_height_changes(self):
+        deposits = self.add_deposits(40)
+        t = self.build_history()
+        self.adb.get_history(self.addrs)
+        # mempool tx is mined, and then reorged to another height
+        self.set_height(t['mem1'], 1001)
+        self.assert_history()
+        self.set_height(t['mem1'], 1002)
+        self.assert_history()
+        self.set_height(deposits[3], 1003)
+        self.assert_history()
+        # confirmed txs become unverified, then are verified again at other heights
+        self.adb.undo_verifications(FakeBlockchain(), above_height=350)
+        self.assert_history()
+        for i, txid in enumerate(deposits[-5:]):
+            self.set_height(txid, 101 + 7 * i)
+            self.assert_history()
+        self.set_height(t['spend'], 0)
+        self.assert_history()
+
+    async def test_future_tx(self):
+        self.add_deposits(40)
+        t = self.build_history()
+        self.adb.set_future_tx(t['local'], wanted_height=1010)
+        self.assert_history()
+        self.set_local_height(1010)
+        self.assert_history()
+
+
+class TestUndoVerifications(AdbIndexTestCase):
+
+    async def test_reorg_reports_unverified_assets(self):
+        db = self.adb.db
+        db.add_verified_asset_metadata(self.ASSET, AssetMetadata(sats_in_circulation=COIN, divisions=0, reissuable=False),
+                                       (TxOutpoint(bytes.fromhex('aa' * 32), 0), 700), None, None)
+        db.add_verified_h160_tag('bb' * 20, '#TAG', {'tx_hash': 'cc' * 32, 'tx_pos': 0, 'height': 800, 'flag': True})
+        tracker = self.adb.add_change_tracker()
+        self.adb.undo_verifications(FakeBlockchain(), above_height=650)
+        self.assertEqual({self.ASSET}, tracker.take().assets)
+        self.assertIn(self.ASSET, self.adb.unverified_asset_metadata)
+        self.assertFalse(db.get_verified_h160_tags_after_height(650))
+
+    async def test_txs_on_our_chain_stay_verified(self):
+        t = self.build_history()
+        self.adb.undo_verifications(FakeBlockchain({700: '00' * 32}), above_height=650)
+        self.assertEqual(700, self.adb.db.get_verified_tx(t['spend']).height)
+        self.assertIsNone(self.adb.db.get_verified_tx(t['cb']))
+        self.assertIn(t['cb'], self.adb.unverified_tx)
+
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -252,6 +779,134 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual(1, len(wallet.get_receiving_addresses()))
 
 
+class TestWalletSqlite(WalletTestCase):
+
+    RAW_TX = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+
+    def _create_sqlite_db(self, path) -> WalletDB:
+        tx = Transaction(self.RAW_TX)
+        storage = WalletStorage(path)
+        db = WalletDB('', storage=storage, manual_upgrades=False)
+        db.add_transaction(tx.txid(), tx)
+        db.add_txo_addr(tx.txid(), 'addr', 0, 1000000, None, False)
+        db.write()
+        self.assertTrue(db.convert_to_sqlite())
+        return db
+
+    def _read_txo_rows(self, path) -> dict:
+        conn = sqlite3.connect(get_sqlite_path(path))
+        try:
+            return {k: json.loads(v) for k, v in conn.execute('SELECT key, value FROM txo')}
+        finally:
+            conn.close()
+
+    async def test_sqlite_wallet_cannot_be_encrypted(self):
+        text = 'p2wpkh:L4jkdiXszG26SUYvwwJhzGwg37H2nLhrbip7u6crmgNeJysv5FHL'
+        wallet = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']
+        self.assertTrue(wallet.db.convert_to_sqlite())
+        with self.assertRaises(WalletFileException):
+            wallet.update_password(None, '1234', encrypt_storage=True)
+        self.assertFalse(wallet.storage.is_encrypted())
+        wallet.check_password(None)
+        # the keystore can be encrypted
+        wallet.update_password(None, '1234', encrypt_storage=False)
+        wallet.check_password('1234')
+        self.assertFalse(wallet.storage.is_encrypted())
+
+    def test_sqlite_is_committed_after_the_wallet_file(self):
+        db = self._create_sqlite_db(self.wallet_path)
+        txid = Transaction(self.RAW_TX).txid()
+        db.add_txo_addr(txid, 'addr2', 0, 5000, None, False)
+        def fail(data):
+            raise OSError('disk full')
+        db.storage.write = db.storage.append = fail
+        with self.assertRaises(OSError):
+            db.write()
+        self.assertEqual({'addr'}, set(self._read_txo_rows(self.wallet_path)[txid]))
+        del db.storage.write, db.storage.append
+        db.write()
+        self.assertEqual({'addr', 'addr2'}, set(self._read_txo_rows(self.wallet_path)[txid]))
+        db.close()
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), storage=storage, manual_upgrades=False)
+        self.assertEqual(db.get('sqlite_generation'), db._sqlite.get_generation())
+        self.assertEqual({0: (5000, None, False)}, db.get_txo_addr(txid, 'addr2'))
+
+    def test_missing_sqlite_database(self):
+        self._create_sqlite_db(self.wallet_path).close()
+        new_path = self.wallet_path + '_renamed'
+        os.replace(self.wallet_path, new_path)
+        storage = WalletStorage(new_path)
+        with self.assertRaises(WalletFileException):
+            WalletDB(storage.read(), storage=storage, manual_upgrades=False)
+        os.replace(get_sqlite_path(self.wallet_path), get_sqlite_path(new_path))
+        storage = WalletStorage(new_path)
+        db = WalletDB(storage.read(), storage=storage, manual_upgrades=False)
+        self.assertIn(Transaction(self.RAW_TX).txid(), db.transactions)
+
+    async def test_backup_of_sqlite_wallet(self):
+        text = 'p2wpkh:L4jkdiXszG26SUYvwwJhzGwg37H2nLhrbip7u6crmgNeJysv5FHL'
+        wallet = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']
+        tx = Transaction(self.RAW_TX)
+        wallet.db.add_transaction(tx.txid(), tx)
+        wallet.db.add_txo_addr(tx.txid(), 'addr', 0, 1000000, None, False)
+        self.assertTrue(wallet.db.convert_to_sqlite())
+        backup_dir = os.path.join(self.electrum_path, 'backups')
+        os.mkdir(backup_dir)
+        backup_path = wallet.save_backup(backup_dir)
+        self.assertFalse(os.path.exists(get_sqlite_path(backup_path)))
+        with open(backup_path, "r") as f:
+            d = json.loads(f.read())
+        self.assertNotIn('use_sqlite', d)
+        self.assertIn(tx.txid(), d['transactions'])
+
+
+class TestScalableCoinChooser(WalletTestCase):
+
+    FEE_PER_BYTE = 1000
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.config.WALLET_COIN_CHOOSER_POLICY = 'Scalable'
+        self.config.WALLET_COIN_CHOOSER_OUTPUT_ROUNDING = False
+        values = [100_000_000, 60_000_000, 30_250_000]
+        text = ' '.join(serialize_privkey(bytes([i + 1]) * 32, True, 'p2pkh') for i in range(len(values)))
+        self.wallet = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']
+        for i, (addr, value) in enumerate(zip(self.wallet.get_addresses(), values)):
+            tx = make_raw_tx([('11' * 32, i)], [(addr, value)])
+            self.assertTrue(self.wallet.adb.add_transaction(tx))
+            self.wallet.adb.add_verified_tx(tx.txid(), TxMinedInfo(height=100 + i, timestamp=0, txpos=0, header_hash='00' * 32))
+        self.dest = hash160_to_p2pkh(bytes([0xee]) * 20)
+
+    def _pay(self, amount):
+        tx = self.wallet.make_unsigned_transaction(
+            coins=self.wallet.get_spendable_coins(),
+            outputs=[PartialTxOutput.from_address_and_value(self.dest, amount)],
+            fee=lambda size: self.FEE_PER_BYTE * size)
+        estimated_fee = self.FEE_PER_BYTE * tx.estimated_size()
+        self.wallet.sign_transaction(tx, None)
+        self.assertTrue(tx.is_complete())
+        self.assertEqual(tx.input_value(), tx.output_value() + tx.get_fee())
+        return tx, estimated_fee
+
+    async def test_make_tx_with_change(self):
+        tx, estimated_fee = self._pay(50_000_000)
+        self.assertEqual([100_000_000], [txin.value_sats() for txin in tx.inputs()])
+        self.assertEqual(estimated_fee, tx.get_fee())
+        change = [o for o in tx.outputs() if o.address != self.dest]
+        self.assertEqual(1, len(change))
+        self.assertTrue(self.wallet.is_mine(change[0].address))
+        self.assertEqual(100_000_000 - 50_000_000 - estimated_fee, change[0].value)
+
+    async def test_make_tx_without_change(self):
+        # the coin pays for the amount and its own fee, the rest is not worth a change output
+        tx, estimated_fee = self._pay(30_000_000)
+        self.assertEqual([30_250_000], [txin.value_sats() for txin in tx.inputs()])
+        self.assertEqual([(self.dest, 30_000_000)], [(o.address, o.value) for o in tx.outputs()])
+        self.assertLess(estimated_fee, tx.get_fee())
+        self.assertLess(tx.get_fee() - estimated_fee, self.wallet.dust_threshold())
+
+
 class TestWalletPassword(WalletTestCase):
 
     async def test_update_password_of_imported_wallet(self):
@@ -38,6 +38,7 @@ from collections import defaultdict
 from enum import IntEnum
 import itertools
 import binascii
+import concurrent.futures
 import copy
 
 from . import ecc, bitcoin, constants, segwit_addr, bip32
@@ -253,6 +254,23 @@ class BIP143SharedTxDigestFields(NamedTuple):
     hashOutputs: str
 
 
+# size of a serialized input with an empty scriptSig: prevout (36), script length (1), nSequence (4)
+LEGACY_EMPTY_TXIN_SIZE = 41
+# an output blanked out for SIGHASH_SINGLE: value -1, empty scriptPubKey
+LEGACY_BLANK_TXOUT = b'\xff' * 8 + b'\x00'
+
+
+class LegacySharedTxDigestFields(NamedTuple):
+    """The input and output vectors of a transaction, serialized once for the
+    legacy (pre-segwit) sighash of all its inputs. Each preimage splices the
+    scriptCode of the input being signed into txins, see _serialize_legacy_preimage.
+    """
+    txins: bytes  # all inputs, each with an empty scriptSig
+    txins_no_sequence: bytes  # same, with nSequence=0, for SIGHASH_NONE and SIGHASH_SINGLE
+    txouts: bytes  # all outputs, prefixed with their count
+    outputs: Sequence[bytes]  # each output
+
+
 class TxOutpoint(NamedTuple):
     txid: bytes  # endianness same as hex string displayed; reverse of tx serialization order
     out_idx: int
@@ -479,19 +497,29 @@ class BCDataStream(object):
     """Workalike python implementation of Bitcoin's CDataStream class."""
 
     def __init__(self):
-        self.input = None  # type: Optional[bytearray]
+        self.input = None  # type: Union[bytearray, memoryview, None]
         self.read_cursor = 0
 
     def clear(self):
         self.input = None
         self.read_cursor = 0
 
-    def write(self, _bytes: Union[bytes, bytearray]):  # Initialize with string of _bytes
-        assert isinstance(_bytes, (bytes, bytearray))
+    def write(self, _bytes: Union[bytes, bytearray, memoryview]):  # Initialize with string of _bytes
+        assert isinstance(_bytes, (bytes, bytearray, memoryview))
         if self.input is None:
             self.input = bytearray(_bytes)
         else:
-            self.input += bytearray(_bytes)
+            if isinstance(self.input, memoryview):
+                self.input = bytearray(self.input)
+            self.input += _bytes
+
+    def load(self, _bytes: Union[bytes, bytearray, memoryview]) -> None:
+        """Initialize for reading _bytes, without copying them.
+        Unlike write(), the stream keeps a view of the caller's buffer.
+        """
+        assert isinstance(_bytes, (bytes, bytearray, memoryview))
+        self.input = memoryview(_bytes)
+        self.read_cursor = 0
 
     def read_string(self, encoding='ascii'):
         # Strings are encoded depending on length:
@@ -522,7 +550,7 @@ class BCDataStream(object):
         read_begin = self.read_cursor
         read_end = read_begin + length
         if 0 <= read_begin <= read_end <= input_len:
-            result = self.input[read_begin:read_end]  # type: bytearray
+            result = self.input[read_begin:read_end]  # type: Union[bytearray, memoryview]
             self.read_cursor += length
             return bytes(result)
         else:
@@ -804,19 +832,20 @@ def multisig_script(public_keys: Sequence[str], m: int) -> str:
 
 
 class Transaction:
-    _cached_network_ser: Optional[str]
+    _cached_network_ser_bytes: Optional[bytes]
 
     def __str__(self):
         return self.serialize()
 
     def __init__(self, raw):
         if raw is None:
-            self._cached_network_ser = None
+            self._cached_network_ser_bytes = None
         elif isinstance(raw, str):
-            self._cached_network_ser = raw.strip() if raw else None
-            assert is_hex_str(self._cached_network_ser)
-        elif isinstance(raw, (bytes, bytearray)):
-            self._cached_network_ser = raw.hex()
+            raw = raw.strip()
+            assert is_hex_str(raw)
+            self._cached_network_ser_bytes = bytes.fromhex(raw) if raw else None
+        elif isinstance(raw, (bytes, bytearray, memoryview)):
+            self._cached_network_ser_bytes = bytes(raw) if raw else None
         else:
             raise Exception(f"cannot initialize transaction from {raw}")
         self._inputs = None  # type: List[TxInput]
@@ -825,6 +854,9 @@ class Transaction:
         self._version = 2
 
         self._cached_txid = None  # type: Optional[str]
+        # (start, end) slices of _cached_network_ser_bytes forming the legacy (witness-stripped)
+        # serialization. Only set by deserialize, as then the raw bytes are known to match the tx.
+        self._legacy_ser_ranges = None  # type: Optional[Sequence[Tuple[int, int]]]
 
     @property
     def locktime(self):
@@ -867,14 +899,14 @@ class Transaction:
         return self._outputs
 
     def deserialize(self) -> None:
-        if self._cached_network_ser is None:
+        if self._cached_network_ser_bytes is None:
             return
         if self._inputs is not None:
             return
 
-        raw_bytes = bfh(self._cached_network_ser)
+        raw_bytes = self._cached_network_ser_bytes
         vds = BCDataStream()
-        vds.write(raw_bytes)
+        vds.load(raw_bytes)
         self._version = vds.read_int32()
         n_vin = vds.read_compact_size()
         is_segwit = (n_vin == 0)
@@ -890,6 +922,7 @@ class Transaction:
         if n_vout < 1:
             raise SerializationError('tx needs to have at least 1 output')
         self._outputs = [parse_output(vds) for i in range(n_vout)]
+        witness_start = vds.read_cursor
         if is_segwit:
             for txin in txins:
                 parse_witness(vds, txin)
@@ -897,6 +930,12 @@ class Transaction:
         self._locktime = vds.read_uint32()
         if vds.can_read_more():
             raise SerializationError('extra junk at the end')
+        size = len(raw_bytes)
+        if is_segwit:
+            # skip marker and flag, and the witnesses
+            self._legacy_ser_ranges = ((0, 4), (6, witness_start), (size - 4, size))
+        else:
+            self._legacy_ser_ranges = ((0, size),)
 
     @classmethod
     def serialize_witness(cls, txin: TxInput, *, estimate_size=False) -> str:
@@ -997,21 +1036,37 @@ class Transaction:
                                           hashSequence=hashSequence,
                                           hashOutputs=hashOutputs)
 
+    def _calc_legacy_shared_txdigest_fields(self) -> LegacySharedTxDigestFields:
+        inputs = self.inputs()
+        outputs = [o.serialize_to_network() for o in self.outputs()]
+        prevouts = [txin.prevout.serialize_to_network() for txin in inputs]
+        txins = b''.join(prevout + b'\x00' + int.to_bytes(txin.nsequence, 4, byteorder="little")
+                         for prevout, txin in zip(prevouts, inputs))
+        txins_no_sequence = b''.join(prevout + bytes(5) for prevout in prevouts)
+        return LegacySharedTxDigestFields(txins=txins,
+                                          txins_no_sequence=txins_no_sequence,
+                                          txouts=bfh(var_int(len(outputs))) + b''.join(outputs),
+                                          outputs=outputs)
+
     def is_segwit(self, *, guess_for_address=False):
         return any(txin.is_segwit(guess_for_address=guess_for_address)
                    for txin in self.inputs())
 
     def invalidate_ser_cache(self):
-        self._cached_network_ser = None
+        self._cached_network_ser_bytes = None
         self._cached_txid = None
+        self._legacy_ser_ranges = None
+
+    def _get_network_ser_bytes(self) -> bytes:
+        if not self._cached_network_ser_bytes:
+            self._cached_network_ser_bytes = bfh(self.serialize_to_network(estimate_size=False, include_sigs=True))
+        return self._cached_network_ser_bytes
 
     def serialize(self) -> str:
-        if not self._cached_network_ser:
-            self._cached_network_ser = self.serialize_to_network(estimate_size=False, include_sigs=True)
-        return self._cached_network_ser
+        return self._get_network_ser_bytes().hex()
 
     def serialize_as_bytes(self) -> bytes:
-        return bfh(self.serialize())
+        return self._get_network_ser_bytes()
 
     def serialize_to_network(self, *, estimate_size=False, include_sigs=True, force_legacy=False) -> str:
         """Serialize the transaction as used on the Bitcoin network, into hex.
@@ -1059,8 +1114,24 @@ class Transaction:
         tx_bytes = tx.serialize_as_bytes()
         return base_encode(tx_bytes, base=43), is_complete
 
+    def _get_legacy_ser_from_raw(self) -> Optional[bytes]:
+        """The witness-stripped serialization, sliced from the raw bytes the tx was parsed from.
+        None if the tx was not created from raw bytes, or was modified since.
+        """
+        self.deserialize()
+        if self._legacy_ser_ranges is None or self._cached_network_ser_bytes is None:
+            return None
+        raw = self._cached_network_ser_bytes
+        if len(self._legacy_ser_ranges) == 1:
+            return raw
+        raw_view = memoryview(raw)
+        return b''.join(raw_view[start:end] for start, end in self._legacy_ser_ranges)
+
     def txid(self) -> Optional[str]:
         if self._cached_txid is None:
+            if (ser := self._get_legacy_ser_from_raw()) is not None:
+                self._cached_txid = sha256d(ser)[::-1].hex()
+                return self._cached_txid
             self.deserialize()
             all_segwit = all(txin.is_segwit() for txin in self.inputs())
             if not all_segwit and not self.is_complete():
@@ -1075,6 +1146,8 @@ class Transaction:
 
     def wtxid(self) -> Optional[str]:
         self.deserialize()
+        if self._legacy_ser_ranges is not None and self._cached_network_ser_bytes is not None:
+            return sha256d(self._cached_network_ser_bytes)[::-1].hex()
         if not self.is_complete():
             return None
         try:
@@ -1207,10 +1280,10 @@ class Transaction:
 
     def estimated_total_size(self):
         """Return an estimated total transaction size in bytes."""
-        if not self.is_complete() or self._cached_network_ser is None:
+        if not self.is_complete() or self._cached_network_ser_bytes is None:
             return len(self.serialize_to_network(estimate_size=True)) // 2
         else:
-            return len(self._cached_network_ser) // 2  # ASCII hex string
+            return len(self._cached_network_ser_bytes)
 
     def estimated_witness_size(self):
         """Return an estimate of witness size in bytes."""
@@ -2183,6 +2256,7 @@ class PartialTransaction(Transaction):
 
     def serialize_preimage(self, txin_index: int, wallet: 'Abstract_Wallet', *,
                            bip143_shared_txdigest_fields: BIP143SharedTxDigestFields = None,
+                           legacy_shared_txdigest_fields: LegacySharedTxDigestFields = None,
                            locking_script_overrides = None) -> str:
         nVersion = int_to_hex(self.version, 4)
         nLocktime = int_to_hex(self.locktime, 4)
@@ -2217,42 +2291,71 @@ class PartialTransaction(Transaction):
             nSequence = int_to_hex(txin.nsequence, 4)
             preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
         else:
-            if sighash & Sighash.ANYONECANPAY:
-                txins = var_int(1) + txin.serialize_to_network(script_sig=bfh(preimage_script)).hex()
-            else:
-                input_serializations = []
-                for k, txin in enumerate(inputs):
-                    if ((sighash & 0x1f) == Sighash.NONE or (sighash & 0x1f) == Sighash.SINGLE) and txin_index != k:
-                        txin = PartialTxInput.from_txin(txin, strip_witness=False)
-                        txin.nsequence = 0
-                    serialization = txin.serialize_to_network(script_sig=bfh(preimage_script) if txin_index==k else b"").hex()
-                    input_serializations.append(serialization)
-
-                txins = var_int(len(inputs)) + ''.join(input_serializations)
-
-            if (sighash & 0x1f) == Sighash.NONE:
-                txouts = var_int(0)
-            elif (sighash & 0x1f) == Sighash.SINGLE:
-                if txin_index >= len(outputs):
-                    raise Exception('Not enough outputs for SIGHASH_SINGLE!')
-                output_serializations = []
-                for k, txout in enumerate(outputs):
-                    if k > txin_index: break
-                    if k < txin_index:
-                        txout = PartialTxOutput.from_txout(txout)
-                        txout.scriptpubkey = b''
-                        txout.value = (1 << 64) - 1
-                    serialization = txout.serialize_to_network().hex()
-                    output_serializations.append(serialization)
-                txouts = var_int(len(output_serializations)) + ''.join(output_serializations)
-            else:
-                txouts = var_int(len(outputs)) + ''.join(o.serialize_to_network().hex() for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
+            preimage = self._serialize_legacy_preimage(
+                txin_index, bfh(preimage_script), sighash,
+                legacy_shared_txdigest_fields=legacy_shared_txdigest_fields).hex()
         return preimage
 
-    def sign(self, keypairs, wallet: 'Abstract_Wallet', *, locking_script_overrides=None) -> None:
+    def _serialize_legacy_preimage(self, txin_index: int, script_code: bytes, sighash: int, *,
+                                   legacy_shared_txdigest_fields: LegacySharedTxDigestFields = None) -> bytes:
+        """The pre-segwit sighash preimage, as bytes. The input and output vectors
+        are taken from legacy_shared_txdigest_fields, so that signing all inputs
+        does not re-serialize the whole transaction for each of them.
+        """
+        if legacy_shared_txdigest_fields is None:
+            legacy_shared_txdigest_fields = self._calc_legacy_shared_txdigest_fields()
+        fields = legacy_shared_txdigest_fields
+        base_sighash = sighash & 0x1f
+        start = txin_index * LEGACY_EMPTY_TXIN_SIZE
+        end = start + LEGACY_EMPTY_TXIN_SIZE
+        prevout = fields.txins[start:start + 36]
+        nsequence = fields.txins[end - 4:end]
+        txin = prevout + bfh(var_int(len(script_code))) + script_code + nsequence
+        if sighash & Sighash.ANYONECANPAY:
+            txins = bfh(var_int(1)) + txin
+        else:
+            if base_sighash in (Sighash.NONE, Sighash.SINGLE):
+                others = fields.txins_no_sequence
+            else:
+                others = fields.txins
+            num_inputs = len(others) // LEGACY_EMPTY_TXIN_SIZE
+            txins = bfh(var_int(num_inputs)) + others[:start] + txin + others[end:]
+        if base_sighash == Sighash.NONE:
+            txouts = bfh(var_int(0))
+        elif base_sighash == Sighash.SINGLE:
+            if txin_index >= len(fields.outputs):
+                raise Exception('Not enough outputs for SIGHASH_SINGLE!')
+            txouts = bfh(var_int(txin_index + 1)) + LEGACY_BLANK_TXOUT * txin_index + fields.outputs[txin_index]
+        else:
+            txouts = fields.txouts
+        nVersion = bfh(int_to_hex(self.version, 4))
+        nLocktime = bfh(int_to_hex(self.locktime, 4))
+        nHashType = bfh(int_to_hex(sighash, 4))
+        return nVersion + txins + txouts + nLocktime + nHashType
+
+    def sign(self, keypairs, wallet: 'Abstract_Wallet', *, locking_script_overrides=None, num_workers: int = 1) -> None:
         # keypairs:  pubkey_hex -> (secret_bytes, is_compressed)
+        # num_workers: if >1, signatures are computed on a thread pool (libsecp256k1 releases the GIL).
+        #              They are added to the inputs in the same order as when signing serially,
+        #              so the resulting tx is identical.
         bip143_shared_txdigest_fields = self._calc_bip143_shared_txdigest_fields()
+        legacy_shared_txdigest_fields = self._calc_legacy_shared_txdigest_fields()
+
+        def sign_input(i: int, pubkey: str) -> str:
+            sec, compressed = keypairs[pubkey]
+            return self.sign_txin(i, sec, wallet, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields,
+                                  legacy_shared_txdigest_fields=legacy_shared_txdigest_fields,
+                                  locking_script_overrides=locking_script_overrides)
+
+        presigned = {}  # (txin_idx, pubkey_hex) -> sig
+        if num_workers > 1:
+            # the sighash does not depend on other signatures, so all of them can be computed upfront
+            jobs = [(i, pk.hex()) for i, txin in enumerate(self.inputs()) if not txin.is_complete()
+                    for pk in txin.pubkeys if pk.hex() in keypairs]
+            if len(jobs) > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+                    sigs = list(executor.map(lambda job: sign_input(*job), jobs))
+                presigned = dict(zip(jobs, sigs))
         for i, txin in enumerate(self.inputs()):
             pubkeys = [pk.hex() for pk in txin.pubkeys]
             for pubkey in pubkeys:
@@ -2261,19 +2364,21 @@ class PartialTransaction(Transaction):
                 if pubkey not in keypairs:
                     continue
                 _logger.info(f"adding signature for {pubkey}. spending utxo {txin.prevout.to_str()}")
-                sec, compressed = keypairs[pubkey]
-                sig = self.sign_txin(i, sec, wallet, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields, locking_script_overrides=locking_script_overrides)
+                sig = presigned.get((i, pubkey)) or sign_input(i, pubkey)
                 self.add_signature_to_txin(txin_idx=i, signing_pubkey=pubkey, sig=sig)
 
         _logger.debug(f"is_complete {self.is_complete()}")
         self.invalidate_ser_cache()
 
-    def sign_txin(self, txin_index, privkey_bytes, wallet: 'Abstract_Wallet', *, bip143_shared_txdigest_fields=None, locking_script_overrides=None) -> str:
+    def sign_txin(self, txin_index, privkey_bytes, wallet: 'Abstract_Wallet', *, bip143_shared_txdigest_fields=None,
+                  legacy_shared_txdigest_fields=None, locking_script_overrides=None) -> str:
         txin = self.inputs()[txin_index]
         txin.validate_data(for_signing=True)
         sighash = txin.sighash if txin.sighash is not None else Sighash.ALL
         pre_hash = sha256d(bfh(self.serialize_preimage(txin_index, wallet,
-                                                       bip143_shared_txdigest_fields=bip143_shared_txdigest_fields, locking_script_overrides=locking_script_overrides)))
+                                                       bip143_shared_txdigest_fields=bip143_shared_txdigest_fields,
+                                                       legacy_shared_txdigest_fields=legacy_shared_txdigest_fields,
+                                                       locking_script_overrides=locking_script_overrides)))
         privkey = ecc.ECPrivkey(privkey_bytes)
         sig = privkey.sign_transaction(pre_hash)
         sig = sig.hex() + Sighash.to_sigbytes(sighash).hex()
@@ -511,6 +511,17 @@ def ensure_sparse_file(filename):
             _logger.info(f'error marking file {filename} as sparse: {e}')
 
 
+def fsync_dir(path: str) -> None:
+    """Makes files created, renamed or removed in the directory at path durable."""
+    if os.name == 'nt':
+        return  # directories cannot be opened on Windows. NTFS journals its metadata anyway.
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def get_headers_dir(config):
     return config.path
 
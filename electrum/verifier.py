@@ -22,7 +22,8 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING, Tuple
+from collections import OrderedDict
+from typing import Sequence, Optional, TYPE_CHECKING, Tuple, Dict, Set
 
 import aiorpcx
 
@@ -50,6 +51,8 @@ class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 class SPV(NetworkJobOnDefaultServer):
     """ Simple Payment Verification """
 
+    MAX_CACHED_ITEMS = 1000  # per cache, see _get_cached
+
     def __init__(self, network: 'Network', wallet: 'AddressSynchronizer'):
         self.wallet = wallet
         NetworkJobOnDefaultServer.__init__(self, network)
@@ -59,20 +62,36 @@ class SPV(NetworkJobOnDefaultServer):
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
         self.verifying = set()
+        # shared by all kinds of verifications, see _get_cached
+        self._proofs = OrderedDict()  # type: Dict[Tuple[str, int], asyncio.Task]  # (txid, height) -> (pos, header)
+        self._txs = OrderedDict()  # type: Dict[str, asyncio.Task]  # txid -> Transaction
+        self._shared_requests = set()  # type: Set[asyncio.Task]  # pending tasks of the caches
 
     async def _run_tasks(self, *, taskgroup):
         await super()._run_tasks(taskgroup=taskgroup)
         async with taskgroup as group:
             await group.spawn(self.main)
 
+    async def stop(self, *, full_shutdown: bool = True):
+        await super().stop(full_shutdown=full_shutdown)
+        # the shared requests run outside of the taskgroup
+        for task in list(self._shared_requests):
+            task.cancel()
+
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
 
     async def main(self):
         self.blockchain = self.network.blockchain()
+        prev_uptodate = False
         while True:
             await self._maybe_undo_verifications()
             await self._request_proofs()
+            # the synchronizer only re-checks up_to_date when woken up
+            up_to_date = self.is_up_to_date()
+            if up_to_date != prev_uptodate and self.wallet.synchronizer:
+                self.wallet.synchronizer.notify_state_changed()
+            prev_uptodate = up_to_date
             await asyncio.sleep(0.1)
 
     async def _maybe_defer(self, tx_hash: str, tx_height: int, *, for_tx=False, add_to_requested_set=True, alt_id=None) -> bool:
@@ -181,16 +200,8 @@ class SPV(NetworkJobOnDefaultServer):
         verifying_id = f'b:{tx_hash}'
         self.verifying.add(verifying_id)
         try:
-            await self._request_and_verify_single_proof(tx_hash, height, quick_return=True)
-            tx = self.wallet.get_transaction(tx_hash)
-            if not tx:
-                self._requests_sent += 1
-                try:
-                    async with self._network_request_semaphore:
-                        raw_tx = await self.interface.get_transaction(tx_hash)
-                finally:
-                    self._requests_answered += 1
-                tx = Transaction(raw_tx)
+            await self._get_verified_proof(tx_hash, height)
+            tx = await self._get_transaction(tx_hash)
             idx = d['tx_pos']
             asset_info = get_asset_info_from_script(tx.outputs()[idx].scriptpubkey)
             if _type := asset_info.get_type() != AssetVoutType.TRANSFER:
@@ -204,15 +215,7 @@ class SPV(NetworkJobOnDefaultServer):
             for input in tx.inputs():
 
                 in_txid = input.prevout.txid.hex()
-                in_tx = self.wallet.get_transaction(in_txid)
-                if not in_tx:
-                    self._requests_sent += 1
-                    try:
-                        async with self._network_request_semaphore:
-                            raw_tx = await self.interface.get_transaction(in_txid)
-                    finally:
-                        self._requests_answered += 1
-                    in_tx = Transaction(raw_tx)
+                in_tx = await self._get_transaction(in_txid)
 
                 if in_tx.outputs()[input.prevout.out_idx].address == tx.outputs()[idx].address and \
                     in_tx.outputs()[input.prevout.out_idx].asset == tx.outputs()[idx].asset:
@@ -238,16 +241,8 @@ class SPV(NetworkJobOnDefaultServer):
         verifying_id = f'rf:{txid}'
         self.verifying.add(verifying_id)
         try:
-            await self._request_and_verify_single_proof(txid, height, quick_return=True)
-            tx = self.wallet.get_transaction(txid)
-            if not tx:
-                self._requests_sent += 1
-                try:
-                    async with self._network_request_semaphore:
-                        raw_tx = await self.interface.get_transaction(txid)
-                    tx = Transaction(raw_tx)
-                finally:
-                    self._requests_answered += 1
+            await self._get_verified_proof(txid, height)
+            tx = await self._get_transaction(txid)
             idx = d['tx_pos']
             asset_info = get_asset_info_from_script(tx.outputs()[idx].scriptpubkey)
             if _type := asset_info.get_type() != AssetVoutType.FREEZE:
@@ -273,16 +268,8 @@ class SPV(NetworkJobOnDefaultServer):
         verifying_id = f'rs:{txid}'
         self.verifying.add(verifying_id)
         try:
-            await self._request_and_verify_single_proof(txid, height, quick_return=True)
-            tx = self.wallet.get_transaction(txid)
-            if not tx:
-                self._requests_sent += 1
-                try:
-                    async with self._network_request_semaphore:
-                        raw_tx = await self.interface.get_transaction(txid)
-                    tx = Transaction(raw_tx)
-                finally:
-                    self._requests_answered += 1
+            await self._get_verified_proof(txid, height)
+            tx = await self._get_transaction(txid)
             idx_qual = d['qualifying_tx_pos']
             asset_info = get_asset_info_from_script(tx.outputs()[idx_qual].scriptpubkey)
             if _type := asset_info.get_type() != AssetVoutType.VERIFIER:
@@ -344,16 +331,8 @@ class SPV(NetworkJobOnDefaultServer):
             source_idx = divisions_source[0].out_idx
             source_height = divisions_source[1]
             try:
-                await self._request_and_verify_single_proof(source_txid, source_height, quick_return=True)
-                tx = self.wallet.get_transaction(source_txid)
-                if not tx:
-                    self._requests_sent += 1
-                    try:
-                        async with self._network_request_semaphore:
-                            raw_tx = await self.interface.get_transaction(source_txid)
-                        tx = Transaction(raw_tx)
-                    finally:
-                        self._requests_answered += 1
+                await self._get_verified_proof(source_txid, source_height)
+                tx = await self._get_transaction(source_txid)
                 asset_info = get_asset_info_from_script(tx.outputs()[source_idx].scriptpubkey)
                 if not isinstance(asset_info, MetadataAssetVoutInformation):
                     raise AssetException('No metadata at this outpoint!(1)')
@@ -371,16 +350,8 @@ class SPV(NetworkJobOnDefaultServer):
             source_idx = associated_data_source[0].out_idx
             source_height = associated_data_source[1]
             try:
-                await self._request_and_verify_single_proof(source_txid, source_height, quick_return=True)
-                tx = self.wallet.get_transaction(source_txid)
-                if not tx:
-                    self._requests_sent += 1
-                    try:
-                        async with self._network_request_semaphore:
-                            raw_tx = await self.interface.get_transaction(source_txid)
-                        tx = Transaction(raw_tx)
-                    finally:
-                        self._requests_answered += 1
+                await self._get_verified_proof(source_txid, source_height)
+                tx = await self._get_transaction(source_txid)
                 asset_info = get_asset_info_from_script(tx.outputs()[source_idx].scriptpubkey)
                 if not isinstance(asset_info, MetadataAssetVoutInformation):
                     raise AssetException('No metadata at this outpoint!(2)')
@@ -397,16 +368,8 @@ class SPV(NetworkJobOnDefaultServer):
         source_idx = source[0].out_idx
         source_height = source[1]
         try:
-            await self._request_and_verify_single_proof(source_txid, source_height, quick_return=True)
-            tx = self.wallet.get_transaction(source_txid)
-            if not tx:
-                self._requests_sent += 1
-                try:
-                    async with self._network_request_semaphore:
-                        raw_tx = await self.interface.get_transaction(source_txid)
-                    tx = Transaction(raw_tx)
-                finally:
-                    self._requests_answered += 1
+            await self._get_verified_proof(source_txid, source_height)
+            tx = await self._get_transaction(source_txid)
             asset_info = get_asset_info_from_script(tx.outputs()[source_idx].scriptpubkey)
             if not isinstance(asset_info, MetadataAssetVoutInformation):
                 if not isinstance(asset_info, OwnerAssetVoutInformation):
@@ -445,16 +408,8 @@ class SPV(NetworkJobOnDefaultServer):
         verifying_id = f't4q:{txid}'
         self.verifying.add(verifying_id)
         try:
-            await self._request_and_verify_single_proof(txid, height, quick_return=True)
-            tx = self.wallet.get_transaction(txid)
-            if not tx:
-                self._requests_sent += 1
-                try:
-                    async with self._network_request_semaphore:
-                        raw_tx = await self.interface.get_transaction(txid)
-                    tx = Transaction(raw_tx)
-                finally:
-                    self._requests_answered += 1
+            await self._get_verified_proof(txid, height)
+            tx = await self._get_transaction(txid)
             idx = d['tx_pos']
             asset_info = get_asset_info_from_script(tx.outputs()[idx].scriptpubkey)
             if _type := asset_info.get_type() != AssetVoutType.NULL:
@@ -483,16 +438,8 @@ class SPV(NetworkJobOnDefaultServer):
         verifying_id = f't4h:{txid}'
         self.verifying.add(verifying_id)
         try:
-            await self._request_and_verify_single_proof(txid, height, quick_return=True)
-            tx = self.wallet.get_transaction(txid)
-            if not tx:
-                self._requests_sent += 1
-                try:
-                    async with self._network_request_semaphore:
-                        raw_tx = await self.interface.get_transaction(txid)
-                    tx = Transaction(raw_tx)
-                finally:
-                    self._requests_answered += 1
+            await self._get_verified_proof(txid, height)
+            tx = await self._get_transaction(txid)
             idx = d['tx_pos']
             asset_info = get_asset_info_from_script(tx.outputs()[idx].scriptpubkey)
             if _type := asset_info.get_type() != AssetVoutType.NULL:
@@ -516,7 +463,7 @@ class SPV(NetworkJobOnDefaultServer):
 
     async def _verify_unverified_transaction(self, tx_hash, tx_height):
         try:
-            pos, header = await self._request_and_verify_single_proof(tx_hash, tx_height)
+            pos, header = await self._get_verified_proof(tx_hash, tx_height)
         except aiorpcx.jsonrpc.RPCError:
             self.logger.info(f'tx {tx_hash} not at height {tx_height}')
             self.wallet.remove_unverified_tx(tx_hash, tx_height)
@@ -530,9 +477,60 @@ class SPV(NetworkJobOnDefaultServer):
         self.wallet.add_verified_tx(tx_hash, tx_info)
 
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height, *, quick_return=False):
-        if quick_return and tx_hash in self.merkle_roots:
-            return
+    async def _get_verified_proof(self, tx_hash: str, tx_height: int) -> Tuple[int, dict]:
+        """Returns (pos, header) of a tx, once its merkle proof is verified.
+        The proof is requested at most once per (txid, height), whichever kind of
+        item (tx, asset metadata, tag...) it is for.
+        """
+        try:
+            return await self._get_cached((tx_hash, tx_height), self._proofs,
+                                          self._request_and_verify_single_proof, tx_hash, tx_height)
+        finally:
+            self.requested_merkle.discard(tx_hash)
+
+    async def _get_transaction(self, tx_hash: str) -> Transaction:
+        """Returns a tx from the wallet, or from the server.
+        A tx is requested from the server at most once per txid.
+        """
+        tx = self.wallet.get_transaction(tx_hash)
+        if tx:
+            return tx
+        return await self._get_cached(tx_hash, self._txs, self._request_transaction, tx_hash)
+
+    async def _get_cached(self, key, cache: OrderedDict, request, *args):
+        # Concurrent callers share one request. It runs in its own task, so that
+        # a caller being cancelled does not cancel it for the others.
+        # Failures are not cached. The cache keeps the most recently used items.
+        task = cache.get(key)
+        if task is None:
+            task = cache[key] = asyncio.ensure_future(request(*args))
+            self._shared_requests.add(task)
+            def on_done(task):
+                self._shared_requests.discard(task)
+                if (task.cancelled() or task.exception() is not None) and cache.get(key) is task:
+                    del cache[key]
+            task.add_done_callback(on_done)
+            while len(cache) > self.MAX_CACHED_ITEMS:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return await asyncio.shield(task)
+
+    async def _request_transaction(self, tx_hash: str) -> Transaction:
+        self._requests_sent += 1
+        try:
+            async with self._network_request_semaphore:
+                raw_tx = await self.interface.get_transaction(tx_hash)
+        finally:
+            self._requests_answered += 1
+        return Transaction(raw_tx)
+
+    def _forget_cached_above_height(self, height: int) -> None:
+        # txs are identified by their txid, only the proofs depend on the chain
+        for key in [key for key in self._proofs if key[1] > height]:
+            del self._proofs[key]
+
+    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
         self.logger.info(f'requesting merkle {tx_hash}')
         try:
             self._requests_sent += 1
@@ -610,6 +608,7 @@ class SPV(NetworkJobOnDefaultServer):
             self.blockchain = cur_chain
             above_height = cur_chain.get_height_of_last_common_block_with_chain(old_chain)
             self.logger.info(f"undoing verifications above height {above_height}")
+            self._forget_cached_above_height(above_height)
             tx_hashes = self.wallet.undo_verifications(self.blockchain, above_height)
             for tx_hash in tx_hashes:
                 self.logger.info(f"redoing {tx_hash}")
@@ -618,6 +617,8 @@ class SPV(NetworkJobOnDefaultServer):
     def remove_spv_proof_for_tx(self, tx_hash):
         self.merkle_roots.pop(tx_hash, None)
         self.requested_merkle.discard(tx_hash)
+        for key in [key for key in self._proofs if key[0] == tx_hash]:
+            del self._proofs[key]
 
     def is_up_to_date(self):
         #print(f'{self.requested_merkle=}')
@@ -64,11 +64,11 @@ from .simple_config import SimpleConfig, FEE_RATIO_HIGH_WARNING, FEERATE_WARNING
 from .bitcoin import COIN, TYPE_ADDRESS, opcodes
 from .bitcoin import DummyAddress, DummyAddressUsedInTxException
 from .bitcoin import (is_address, address_to_script, is_minikey, relayfee, dust_threshold, b58_address_to_hash160, is_b58_address)
-from .asset import (get_asset_info_from_script, parse_verifier_string, generate_transfer_script_from_base, MAX_ASSET_DIVISIONS, 
+from .asset import (get_asset_info_from_script, get_asset_info_from_outputs, parse_verifier_string, generate_transfer_script_from_base, MAX_ASSET_DIVISIONS, 
                     TransferAssetVoutInformation, AssetMemo)
 from .crypto import sha256d
 from . import keystore
-from .keystore import (load_keystore, Hardware_KeyStore, KeyStore, KeyStoreWithMPK,
+from .keystore import (load_keystore, Hardware_KeyStore, KeyStore, KeyStoreWithMPK, Software_KeyStore,
                        AddressIndexGeneric, CannotDerivePubkey)
 from .util import multisig_type, parse_max_spend
 from .storage import StorageEncryptionVersion, WalletStorage
@@ -426,6 +426,8 @@ class Abstract_Wallet(ABC, Logger, EventListener):
             self.db.write()
 
     def save_backup(self, backup_dir):
+        """Writes a copy of the wallet to backup_dir. The copy is a single json file,
+        with the data of the sqlite database of the wallet (if any) included."""
         new_path = os.path.join(backup_dir, self.basename() + '.backup')
         new_storage = WalletStorage(new_path)
         new_storage._encryption_version = self.storage._encryption_version
@@ -489,6 +491,7 @@ class Abstract_Wallet(ABC, Logger, EventListener):
             if any([ks.is_requesting_to_be_rewritten_to_wallet_file for ks in self.get_keystores()]):
                 self.save_keystore()
             self.save_db()
+            self.db.close()
 
     def is_up_to_date(self) -> bool:
         if self.taskgroup.joined:  # either stop() was called, or the taskgroup died
@@ -1972,7 +1975,7 @@ class Abstract_Wallet(ABC, Logger, EventListener):
                 distr_amount += val
 
         assert all(output.value == 0 for output in outputs if output.asset)
-        assert all(get_asset_info_from_script(output.scriptpubkey).well_formed_script for output in outputs)
+        assert all(asset_info.well_formed_script for asset_info in get_asset_info_from_outputs(outputs))
 
         if fee is None and self.config.fee_per_kb() is None:
             raise NoDynamicFeeEstimates()
@@ -2683,8 +2686,12 @@ class Abstract_Wallet(ABC, Logger, EventListener):
         txout.is_change = self.is_change(address)
         self._add_txinout_derivation_info(txout, address, only_der_suffix=only_der_suffix)
 
-    def sign_transaction(self, tx: Transaction, password) -> Optional[PartialTransaction]:
-        """ returns tx if successful else None """
+    def sign_transaction(self, tx: Transaction, password, *, num_workers: int = None) -> Optional[PartialTransaction]:
+        """ returns tx if successful else None
+
+        num_workers: number of threads computing the signatures of software keystores.
+                     Defaults to config.WALLET_SIGNING_NUM_WORKERS. The signed tx does not depend on it.
+        """
         if self.is_watching_only():
             return
         if not isinstance(tx, PartialTransaction):
@@ -2700,13 +2707,19 @@ class Abstract_Wallet(ABC, Logger, EventListener):
         # and full derivation paths as hw keystores might want them
         tmp_tx = copy.deepcopy(tx)
         tmp_tx.add_info_from_wallet(self, include_xpubs=True)
+        if num_workers is None:
+            num_workers = self.config.WALLET_SIGNING_NUM_WORKERS
         # sign. start with ready keystores.
         # note: ks.ready_to_sign() side-effect: we trigger pairings with potential hw devices.
         #       We only do this once, before the loop, however we could rescan after each iteration,
         #       to see if the user connected/disconnected devices in the meantime.
         for k in sorted(self.get_keystores(), key=lambda ks: ks.ready_to_sign(), reverse=True):
             try:
-                if k.can_sign(tmp_tx):
+                if not k.can_sign(tmp_tx):
+                    continue
+                if isinstance(k, Software_KeyStore):
+                    k.sign_transaction(tmp_tx, password, self, num_workers=num_workers)
+                else:
                     k.sign_transaction(tmp_tx, password, self)
             except UserCancelled:
                 continue
@@ -3081,6 +3094,8 @@ class Abstract_Wallet(ABC, Logger, EventListener):
                 enc_version = self.get_available_storage_encryption_version()
             else:
                 enc_version = StorageEncryptionVersion.PLAINTEXT
+            if new_pw and enc_version != StorageEncryptionVersion.PLAINTEXT and self.db.is_using_sqlite():
+                raise WalletFileException("Can't encrypt a wallet that uses an sqlite database.")
             self.storage.set_password(new_pw, enc_version)
         # make sure next storage.write() saves changes
         self.db.set_modified(True)
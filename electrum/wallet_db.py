@@ -28,9 +28,10 @@ import datetime
 import json
 import copy
 import threading
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from typing import Dict, Optional, List, Tuple, Set, Iterable, NamedTuple, Sequence, TYPE_CHECKING, Union, Any
 import binascii
+import bisect
 import time
 
 import attr
@@ -40,12 +41,14 @@ from .asset import AssetMetadata, get_error_for_asset_name
 from .util import profiler, WalletFileException, multisig_type, TxMinedInfo, bfh
 from .invoices import Invoice, Request
 from .keystore import bip44_derivation
-from .transaction import Transaction, TxOutpoint, tx_from_any, PartialTransaction, PartialTxOutput
+from .transaction import (Transaction, TxOutpoint, PartialTransaction, PartialTxOutput,
+                          convert_raw_tx_to_hex)
 from .logging import Logger
 
 from .lnutil import LOCAL, REMOTE, HTLCOwner, ChannelType
 from . import json_db
-from .json_db import StoredDict, JsonDB, locked, modifier, StoredObject, stored_in, stored_as
+from .json_db import StoredDict, JsonDB, locked, modifier, StoredObject, stored_in, stored_as, JsonDBJsonEncoder
+from .wallet_sqlite import WalletSqlite, SqliteStoredDict, SQLITE_MAPS, get_sqlite_path
 from .plugin import run_hook, plugin_loaders
 from .version import ELECTRUM_VERSION
 from .atomic_swap import AtomicSwap
@@ -56,6 +59,20 @@ from .atomic_swap import AtomicSwap
 
 FINAL_SEED_VERSION = 1
 
+# number of deserialized transactions kept in memory by WalletDB
+TX_CACHE_SIZE = 1000
+PSBT_MAGIC = b'psbt\xff'
+
+
+def raw_tx_from_json(x: str) -> bytes:
+    """Stored transactions are kept as raw bytes: network serialization,
+    or PSBT for partial ones (which older versions stored as base64).
+    """
+    try:
+        return bytes.fromhex(x)
+    except ValueError:
+        return bytes.fromhex(convert_raw_tx_to_hex(x))
+
 @stored_in('tx_fees', tuple)
 class TxFeesValue(NamedTuple):
     fee: Optional[int] = None
@@ -78,13 +95,44 @@ class DBMetadata(StoredObject):
         return f"using {ver}, on {date_str}"
 
 
+class HeightIndex:
+    """Keys of verified data, ordered by height.
+    Finds the ones above a height (i.e. affected by a reorg) without a full scan.
+    """
+
+    def __init__(self):
+        self._heights = {}  # key -> height
+        self._sorted = []  # type: List[Tuple[int, Any]]  # (height, key)
+
+    def add(self, key, height: int) -> None:
+        self.remove(key)
+        self._heights[key] = height
+        bisect.insort(self._sorted, (height, key))
+
+    def remove(self, key) -> None:
+        height = self._heights.pop(key, None)
+        if height is None:
+            return
+        i = bisect.bisect_left(self._sorted, (height, key))
+        assert self._sorted[i] == (height, key)
+        del self._sorted[i]
+
+    def clear(self) -> None:
+        self._heights.clear()
+        self._sorted.clear()
+
+    def keys_above(self, height: int) -> List:
+        i = bisect.bisect_left(self._sorted, (height + 1,))
+        return [key for _, key in self._sorted[i:]]
+
+
 # note: subclassing WalletFileException for some specific cases
 #       allows the crash reporter to distinguish them and open
 #       separate tracking issues
 class WalletFileExceptionVersion51(WalletFileException): pass
 
 # register dicts that require value conversions not handled by constructor
-json_db.register_dict('transactions', lambda x: tx_from_any(x, deserialize=False), None)
+json_db.register_dict('transactions', raw_tx_from_json, None)
 json_db.register_dict('prevouts_by_scripthash', lambda x: set(tuple(k) for k in x), None)
 json_db.register_dict('data_loss_protect_remote_pcp', lambda x: bytes.fromhex(x), None)
 json_db.register_dict('verified_asset_metadata', lambda metadata, tup1, tup2, tup3: (
@@ -108,6 +156,8 @@ for key in ('assets_to_watch', 'asset_blacklist', 'broadcasts_to_watch', 'non_de
 class WalletDB(JsonDB):
 
     def __init__(self, data, *, storage=None, manual_upgrades: bool):
+        self._sqlite = None  # type: Optional[WalletSqlite]
+        self._sqlite_maps = {}  # type: Dict[str, SqliteStoredDict]
         JsonDB.__init__(self, data, storage)
         if not data:
             # create new DB
@@ -143,6 +193,8 @@ class WalletDB(JsonDB):
                     self.logger.info(f'Failed to convert label to json format: {key}')
                     continue
                 self.data[key] = value
+            # convert the file to json
+            self._needs_full_write = True
         if not isinstance(self.data, dict):
             raise WalletFileException("Malformed wallet file (not dict)")
 
@@ -200,7 +252,9 @@ class WalletDB(JsonDB):
         if self._called_after_upgrade_tasks:
             # we need strict ordering between upgrade() and after_upgrade_tasks()
             raise Exception("'after_upgrade_tasks' must NOT be called before 'upgrade'")
-        
+        # upgrades modify the data in place
+        self._needs_full_write = True
+
         # Upgrades go here
         
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
@@ -369,6 +423,7 @@ class WalletDB(JsonDB):
         if scripthash not in self._prevouts_by_scripthash:
             self._prevouts_by_scripthash[scripthash] = set()
         self._prevouts_by_scripthash[scripthash].add((prevout.to_str(), value, asset))
+        self.journal_value(['prevouts_by_scripthash', scripthash])
 
     @modifier
     def remove_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
@@ -378,6 +433,8 @@ class WalletDB(JsonDB):
         self._prevouts_by_scripthash[scripthash].discard((prevout.to_str(), value))
         if not self._prevouts_by_scripthash[scripthash]:
             self._prevouts_by_scripthash.pop(scripthash)
+        else:
+            self.journal_value(['prevouts_by_scripthash', scripthash])
 
     @locked
     def get_prevouts_by_scripthash(self, scripthash: str) -> Set[Tuple[TxOutpoint, int, Optional[str]]]:
@@ -390,28 +447,44 @@ class WalletDB(JsonDB):
         assert isinstance(tx_hash, str)
         assert isinstance(tx, Transaction), tx
         # note that tx might be a PartialTransaction
-        # serialize and de-serialize tx now. this might e.g. convert a complete PartialTx to a Tx
-        tx = tx_from_any(str(tx))
+        # we store its serialization; a complete PartialTx is stored as a Tx
         if not tx_hash:
             raise Exception("trying to add tx to db without txid")
         if tx_hash != tx.txid():
             raise Exception(f"trying to add tx to db with inconsistent txid: {tx_hash} != {tx.txid()}")
+        raw = tx.serialize_as_bytes()
         # don't allow overwriting complete tx with partial tx
-        tx_we_already_have = self.transactions.get(tx_hash, None)
-        if tx_we_already_have is None or isinstance(tx_we_already_have, PartialTransaction):
-            self.transactions[tx_hash] = tx
+        raw_we_already_have = self.transactions.get(tx_hash, None)
+        if raw_we_already_have is None or raw_we_already_have.startswith(PSBT_MAGIC):
+            self.transactions[tx_hash] = raw
+            self._tx_cache.pop(tx_hash, None)
 
     @modifier
     def remove_transaction(self, tx_hash: str) -> Optional[Transaction]:
         assert isinstance(tx_hash, str)
-        return self.transactions.pop(tx_hash, None)
+        tx = self.get_transaction(tx_hash)
+        self.transactions.pop(tx_hash, None)
+        self._tx_cache.pop(tx_hash, None)
+        return tx
 
     @locked
     def get_transaction(self, tx_hash: Optional[str]) -> Optional[Transaction]:
         if tx_hash is None:
             return None
         assert isinstance(tx_hash, str), tx_hash
-        return self.transactions.get(tx_hash)
+        tx = self._tx_cache.get(tx_hash)
+        if tx is not None:
+            self._tx_cache.move_to_end(tx_hash)
+            return tx
+        raw = self.transactions.get(tx_hash)
+        if raw is None:
+            return None
+        # deserialization itself is deferred until the tx is accessed
+        tx = PartialTransaction.from_raw_psbt(raw) if raw.startswith(PSBT_MAGIC) else Transaction(raw)
+        self._tx_cache[tx_hash] = tx
+        if len(self._tx_cache) > TX_CACHE_SIZE:
+            self._tx_cache.popitem(last=False)
+        return tx
 
     @locked
     def list_transactions(self) -> Sequence[str]:
@@ -462,11 +535,18 @@ class WalletDB(JsonDB):
         assert isinstance(txid, str)
         assert isinstance(info, TxMinedInfo)
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
+        self._verified_tx_by_height.add(txid, info.height)
 
     @modifier
     def remove_verified_tx(self, txid: str):
         assert isinstance(txid, str)
         self.verified_tx.pop(txid, None)
+        self._verified_tx_by_height.remove(txid)
+
+    @locked
+    def get_verified_tx_after_height(self, height: int) -> Sequence[str]:
+        assert isinstance(height, int)
+        return self._verified_tx_by_height.keys_above(height)
 
     def is_in_verified_tx(self, txid: str) -> bool:
         assert isinstance(txid, str)
@@ -480,6 +560,7 @@ class WalletDB(JsonDB):
             self.tx_fees[txid] = TxFeesValue()
         tx_fees_value = self.tx_fees[txid]
         if tx_fees_value.is_calculated_by_us:
+            self.note_journaled(modified=False)
             return
         self.tx_fees[txid] = tx_fees_value._replace(fee=fee_sat, is_calculated_by_us=False)
 
@@ -487,6 +568,7 @@ class WalletDB(JsonDB):
     def add_tx_fee_we_calculated(self, txid: str, fee_sat: Optional[int]) -> None:
         assert isinstance(txid, str)
         if fee_sat is None:
+            self.note_journaled(modified=False)
             return
         assert isinstance(fee_sat, int)
         if txid not in self.tx_fees:
@@ -554,12 +636,14 @@ class WalletDB(JsonDB):
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (1, len(self.change_addresses))
         self.change_addresses.append(addr)
+        self.journal_append(['addresses', 'change'], addr)
 
     @modifier
     def add_receiving_address(self, addr: str) -> None:
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (0, len(self.receiving_addresses))
         self.receiving_addresses.append(addr)
+        self.journal_append(['addresses', 'receiving'], addr)
 
     @locked
     def get_address_index(self, address: str) -> Optional[Sequence[int]]:
@@ -631,6 +715,29 @@ class WalletDB(JsonDB):
         self.my_swaps = self.get_dict('atomic_swap')
         self.my_output_to_swap_id = self.get_dict('outpoint_to_swap_id')
 
+        # height indexes of the verified data, see undo_verifications
+        self._asset_metadata_by_height = HeightIndex()
+        for asset, (_, (_, height), _, _) in self.verified_asset_metadata.items():
+            self._asset_metadata_by_height.add(asset, height)
+        self._restricted_verifiers_by_height = HeightIndex()
+        for asset, d in self.verified_restricted_verifiers.items():
+            self._restricted_verifiers_by_height.add(asset, d['height'])
+        self._restricted_freezes_by_height = HeightIndex()
+        for asset, d in self.verified_restricted_freezes.items():
+            self._restricted_freezes_by_height.add(asset, d['height'])
+        self._broadcasts_by_height = HeightIndex()
+        for asset, d1 in self.verified_broadcasts.items():
+            for tx_hash, d2 in d1.items():
+                self._broadcasts_by_height.add((asset, tx_hash), d2['height'])
+        self._qualifier_tags_by_height = HeightIndex()
+        for asset, h160_dict in self.verified_tags_for_qualifiers.items():
+            for h160, d in h160_dict.items():
+                self._qualifier_tags_by_height.add((asset, h160), d['height'])
+        self._h160_tags_by_height = HeightIndex()
+        for h160, asset_dict in self.verified_tags_for_h160s.items():
+            for asset, d in asset_dict.items():
+                self._h160_tags_by_height.add((h160, asset), d['height'])
+
     @locked
     def get_swap_id_for_outpoint(self, outpoint: TxOutpoint) -> Optional[str]:
         assert isinstance(outpoint, TxOutpoint)
@@ -671,10 +778,12 @@ class WalletDB(JsonDB):
     @modifier
     def remove_broadcast_to_watch(self, asset):
         self.broadcasts_to_watch.discard(asset)
+        self.journal_value(['broadcasts_to_watch'])
 
     @modifier
     def add_broadcast_to_watch(self, asset):
         self.broadcasts_to_watch.add(asset)
+        self.journal_value(['broadcasts_to_watch'])
 
     @locked
     def get_asset_blacklist_regex_list(self) -> Sequence[str]:
@@ -684,10 +793,12 @@ class WalletDB(JsonDB):
     def update_asset_blacklist_regex_list(self, l):
         self.asset_blacklist.clear()
         self.asset_blacklist.update(l)
+        self.journal_value(['asset_blacklist'])
 
     @modifier
     def add_asset_blacklist_regex(self, r):
         self.asset_blacklist.add(r)
+        self.journal_value(['asset_blacklist'])
 
     @locked
     def is_non_deterministic_txo_lockingscript(self, outpoint: TxOutpoint) -> bool:
@@ -698,11 +809,13 @@ class WalletDB(JsonDB):
     def add_non_deterministic_txo_lockingscript(self, outpoint: TxOutpoint):
         assert isinstance(outpoint, TxOutpoint)
         self.non_deterministic_vouts.add(outpoint.to_str())
+        self.journal_value(['non_deterministic_txo_scriptpubkey'])
 
     @modifier
     def remove_non_deterministic_txo_lockingscript(self, outpoint: TxOutpoint):
         assert isinstance(outpoint, TxOutpoint)
         self.non_deterministic_vouts.discard(outpoint.to_str())
+        self.journal_value(['non_deterministic_txo_scriptpubkey'])
 
     @locked
     def get_assets_to_watch(self) -> Sequence[str]:
@@ -718,6 +831,7 @@ class WalletDB(JsonDB):
         assert isinstance(asset, str)
         assert (error := get_error_for_asset_name(asset) is None), error
         self.assets_to_watch.add(asset)
+        self.journal_value(['assets_to_watch'])
 
     @modifier
     def add_verified_asset_metadata(self, asset: str, metadata: AssetMetadata, source_tup: Tuple[TxOutpoint, int], source_divisions_tup: Tuple[TxOutpoint, int] | None, source_associated_data_tup: Tuple[TxOutpoint, int] | None):
@@ -739,6 +853,7 @@ class WalletDB(JsonDB):
             assert isinstance(source_associated_data_tup[1], int)
 
         self.verified_asset_metadata[asset] = metadata, source_tup, source_divisions_tup, source_associated_data_tup
+        self._asset_metadata_by_height.add(asset, source_tup[1])
 
     @locked
     def get_verified_asset_metadata(self, asset: str) -> Optional[AssetMetadata]:
@@ -768,15 +883,12 @@ class WalletDB(JsonDB):
     @locked
     def get_assets_verified_after_height(self, height: int) -> Sequence[str]:
         assert isinstance(height, int)
-        assets = []
-        for asset, (_, (_, verified_height), _, _) in self.verified_asset_metadata.items():
-            if verified_height > height:
-                assets.append(asset)
-        return assets
+        return self._asset_metadata_by_height.keys_above(height)
 
     @modifier
     def remove_verified_asset_metadata(self, asset: str):
         assert isinstance(asset, str)
+        self._asset_metadata_by_height.remove(asset)
         return self.verified_asset_metadata.pop(asset, None)
 
     @locked
@@ -788,6 +900,7 @@ class WalletDB(JsonDB):
     def remove_verified_restricted_verifier(self, asset: str):
         assert isinstance(asset, str)
         self.verified_restricted_verifiers.pop(asset)
+        self._restricted_verifiers_by_height.remove(asset)
 
     @modifier
     def add_verified_restricted_verifier(self, asset: str, d):
@@ -798,15 +911,12 @@ class WalletDB(JsonDB):
         assert isinstance(d['height'], int)
         assert isinstance(d['string'], str)
         self.verified_restricted_verifiers[asset] = d
+        self._restricted_verifiers_by_height.add(asset, d['height'])
 
     @locked
     def get_verified_restricted_verifier_after_height(self, height: int) -> Set[str]:
         assert isinstance(height, int)
-        s = set()
-        for asset, d in self.verified_restricted_verifiers.items():
-            if d['height'] > height:
-                s.add(asset)
-        return s
+        return set(self._restricted_verifiers_by_height.keys_above(height))
 
     @locked
     def get_verified_restricted_freeze(self, asset: str) -> Optional[Dict[str, Any]]:
@@ -817,6 +927,7 @@ class WalletDB(JsonDB):
     def remove_verified_restricted_freeze(self, asset: str):
         assert isinstance(asset, str)
         self.verified_restricted_freezes.pop(asset)
+        self._restricted_freezes_by_height.remove(asset)
 
     @modifier
     def add_verified_restricted_freeze(self, asset: str, d):
@@ -826,15 +937,12 @@ class WalletDB(JsonDB):
         assert isinstance(d['height'], int)
         assert isinstance(d['frozen'], bool)
         self.verified_restricted_freezes[asset] = d
+        self._restricted_freezes_by_height.add(asset, d['height'])
 
     @locked
     def get_verified_restricted_freezes_after_height(self, height: int) -> Set[str]:
         assert isinstance(height, int)
-        s = set()
-        for asset, d in self.verified_restricted_freezes.items():
-            if d['height'] > height:
-                s.add(asset)
-        return s
+        return set(self._restricted_freezes_by_height.keys_above(height))
 
     @locked
     def get_verified_broadcasts(self, asset: str) -> Dict[str, Dict[str, Any]]:
@@ -852,6 +960,7 @@ class WalletDB(JsonDB):
         assert isinstance(asset, str)
         assert isinstance(tx_hash, str)
         self.verified_broadcasts.get(asset, dict()).pop(tx_hash, None)
+        self._broadcasts_by_height.remove((asset, tx_hash))
 
     @modifier
     def add_verified_broadcast(self, asset: str, tx_hash: str, d):
@@ -866,17 +975,16 @@ class WalletDB(JsonDB):
         if asset not in self.verified_broadcasts:
             self.verified_broadcasts[asset] = dict()
         self.verified_broadcasts[asset][tx_hash] = d
+        self._broadcasts_by_height.add((asset, tx_hash), d['height'])
 
     @locked
     def get_verified_broadcasts_after_height(self, height: int) -> Dict[str, Set[str]]:
         assert isinstance(height, int)
         d = dict()
-        for asset, d1 in self.verified_broadcasts.items():
-            for tx_hash, d2 in d1.items():
-                if d2['height'] > height:
-                    if asset not in d:
-                        d[asset] = set()
-                    d[asset].add(tx_hash)
+        for asset, tx_hash in self._broadcasts_by_height.keys_above(height):
+            if asset not in d:
+                d[asset] = set()
+            d[asset].add(tx_hash)
         return d
 
     @locked
@@ -902,6 +1010,7 @@ class WalletDB(JsonDB):
         assert isinstance(asset, str)
         assert isinstance(h160, str)
         self.verified_tags_for_qualifiers.get(asset, dict()).pop(h160, None)
+        self._qualifier_tags_by_height.remove((asset, h160))
         # Do not pop off top level key
 
     @modifier
@@ -915,15 +1024,14 @@ class WalletDB(JsonDB):
         if self.verified_tags_for_qualifiers.get(asset) is None:
             self.verified_tags_for_qualifiers[asset] = dict()
         self.verified_tags_for_qualifiers[asset][h160] = d
+        self._qualifier_tags_by_height.add((asset, h160), d['height'])
 
     @locked
     def get_verified_qualifier_tags_after_height(self, height: int) -> Dict[str, Set[str]]:
         assert isinstance(height, int)
         d = defaultdict(set)
-        for asset, h160_dict in self.verified_tags_for_qualifiers.items():
-            for h160, d1 in h160_dict.items():
-                if d1['height'] > height:
-                    d[asset].add(h160)
+        for asset, h160 in self._qualifier_tags_by_height.keys_above(height):
+            d[asset].add(h160)
         return d
 
     @locked
@@ -947,6 +1055,7 @@ class WalletDB(JsonDB):
         assert isinstance(asset, str)
         assert isinstance(h160, str)
         self.verified_tags_for_h160s.get(h160, dict()).pop(asset, None)
+        self._h160_tags_by_height.remove((h160, asset))
         # Do not pop off top level key
 
     @modifier
@@ -960,27 +1069,29 @@ class WalletDB(JsonDB):
         if self.verified_tags_for_h160s.get(h160) is None:
             self.verified_tags_for_h160s[h160] = dict()
         self.verified_tags_for_h160s[h160][asset] = d
+        self._h160_tags_by_height.add((h160, asset), d['height'])
 
     @locked
     def get_verified_h160_tags_after_height(self, height: int) -> Dict[str, Set[str]]:
         assert isinstance(height, int)
         d = defaultdict(set)
-        for h160, asset_dict in self.verified_tags_for_h160s.items():
-            for asset, d1 in asset_dict.items():
-                if d1['height'] > height:
-                    d[h160].add(asset)
+        for h160, asset in self._h160_tags_by_height.keys_above(height):
+            d[h160].add(asset)
         return d
 
     @profiler
     def _load_transactions(self):
         self.data = StoredDict(self.data, self, [])
+        if self.get('use_sqlite') and self.storage:
+            self._load_sqlite_maps()
         # references in self.data
         # TODO make all these private
         # txid -> address -> prev_outpoint -> value
         self.txi = self.get_dict('txi')                          # type: Dict[str, Dict[str, Dict[str, Tuple[int, Optional[str]]]]]
         # txid -> address -> output_index -> (value, is_coinbase)
         self.txo = self.get_dict('txo')                          # type: Dict[str, Dict[str, Dict[str, Tuple[int, Optional[str], bool]]]]
-        self.transactions = self.get_dict('transactions')        # type: Dict[str, Transaction]
+        self.transactions = self.get_dict('transactions')        # type: Dict[str, bytes]  # raw tx, see get_transaction
+        self._tx_cache = OrderedDict()                           # type: Dict[str, Transaction]  # LRU
         self.spent_outpoints = self.get_dict('spent_outpoints')  # txid -> output_index -> next_txid
         self.history = self.get_dict('addr_history')             # address -> list of (txid, height)
         self.verified_tx = self.get_dict('verified_tx3')         # txid -> (height, timestamp, txpos, header_hash)
@@ -999,6 +1110,111 @@ class WalletDB(JsonDB):
                 if spending_txid not in self.transactions:
                     self.logger.info("removing unreferenced spent outpoint")
                     d.pop(prevout_n)
+        self._verified_tx_by_height = HeightIndex()
+        for txid, (height, *_) in self.verified_tx.items():
+            self._verified_tx_by_height.add(txid, height)
+
+    def _load_sqlite_maps(self, *, create: bool = False):
+        """Replaces the maps listed in SQLITE_MAPS with tables of the sqlite
+        database next to the wallet file. A map still found in the json data
+        (e.g. when converting) is copied to its table first.
+        """
+        if self.storage.is_encrypted():
+            raise WalletFileException('an encrypted wallet cannot use an sqlite database: it would not be encrypted')
+        path = get_sqlite_path(self.storage.path)
+        if not create and not os.path.exists(path):
+            raise WalletFileException(
+                f'The sqlite database of this wallet is missing: {path}\n'
+                f'It has to be next to the wallet file, and renamed along with it.')
+        self._sqlite = WalletSqlite(path)
+        for name, attr_name in SQLITE_MAPS.items():
+            table = SqliteStoredDict(self._sqlite, self, name)
+            if name in self.data:
+                value = self.data[name]
+                table.clear()
+                self._sqlite.put_many(name, [(k, json.dumps(v, cls=JsonDBJsonEncoder)) for k, v in value.items()])
+                self._needs_full_write = True
+            dict.__setitem__(self.data, name, table)
+            self._sqlite_maps[name] = table
+            if hasattr(self, attr_name):
+                setattr(self, attr_name, table)
+        if create:
+            self.put('sqlite_generation', 0)
+            self._sqlite.set_generation(0)
+        elif (generation := self._sqlite.get_generation()) != self.get('sqlite_generation', 0):
+            # e.g. we stopped between writing the wallet file and committing the database;
+            # the synchronizer fetches the history we do not have again
+            self.logger.warning(f'sqlite database is at generation {generation}, '
+                                f'wallet file at {self.get("sqlite_generation", 0)}')
+        self._sqlite.commit()
+        self.logger.info(f'using sqlite database {self._sqlite.path}')
+
+    def is_using_sqlite(self) -> bool:
+        return self._sqlite is not None
+
+    @locked
+    def convert_to_sqlite(self) -> bool:
+        """Moves the transaction, history and verified asset data to an sqlite database.
+        Returns False if the db already uses one.
+        """
+        if self._sqlite:
+            return False
+        if not self.storage:
+            raise WalletFileException('cannot convert a wallet without storage')
+        if self.storage.is_encrypted():
+            raise WalletFileException('cannot convert an encrypted wallet: the sqlite database is not encrypted')
+        self.put('use_sqlite', True)
+        self._load_sqlite_maps(create=True)
+        self.write()
+        return True
+
+    def add_patch(self, patch: dict) -> None:
+        table = self._sqlite_maps.get(patch['path'][0]) if patch['path'] else None
+        if table is None:
+            return JsonDB.add_patch(self, patch)
+        with self.lock:
+            self.note_journaled()
+            table.apply_patch(patch)
+
+    @locked
+    def dump(self, *, human_readable: bool = True, for_storage: bool = False) -> str:
+        if not self._sqlite:
+            return JsonDB.dump(self, human_readable=human_readable, for_storage=for_storage)
+        data = dict(self.data)
+        for name in SQLITE_MAPS:
+            if for_storage:
+                data.pop(name)
+            else:
+                # a self-contained json wallet
+                data[name] = data[name].to_json()
+        if not for_storage:
+            data.pop('use_sqlite')
+            data.pop('sqlite_generation', None)
+        return json.dumps(
+            data,
+            indent=4 if human_readable else None,
+            sort_keys=bool(human_readable),
+            cls=JsonDBJsonEncoder,
+        )
+
+    def _write(self):
+        # the sqlite database is committed after the wallet file is written, so
+        # that it never has changes the file does not know of. If we stop in
+        # between, the generation numbers differ on the next start.
+        if self._sqlite and self._sqlite.has_uncommitted_changes():
+            generation = self.get('sqlite_generation', 0) + 1
+            self.put('sqlite_generation', generation)
+            self._sqlite.set_generation(generation)
+        JsonDB._write(self)
+        if self._sqlite and not self.modified():
+            self._sqlite.commit()
+
+    def close(self) -> None:
+        """Closes the sqlite database, if any. To be called once the db has
+        been written for the last time."""
+        with self.lock:
+            if self._sqlite:
+                self._sqlite.close()
 
     @modifier
     def clear_history(self):
@@ -1006,8 +1222,10 @@ class WalletDB(JsonDB):
         self.txo.clear()
         self.spent_outpoints.clear()
         self.transactions.clear()
+        self._tx_cache.clear()
         self.history.clear()
         self.verified_tx.clear()
+        self._verified_tx_by_height.clear()
         self.tx_fees.clear()
         self._prevouts_by_scripthash.clear()
 
@@ -0,0 +1,274 @@
+import json
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import TYPE_CHECKING, Iterator, Optional, Sequence, Tuple, Any
+
+from .logging import Logger
+from .util import test_read_write_permissions
+from . import json_db
+from .json_db import StoredDict, StoredObject, JsonDBJsonEncoder
+
+if TYPE_CHECKING:
+    from .wallet_db import WalletDB
+
+
+# keys of the wallet file that are kept in the SQLite database, when it is enabled.
+# -> name of the WalletDB attribute referencing them
+SQLITE_MAPS = {
+    'txi': 'txi',
+    'txo': 'txo',
+    'transactions': 'transactions',
+    'spent_outpoints': 'spent_outpoints',
+    'addr_history': 'history',
+    'verified_tx3': 'verified_tx',
+    'tx_fees': 'tx_fees',
+    'prevouts_by_scripthash': '_prevouts_by_scripthash',
+    'verified_asset_metadata': 'verified_asset_metadata',
+    'verified_qualifier_tags': 'verified_tags_for_qualifiers',
+    'verified_h160_tags': 'verified_tags_for_h160s',
+    'verified_verifier_strings': 'verified_restricted_verifiers',
+    'verified_freezes': 'verified_restricted_freezes',
+    'verified_broadcasts': 'verified_broadcasts',
+}
+
+# number of rows per table kept deserialized in memory
+SQLITE_ROW_CACHE_SIZE = 1000
+
+
+def get_sqlite_path(wallet_path: str) -> str:
+    return wallet_path + '.sqlite'
+
+
+class WalletSqlite(Logger):
+    """SQLite database holding the large maps of a wallet file (see SQLITE_MAPS).
+
+    Each map is a table of (key, json value) rows, indexed by key.
+    Unlike SqlDB, which runs requests on its own thread and returns futures,
+    this is used synchronously by WalletDB accessors, under the lock of the db.
+    Changes are committed after the wallet file is written (see WalletDB._write);
+    the generation number of the last commit is also saved in the wallet file.
+    """
+
+    def __init__(self, path: str):
+        Logger.__init__(self)
+        self.path = path
+        test_read_write_permissions(path)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.create_database()
+
+    def create_database(self):
+        with self.lock:
+            for name in SQLITE_MAPS:
+                self.conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS "{name}" (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+            self.conn.commit()
+
+    def get_generation(self) -> int:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key='generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def set_generation(self, generation: int) -> None:
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (str(generation),))
+
+    def has_uncommitted_changes(self) -> bool:
+        with self.lock:
+            return self.conn.in_transaction
+
+    def get(self, name: str, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute(f'SELECT value FROM "{name}" WHERE key=?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def contains(self, name: str, key: str) -> bool:
+        with self.lock:
+            return self.conn.execute(f'SELECT 1 FROM "{name}" WHERE key=?', (key,)).fetchone() is not None
+
+    def put(self, name: str, key: str, value: str) -> None:
+        with self.lock:
+            self.conn.execute(f'INSERT OR REPLACE INTO "{name}" (key, value) VALUES (?, ?)', (key, value))
+
+    def put_many(self, name: str, rows: Sequence[Tuple[str, str]]) -> None:
+        with self.lock:
+            self.conn.executemany(f'INSERT OR REPLACE INTO "{name}" (key, value) VALUES (?, ?)', rows)
+
+    def delete(self, name: str, key: str) -> None:
+        with self.lock:
+            self.conn.execute(f'DELETE FROM "{name}" WHERE key=?', (key,))
+
+    def clear(self, name: str) -> None:
+        with self.lock:
+            self.conn.execute(f'DELETE FROM "{name}"')
+
+    def keys(self, name: str) -> Sequence[str]:
+        with self.lock:
+            return [row[0] for row in self.conn.execute(f'SELECT key FROM "{name}"')]
+
+    def count(self, name: str) -> int:
+        with self.lock:
+            return self.conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+
+    def commit(self) -> None:
+        with self.lock:
+            self.conn.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class SqliteStoredDict(MutableMapping):
+    """A top-level map of the wallet db, backed by a table of WalletSqlite.
+
+    Rows are deserialized on access, the same way StoredDict converts the
+    items of a map loaded from json. Changes made to the returned values
+    (StoredDicts, StoredObjects) reach us as patches, see apply_patch.
+    """
+
+    def __init__(self, backend: WalletSqlite, db: 'WalletDB', name: str):
+        assert name not in json_db.registered_dict_keys
+        self.backend = backend
+        self.db = db
+        self.name = name
+        self._cache = OrderedDict()  # LRU of recently used rows
+        self._live = weakref.WeakValueDictionary()  # rows still referenced elsewhere
+
+    def _convert(self, key: str, v: Any) -> Any:
+        # mirrors StoredDict.__setitem__ for the items of a map
+        path = [self.name]
+        if isinstance(v, StoredDict):
+            v.db = self.db
+            v.path = path + [key]
+        elif isinstance(v, dict):
+            v = self.db._convert_dict(path, key, v)
+            if self.db._should_convert_to_stored_dict(key):
+                v = StoredDict(v, self.db, path + [key])
+        if isinstance(v, (dict, str, int, list)):
+            v = self.db._convert_value(path, key, v)
+        if isinstance(v, StoredObject):
+            v.set_db(self.db, path + [key])
+        return v
+
+    def _load(self, key: str, raw: str) -> Any:
+        x = json.loads(raw)
+        if self.name in json_db.registered_dicts:
+            constructor, _type = json_db.registered_dicts[self.name]
+            if _type == dict:
+                x = constructor(**x)
+            elif _type == tuple:
+                x = constructor(*x)
+            else:
+                x = constructor(x)
+        return self._convert(key, x)
+
+    def _remember(self, key: str, v: Any) -> None:
+        self._cache[key] = v
+        self._cache.move_to_end(key)
+        if len(self._cache) > SQLITE_ROW_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        try:
+            self._live[key] = v
+        except TypeError:  # not weak-referenceable, e.g. a tuple
+            pass
+
+    def _forget(self, key: str) -> None:
+        self._cache.pop(key, None)
+        self._live.pop(key, None)
+
+    def _get_cached(self, key: str) -> Any:
+        v = self._cache.get(key)
+        if v is None:
+            v = self._live.get(key)
+        return v
+
+    def __getitem__(self, key: str) -> Any:
+        with self.db.lock:
+            v = self._get_cached(key)
+            if v is None:
+                raw = self.backend.get(self.name, key)
+                if raw is None:
+                    raise KeyError(key)
+                v = self._load(key, raw)
+            self._remember(key, v)
+            return v
+
+    def __contains__(self, key) -> bool:
+        with self.db.lock:
+            return self._get_cached(key) is not None or self.backend.contains(self.name, key)
+
+    def __setitem__(self, key: str, v: Any) -> None:
+        with self.db.lock:
+            v = self._convert(key, v)
+            self.backend.put(self.name, key, json.dumps(v, cls=JsonDBJsonEncoder))
+            self._forget(key)
+            self._remember(key, v)
+            self.db.note_journaled()
+
+    def __delitem__(self, key: str) -> None:
+        with self.db.lock:
+            if key not in self:
+                raise KeyError(key)
+            self.backend.delete(self.name, key)
+            self._forget(key)
+            self.db.note_journaled()
+
+    def pop(self, key: str, *args) -> Any:
+        with self.db.lock:
+            if key not in self and args:
+                self.db.note_journaled(modified=False)
+                return args[0]
+            return super().pop(key, *args)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.backend.keys(self.name))
+
+    def __len__(self) -> int:
+        return self.backend.count(self.name)
+
+    def clear(self) -> None:
+        with self.db.lock:
+            self.backend.clear(self.name)
+            self._cache.clear()
+            self._live.clear()
+            self.db.note_journaled()
+
+    def apply_patch(self, patch: dict) -> None:
+        """Persists a change made below this map, recorded by StoredDict/StoredObject."""
+        path = patch['path'][1:]
+        with self.db.lock:
+            if not path:
+                if patch['op'] == 'replace' and not patch['value']:
+                    self.clear()
+                    return
+                raise Exception(f'unexpected patch for sqlite map {self.name}: {patch["op"]}')
+            key = path[0]
+            if len(path) == 1:
+                if patch['op'] == 'remove':
+                    self.backend.delete(self.name, key)
+                    self._forget(key)
+                else:
+                    self.backend.put(self.name, key, json.dumps(patch['value'], cls=JsonDBJsonEncoder))
+                return
+            v = self._get_cached(key)
+            if v is not None:
+                # the changed row is in memory: save it as a whole
+                self.backend.put(self.name, key, json.dumps(v, cls=JsonDBJsonEncoder))
+                return
+            raw = self.backend.get(self.name, key)
+            if raw is None:
+                raise KeyError(key)
+            x = json.loads(raw)
+            json_db.apply_patch(x, dict(patch, path=path[1:]))
+            self.backend.put(self.name, key, json.dumps(x, cls=JsonDBJsonEncoder))
+
+    def to_json(self) -> dict:
+        """All rows, e.g. to make a json backup of the wallet."""
+        with self.db.lock:
+            return {key: self[key] for key in self}